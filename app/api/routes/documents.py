@@ -1,23 +1,33 @@
 import os
-import uuid
-from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
-from typing import List
+import json
+import base64
+from datetime import datetime
+from fastapi import APIRouter, UploadFile, File, HTTPException, Depends, Query, Response
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, List, Optional, Tuple
 from app.config import settings
 from app.utils.logger import get_logger
-from app.core.document_processor import process_document
-from app.core.storage import upload_to_firebase, delete_from_firebase
-from app.db.vector_store import add_document_to_vectordb, delete_document_from_vectordb
-from app.db.models import FileMetadata, get_db_session
+from app.core.ingestion import QueueFullError, get_job, submit_bulk, submit_document
+from app.core.storage import delete_file
+from app.db.vector_store import delete_document_from_vectordb
+from sqlalchemy import Select, func, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.models import FileMetadata, SessionLocal, get_db_session
 
 router = APIRouter(prefix="/documents", tags=["Documents"])
 logger = get_logger(__name__)
 
-@router.post("/upload", status_code=201)
-async def upload_document(
-    file: UploadFile = File(...),
-    db_session=Depends(get_db_session)
-):
-    """Upload a document, process it and store in the system"""
+@router.post("/upload", status_code=202)
+async def upload_document(response: Response, file: UploadFile = File(...)):
+    """
+    Accept a document and queue it for processing
+    
+    The file is validated and spooled to disk, then extracted, embedded,
+    indexed, uploaded and saved by the background ingestion workers.
+    Poll GET /documents/jobs/{job_id} for progress. A file whose content
+    was already uploaded is not processed again; its existing file_id is
+    returned with status 200.
+    """
     try:
         # Check file extension
         _, file_ext = os.path.splitext(file.filename)
@@ -35,63 +45,87 @@ async def upload_document(
                 detail=f"File quá lớn. Kích thước tối đa: {settings.MAX_FILE_SIZE / (1024 * 1024)}MB"
             )
         
-        # Create unique ID for the file
-        file_id = str(uuid.uuid4())
-        
-        # Process document to get text chunks
-        logger.info(f"Processing document: {file.filename}")
-        chunks = await process_document(file_content, file.filename)
-        
-        # Generate embeddings and add to vector DB
-        vector_id = await add_document_to_vectordb(file_id, chunks)
-        
-        # Upload original file to Firebase
-        file_url = await upload_to_firebase(file_id, file_content, file.filename)
+        logger.info(f"Queueing document: {file.filename}")
+        job = await submit_document(file_content, file.filename)
         
-        # Save metadata to database
-        new_file = FileMetadata(
-            file_id=file_id,
-            filename=file.filename,
-            file_size=len(file_content),
-            file_type=file_ext.lower(),
-            vector_id=vector_id,
-            file_url=file_url
-        )
-        db_session.add(new_file)
-        db_session.commit()
+        if job.status == "duplicate":
+            response.status_code = 200
+            return {
+                "message": "Tài liệu đã tồn tại",
+                "job_id": job.job_id,
+                "file_id": job.file_id,
+                "duplicate": True
+            }
         
         return {
-            "message": "Upload thành công",
-            "file_id": file_id
+            "message": "Đã nhận tài liệu, đang xử lý",
+            "job_id": job.job_id,
+            "file_id": job.file_id,
+            "status_url": f"/documents/jobs/{job.job_id}"
         }
         
     except HTTPException as e:
         # Re-raise HTTP exceptions
         raise
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error("Error uploading document", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         await file.seek(0)
 
+@router.post("/bulk-upload", status_code=202)
+async def bulk_upload_documents(files: List[UploadFile] = File(...)):
+    """
+    Accept many documents, or ZIP archives of them, as one pipelined job
+    
+    Unsupported or oversized files are reported as skipped. Poll
+    GET /documents/jobs/{job_id} for per-file results and throughput.
+    """
+    try:
+        job = await submit_bulk([(file.filename, file.file) for file in files])
+        logger.info(f"Queueing bulk upload of {len(job.files)} files")
+        
+        return {
+            "message": "Đã nhận tài liệu, đang xử lý",
+            "job_id": job.job_id,
+            "status_url": f"/documents/jobs/{job.job_id}",
+            "files": [f.to_dict() for f in job.files]
+        }
+        
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        logger.error("Error uploading documents", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/jobs/{job_id}")
+async def get_ingestion_job(job_id: str):
+    """Report the status and per-stage (or, for bulk uploads, per-file) progress of an upload job"""
+    job = await get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job với ID {job_id} không tồn tại")
+    return job
+
 @router.delete("/{file_id}")
 async def delete_document(file_id: str, db_session=Depends(get_db_session)):
     """Delete a document and its embeddings by ID"""
     try:
         # Get file metadata
-        file_metadata = db_session.query(FileMetadata).filter_by(file_id=file_id).first()
+        file_metadata = await db_session.get(FileMetadata, file_id)
         if not file_metadata:
             raise HTTPException(status_code=404, detail=f"File với ID {file_id} không tồn tại")
         
-        # Delete from Firebase
-        await delete_from_firebase(file_id, file_metadata.filename)
+        # Delete the original file from storage
+        await delete_file(file_id, file_metadata.filename)
         
         # Delete from vector DB
         await delete_document_from_vectordb(file_id)
         
         # Delete metadata from database
-        db_session.delete(file_metadata)
-        db_session.commit()
+        await db_session.delete(file_metadata)
+        await db_session.commit()
         
         return {"message": "Xoá thành công"}
         
@@ -100,26 +134,118 @@ async def delete_document(file_id: str, db_session=Depends(get_db_session)):
         raise
     except Exception as e:
         logger.error(f"Error deleting document {file_id}", exc_info=True)
-        db_session.rollback()
+        await db_session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/")
-async def list_documents(db_session=Depends(get_db_session)):
-    """List all uploaded documents"""
+def _encode_cursor(upload_time: datetime, file_id: str) -> str:
+    """Opaque cursor pointing just past a document in the listing order"""
+    data = json.dumps([upload_time.isoformat(), file_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, str]:
     try:
-        files = db_session.query(FileMetadata).all()
-        return {
-            "documents": [
-                {
-                    "file_id": file.file_id,
-                    "filename": file.filename,
-                    "upload_time": file.upload_time,
-                    "file_size": file.file_size,
-                    "file_type": file.file_type
-                } 
-                for file in files
-            ]
-        }
-    except Exception as e:
-        logger.error("Error listing documents", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
+        upload_time, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(upload_time), str(file_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor không hợp lệ")
+
+def _filtered(query: Select, file_type: Optional[str], filename_prefix: Optional[str]) -> Select:
+    if file_type:
+        query = query.where(FileMetadata.file_type == file_type.lower())
+    if filename_prefix:
+        # One literal pattern, so Postgres can match it against the prefix index
+        escaped = filename_prefix.replace("/", "//").replace("%", "/%").replace("_", "/_")
+        query = query.where(FileMetadata.filename.like(escaped + "%", escape="/"))
+    return query
+
+async def _estimate_total(db_session: AsyncSession, count_query: Select) -> int:
+    """
+    Number of documents matching the filters
+    
+    On PostgreSQL this is the planner's row estimate (table statistics when
+    unfiltered), which costs no scan; other databases count exactly.
+    """
+    connection = await db_session.connection()
+    if connection.dialect.name == "postgresql":
+        compiled = count_query.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+        # Sent as is: text() would read a ":" in a filter value as a bind parameter
+        plan = (await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}")).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+    return (await db_session.execute(select(func.count()).select_from(count_query.subquery()))).scalar()
+
+async def _document_page(
+    query: Select,
+    count_query: Select,
+    limit: int,
+    include_total: bool
+) -> AsyncIterator[str]:
+    """Stream one page of the document list as JSON, row by row"""
+    # The session lives as long as the response body, not the request handler
+    async with SessionLocal() as db_session:
+        try:
+            rows = await db_session.stream(query.limit(limit + 1))
+            yield '{"documents": ['
+            count = 0
+            last = None
+            has_more = False
+            async for row in rows:
+                if count == limit:
+                    # One extra row tells whether there is a next page
+                    has_more = True
+                    break
+                yield ("," if count else "") + json.dumps({
+                    "file_id": row.file_id,
+                    "filename": row.filename,
+                    "upload_time": row.upload_time.isoformat() if row.upload_time else None,
+                    "file_size": row.file_size,
+                    "file_type": row.file_type
+                }, ensure_ascii=False)
+                count += 1
+                last = row
+            await rows.close()
+            
+            tail = {"next_cursor": _encode_cursor(last.upload_time, last.file_id) if has_more else None}
+            if include_total:
+                tail["total_estimate"] = await _estimate_total(db_session, count_query)
+            yield "], " + json.dumps(tail)[1:]
+        except Exception:
+            # The status line is already sent; the truncated body fails to parse
+            logger.error("Error listing documents", exc_info=True)
+            raise
+
+@router.get("/")
+async def list_documents(
+    limit: int = Query(50, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    file_type: Optional[str] = None,
+    filename_prefix: Optional[str] = None,
+    include_total: bool = False
+):
+    """
+    List uploaded documents, newest first, one page at a time
+    
+    Pages are read by keyset on (upload_time, file_id): pass the previous
+    page's next_cursor to get the next one (null on the last page). The
+    rows are streamed as they are read. include_total adds total_estimate,
+    the planner's estimate of matching documents on PostgreSQL.
+    """
+    columns = (
+        FileMetadata.file_id,
+        FileMetadata.filename,
+        FileMetadata.upload_time,
+        FileMetadata.file_size,
+        FileMetadata.file_type,
+    )
+    query = _filtered(select(*columns), file_type, filename_prefix)
+    count_query = _filtered(select(FileMetadata.file_id), file_type, filename_prefix)
+    if cursor:
+        upload_time, file_id = _decode_cursor(cursor)
+        query = query.where(tuple_(FileMetadata.upload_time, FileMetadata.file_id) < tuple_(upload_time, file_id))
+    query = query.order_by(FileMetadata.upload_time.desc(), FileMetadata.file_id.desc())
+    
+    return StreamingResponse(
+        _document_page(query, count_query, limit, include_total),
+        media_type="application/json"
+    )
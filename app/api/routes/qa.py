@@ -1,9 +1,16 @@
+import json
+import asyncio
 from fastapi import APIRouter, Depends, HTTPException, Body
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from app.config import settings
 from app.utils.logger import get_logger
-from app.core.qa_chain import get_answer
-from app.db.vector_store import search_similar_chunks
+from app.utils.metrics import stage_timer
+from app.core.answer_cache import AnswerCache, answer_cache
+from app.core.embedding import get_single_embedding
+from app.core.qa_chain import get_answer, stream_answer
+from app.db.vector_store import search_similar_chunks, search_similar_chunks_batch
 from app.db.models import get_db_session
 
 router = APIRouter(tags=["Q&A"])
@@ -16,6 +23,39 @@ class QuestionRequest(BaseModel):
     similarity_threshold: Optional[float] = 0.5  # Giảm từ 0.7 xuống 0.5
     top_k: Optional[int] = 3
 
+class BatchQuestionRequest(BaseModel):
+    questions: List[str]
+    file_id: Optional[str] = None
+    max_tokens: Optional[int] = 1000
+    similarity_threshold: Optional[float] = 0.5
+    top_k: Optional[int] = 3
+
+# Answer completions in flight across all /ask/batch requests
+_batch_completion_limit = asyncio.Semaphore(settings.ASK_BATCH_CONCURRENCY)
+
+NO_RESULTS_ANSWER = "Không tìm thấy thông tin liên quan đến câu hỏi của bạn trong tài liệu."
+
+async def _retrieve(request: QuestionRequest) -> Tuple[Optional[List[float]], List[Dict[str, str]]]:
+    """
+    Search for the chunks relevant to a question
+
+    Returns:
+        (question embedding, kept for the answer cache, or None when the
+        cache is disabled; relevant chunks)
+    """
+    query_embedding = None
+    if settings.ANSWER_CACHE_ENABLED:
+        with stage_timer("query_embed"):
+            query_embedding = await get_single_embedding(request.question)
+    relevant_chunks = await search_similar_chunks(
+        request.question, 
+        file_id=request.file_id,
+        similarity_threshold=request.similarity_threshold,
+        top_k=request.top_k,
+        query_embedding=query_embedding
+    )
+    return query_embedding, relevant_chunks
+
 @router.post("/ask")
 async def ask_question(
     request: QuestionRequest = Body(...),
@@ -27,20 +67,24 @@ async def ask_question(
             raise HTTPException(status_code=400, detail="Câu hỏi không được để trống")
 
         # Search for similar chunks in the vector DB
-        relevant_chunks = await search_similar_chunks(
-            request.question, 
-            file_id=request.file_id,
-            similarity_threshold=request.similarity_threshold,
-            top_k=request.top_k
-        )
+        query_embedding, relevant_chunks = await _retrieve(request)
         
         if not relevant_chunks:
             return {
-                "answer": "Không tìm thấy thông tin liên quan đến câu hỏi của bạn trong tài liệu."
+                "answer": NO_RESULTS_ANSWER
             }
         
+        # A near-identical question answered from the same chunks skips the completion
+        if query_embedding is not None:
+            cache_key = AnswerCache.make_key(request.file_id, request.max_tokens, relevant_chunks)
+            answer = answer_cache.get(query_embedding, cache_key)
+            if answer is not None:
+                return {"answer": answer}
+        
         # Get answer using OpenAI
         answer = await get_answer(request.question, relevant_chunks, request.max_tokens)
+        if query_embedding is not None:
+            answer_cache.put(query_embedding, cache_key, relevant_chunks, answer)
         
         return {"answer": answer}
         
@@ -50,3 +94,136 @@ async def ask_question(
     except Exception as e:
         logger.error("Error processing question", exc_info=True)
         raise HTTPException(status_code=500, detail="Đã xảy ra lỗi khi xử lý câu hỏi")
+
+def _sse_event(event: str, data: Dict) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _answer_events(
+    request: QuestionRequest,
+    query_embedding: Optional[List[float]],
+    relevant_chunks: List[Dict[str, str]]
+) -> AsyncIterator[str]:
+    """Stream answer tokens, then a final event with the source chunks"""
+    cached = None
+    if relevant_chunks and query_embedding is not None:
+        cache_key = AnswerCache.make_key(request.file_id, request.max_tokens, relevant_chunks)
+        cached = answer_cache.get(query_embedding, cache_key)
+    
+    if not relevant_chunks:
+        yield _sse_event("token", {"text": NO_RESULTS_ANSWER})
+    elif cached is not None:
+        # A cached answer is sent whole
+        yield _sse_event("token", {"text": cached})
+    else:
+        parts = []
+        try:
+            async for text in stream_answer(request.question, relevant_chunks, request.max_tokens):
+                parts.append(text)
+                yield _sse_event("token", {"text": text})
+        except Exception:
+            # The status line is already sent, so report the failure in the stream
+            logger.error("Error streaming answer", exc_info=True)
+            yield _sse_event("error", {"detail": "Đã xảy ra lỗi khi xử lý câu hỏi"})
+            return
+        if query_embedding is not None:
+            answer_cache.put(query_embedding, cache_key, relevant_chunks, "".join(parts).strip())
+    
+    yield _sse_event("done", {"sources": [chunk["metadata"] for chunk in relevant_chunks]})
+
+@router.post("/ask/stream")
+async def ask_question_stream(
+    request: QuestionRequest = Body(...),
+    db_session=Depends(get_db_session)
+):
+    """
+    Ask a question and stream the answer as Server-Sent Events
+    
+    Emits a "token" event ({"text": ...}) for each piece of the answer as
+    the model produces it, then a "done" event ({"sources": [...]}) with
+    the metadata of the chunks the answer is based on, or an "error" event
+    if generation fails midway.
+    """
+    try:
+        if not request.question:
+            raise HTTPException(status_code=400, detail="Câu hỏi không được để trống")
+
+        # Retrieval runs before the response starts, so its errors are still HTTP errors
+        query_embedding, relevant_chunks = await _retrieve(request)
+        
+        return StreamingResponse(
+            _answer_events(request, query_embedding, relevant_chunks),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        
+    except HTTPException as e:
+        # Re-raise HTTP exceptions
+        raise
+    except Exception as e:
+        logger.error("Error processing question", exc_info=True)
+        raise HTTPException(status_code=500, detail="Đã xảy ra lỗi khi xử lý câu hỏi")
+
+async def _batch_answer(question: str, relevant_chunks: List[Dict[str, str]], max_tokens: int) -> Dict:
+    """Answer one question of a batch, reporting a failure as that item's error"""
+    if not relevant_chunks:
+        return {"question": question, "answer": NO_RESULTS_ANSWER, "error": None}
+    try:
+        async with _batch_completion_limit:
+            answer = await get_answer(question, relevant_chunks, max_tokens)
+        return {"question": question, "answer": answer, "error": None}
+    except Exception:
+        logger.error("Error answering batch question", exc_info=True)
+        return {"question": question, "answer": None, "error": "Đã xảy ra lỗi khi xử lý câu hỏi"}
+
+@router.post("/ask/batch")
+async def ask_questions_batch(
+    request: BatchQuestionRequest = Body(...),
+    db_session=Depends(get_db_session)
+):
+    """
+    Answer many questions in one call
+    
+    All questions are embedded in batched requests and searched with one
+    multi-query index call; answers are generated with at most
+    ASK_BATCH_CONCURRENCY completions in flight. Results come back in input
+    order, and a question that fails gets an "error" instead of failing
+    the whole batch.
+    """
+    try:
+        if not request.questions:
+            raise HTTPException(status_code=400, detail="Danh sách câu hỏi không được để trống")
+        if len(request.questions) > settings.ASK_BATCH_MAX_QUESTIONS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Tối đa {settings.ASK_BATCH_MAX_QUESTIONS} câu hỏi mỗi lần"
+            )
+        
+        # Empty questions are reported per item and left out of the search
+        asked = [i for i, question in enumerate(request.questions) if question.strip()]
+        relevant_chunks = await search_similar_chunks_batch(
+            [request.questions[i] for i in asked],
+            file_id=request.file_id,
+            similarity_threshold=request.similarity_threshold,
+            top_k=request.top_k
+        )
+        
+        results = [
+            {"question": question, "answer": None, "error": "Câu hỏi không được để trống"}
+            for question in request.questions
+        ]
+        answers = await asyncio.gather(*(
+            _batch_answer(request.questions[i], chunks, request.max_tokens)
+            for i, chunks in zip(asked, relevant_chunks)
+        ))
+        for i, result in zip(asked, answers):
+            results[i] = result
+        
+        return {"results": results}
+        
+    except HTTPException as e:
+        # Re-raise HTTP exceptions
+        raise
+    except Exception as e:
+        logger.error("Error processing question batch", exc_info=True)
+        raise HTTPException(status_code=500, detail="Đã xảy ra lỗi khi xử lý câu hỏi")
@@ -16,14 +16,81 @@ class Settings(BaseSettings):
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
     EMBEDDING_MODEL: str = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
     QA_MODEL: str = os.getenv("QA_MODEL", "o4-mini")
+    OPENAI_TIMEOUT: float = float(os.getenv("OPENAI_TIMEOUT", "60"))
+    OPENAI_MAX_CONNECTIONS: int = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+    
+    # Embedding batching: each request holds at most EMBEDDING_BATCH_SIZE inputs
+    # and EMBEDDING_BATCH_TOKENS tokens, with EMBEDDING_CONCURRENCY requests in flight
+    EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+    EMBEDDING_BATCH_TOKENS: int = int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000"))
+    EMBEDDING_CONCURRENCY: int = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+    
+    # Embedding cache (in-memory LRU over an on-disk store in VECTOR_DB_PATH); memory
+    # entries are float32, about 6 KB each for 1536-dim vectors (10000 ≈ 60 MB per worker)
+    EMBEDDING_CACHE_ENABLED: bool = os.getenv("EMBEDDING_CACHE_ENABLED", "True").lower() in ("true", "1", "t")
+    EMBEDDING_CACHE_MEMORY_SIZE: int = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "10000"))
+    EMBEDDING_CACHE_DISK_SIZE: int = int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", "1000000"))
+    
+    # Batch Q&A (/ask/batch): at most ASK_BATCH_MAX_QUESTIONS questions per request, with
+    # ASK_BATCH_CONCURRENCY answer completions in flight across all batch requests
+    ASK_BATCH_MAX_QUESTIONS: int = int(os.getenv("ASK_BATCH_MAX_QUESTIONS", "1000"))
+    ASK_BATCH_CONCURRENCY: int = int(os.getenv("ASK_BATCH_CONCURRENCY", "8"))
+    
+    # Answer cache for /ask and /ask/stream (in memory, per worker): a question whose embedding is
+    # within ANSWER_CACHE_SIMILARITY (cosine) of a cached one and retrieves the same chunks gets
+    # the cached answer. Holds at most ANSWER_CACHE_SIZE answers for ANSWER_CACHE_TTL seconds
+    ANSWER_CACHE_ENABLED: bool = os.getenv("ANSWER_CACHE_ENABLED", "True").lower() in ("true", "1", "t")
+    ANSWER_CACHE_SIZE: int = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+    ANSWER_CACHE_TTL: float = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+    ANSWER_CACHE_SIMILARITY: float = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+    
+    # Answer context: retrieved chunks are merged, de-duplicated and cut to QA_CONTEXT_TOKENS
+    # tokens; passages at least QA_CONTEXT_DUPLICATE_THRESHOLD similar to a kept one are dropped
+    QA_CONTEXT_TOKENS: int = int(os.getenv("QA_CONTEXT_TOKENS", "3000"))
+    QA_CONTEXT_DUPLICATE_THRESHOLD: float = float(os.getenv("QA_CONTEXT_DUPLICATE_THRESHOLD", "0.9"))
     
     # Firebase config
     FIREBASE_CREDENTIALS: str = os.getenv("FIREBASE_CREDENTIALS", "")
     FIREBASE_BUCKET: str = os.getenv("FIREBASE_BUCKET", "")
     
-    # Vector DB choice (faiss or chroma)
+    # Document storage: firebase or local (files under LOCAL_STORAGE_PATH, linked as
+    # LOCAL_STORAGE_BASE_URL/... or file:// URIs). Files larger than STORAGE_CHUNK_SIZE
+    # (a multiple of 256 KB) are uploaded to Firebase in resumable chunks of that size
+    STORAGE_BACKEND: str = os.getenv("STORAGE_BACKEND", "firebase")
+    LOCAL_STORAGE_PATH: str = os.getenv("LOCAL_STORAGE_PATH", "./storage")
+    LOCAL_STORAGE_BASE_URL: str = os.getenv("LOCAL_STORAGE_BASE_URL", "")
+    STORAGE_CHUNK_SIZE: int = int(os.getenv("STORAGE_CHUNK_SIZE", str(8 * 1024 * 1024)))
+    
+    # Vector DB choice (faiss, numpy or chroma)
     VECTOR_DB: str = os.getenv("VECTOR_DB", "faiss")
     VECTOR_DB_PATH: str = os.getenv("VECTOR_DB_PATH", "./vectordb")
+    # Storage precision of the local index: float32, float16 or int8 (int8 needs VECTOR_DB=numpy).
+    # With float16/int8, top_k * VECTOR_RESCORE_FACTOR candidates are re-ranked against the
+    # full-precision vectors on disk (set to 0 to disable re-scoring)
+    VECTOR_PRECISION: str = os.getenv("VECTOR_PRECISION", "float32")
+    VECTOR_RESCORE_FACTOR: int = int(os.getenv("VECTOR_RESCORE_FACTOR", "4"))
+    # Local index type: flat (exact), hnsw (approximate, needs VECTOR_DB=faiss) or auto
+    # (switches to hnsw once the index holds VECTOR_ANN_THRESHOLD vectors). HNSW_M and
+    # HNSW_EF_CONSTRUCTION shape the graph; HNSW_EF_SEARCH trades recall for query latency
+    VECTOR_INDEX_TYPE: str = os.getenv("VECTOR_INDEX_TYPE", "auto")
+    VECTOR_ANN_THRESHOLD: int = int(os.getenv("VECTOR_ANN_THRESHOLD", "200000"))
+    HNSW_M: int = int(os.getenv("HNSW_M", "32"))
+    HNSW_EF_CONSTRUCTION: int = int(os.getenv("HNSW_EF_CONSTRUCTION", "80"))
+    HNSW_EF_SEARCH: int = int(os.getenv("HNSW_EF_SEARCH", "64"))
+    # Compact the local (faiss/numpy) index once this fraction of its vectors is deleted
+    # (FAISS_COMPACTION_THRESHOLD, the earlier name, is still read)
+    VECTOR_COMPACTION_THRESHOLD: float = float(
+        os.getenv("VECTOR_COMPACTION_THRESHOLD", os.getenv("FAISS_COMPACTION_THRESHOLD", "0.2"))
+    )
+    # The index is a read-only snapshot shared by all workers through mmap; rows added after
+    # it are searched exactly until VECTOR_SNAPSHOT_ROWS of them call for a new snapshot.
+    # Workers check for changes published by other workers every VECTOR_RELOAD_INTERVAL seconds
+    VECTOR_SNAPSHOT_ROWS: int = int(os.getenv("VECTOR_SNAPSHOT_ROWS", "20000"))
+    VECTOR_RELOAD_INTERVAL: float = float(os.getenv("VECTOR_RELOAD_INTERVAL", "1.0"))
+    # Number of local shards; documents are assigned by a hash of their ID and global searches
+    # query every shard in parallel. Fixed once the store is created
+    VECTOR_SHARDS: int = int(os.getenv("VECTOR_SHARDS", "1"))
     
     # PostgreSQL config
     POSTGRES_USER: str = os.getenv("POSTGRES_USER", "postgres")
@@ -31,11 +98,56 @@ class Settings(BaseSettings):
     POSTGRES_HOST: str = os.getenv("POSTGRES_HOST", "localhost")
     POSTGRES_PORT: str = os.getenv("POSTGRES_PORT", "5432")
     POSTGRES_DB: str = os.getenv("POSTGRES_DB", "chatbot_db")
+    # Full SQLAlchemy async URL, overriding the POSTGRES_* settings when set
+    DATABASE_URL: str = os.getenv("DATABASE_URL", "")
+    # Connection pool: DB_POOL_SIZE persistent connections plus up to DB_MAX_OVERFLOW more
+    # under load; a request waits at most DB_POOL_TIMEOUT seconds for a free connection
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
     
     # File upload settings
     MAX_FILE_SIZE: int = 10 * 1024 * 1024  # 10 MB
     ALLOWED_EXTENSIONS: list = [".pdf", ".docx", ".txt"]
     
+    # Chunking: CHUNK_SIZE-token chunks overlapping by CHUNK_OVERLAP tokens, ending at a
+    # paragraph or sentence break when one falls in the second half of the chunk
+    CHUNK_SIZE: int = int(os.getenv("CHUNK_SIZE", "400"))
+    CHUNK_OVERLAP: int = int(os.getenv("CHUNK_OVERLAP", "50"))
+    CHUNK_SNAP_BOUNDARIES: bool = os.getenv("CHUNK_SNAP_BOUNDARIES", "True").lower() in ("true", "1", "t")
+    # Store chunks with identical text once in the local index; later documents reference them
+    CHUNK_DEDUP: bool = os.getenv("CHUNK_DEDUP", "True").lower() in ("true", "1", "t")
+    
+    # PDF extraction runs in PDF_WORKERS processes (0 = one per CPU); documents longer
+    # than PDF_PAGES_PER_TASK pages are split into page ranges extracted in parallel
+    PDF_WORKERS: int = int(os.getenv("PDF_WORKERS", "0"))
+    PDF_PAGES_PER_TASK: int = int(os.getenv("PDF_PAGES_PER_TASK", "50"))
+    PDF_SLOW_PAGE_MS: float = float(os.getenv("PDF_SLOW_PAGE_MS", "1000"))
+    
+    # Background ingestion: uploads are spooled to UPLOAD_SPOOL_PATH and processed by
+    # INGEST_WORKERS workers; each stage has its own concurrency limit so CPU-bound
+    # extraction and network-bound embedding overlap across documents
+    UPLOAD_SPOOL_PATH: str = os.getenv("UPLOAD_SPOOL_PATH", "./uploads")
+    INGEST_WORKERS: int = int(os.getenv("INGEST_WORKERS", "4"))
+    INGEST_QUEUE_SIZE: int = int(os.getenv("INGEST_QUEUE_SIZE", "100"))
+    INGEST_JOB_HISTORY: int = int(os.getenv("INGEST_JOB_HISTORY", "1000"))
+    # Jobs are kept in the database: the running worker refreshes them every
+    # INGEST_JOB_HEARTBEAT seconds, and an unfinished job not refreshed for
+    # INGEST_JOB_STALE_AFTER seconds (its worker stopped) is run again by another
+    # worker; spooled files no job refers to are removed after the same time
+    INGEST_JOB_HEARTBEAT: float = float(os.getenv("INGEST_JOB_HEARTBEAT", "5"))
+    INGEST_JOB_STALE_AFTER: float = float(os.getenv("INGEST_JOB_STALE_AFTER", "60"))
+    INGEST_EXTRACT_CONCURRENCY: int = int(os.getenv("INGEST_EXTRACT_CONCURRENCY", "2"))
+    INGEST_EMBED_CONCURRENCY: int = int(os.getenv("INGEST_EMBED_CONCURRENCY", "4"))
+    INGEST_INDEX_CONCURRENCY: int = int(os.getenv("INGEST_INDEX_CONCURRENCY", "1"))
+    INGEST_UPLOAD_CONCURRENCY: int = int(os.getenv("INGEST_UPLOAD_CONCURRENCY", "4"))
+    INGEST_SAVE_CONCURRENCY: int = int(os.getenv("INGEST_SAVE_CONCURRENCY", "4"))
+    # Bulk uploads: at most BULK_MAX_FILES documents per request (ZIP entries included);
+    # vector-store and Postgres writes commit up to BULK_WRITE_DOCS documents at once
+    BULK_MAX_FILES: int = int(os.getenv("BULK_MAX_FILES", "1000"))
+    BULK_WRITE_DOCS: int = int(os.getenv("BULK_WRITE_DOCS", "50"))
+    
     # Logs
     LOG_FOLDER: str = os.getenv("LOG_FOLDER", "logs")
 
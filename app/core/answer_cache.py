@@ -0,0 +1,153 @@
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+class _CachedAnswer:
+    __slots__ = ("key", "embedding", "answer", "doc_ids", "expires_at")
+
+    def __init__(self, key: Tuple, embedding: np.ndarray, answer: str, doc_ids: Set[str], expires_at: float):
+        self.key = key
+        self.embedding = embedding
+        self.answer = answer
+        self.doc_ids = doc_ids
+        self.expires_at = expires_at
+
+class AnswerCache:
+    """
+    Semantic cache of generated answers
+
+    An answer is reused for a question whose embedding is within
+    `similarity` (cosine) of the cached question's and which retrieved the
+    same chunks, in the same order, for the same file_id and max_tokens, so
+    the answer is always based on the context it would be generated from.
+    Chunks are identified by a digest of their text: once a document is
+    deleted or re-indexed with other content, its old chunks are no longer
+    retrieved and entries built on them stop matching in every worker.
+
+    Holds at most max_entries answers, evicting the least recently used,
+    each for ttl seconds. Used from the event loop only.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, similarity: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+
+        self._entries: "OrderedDict[int, _CachedAnswer]" = OrderedDict()
+        # Entries sharing a key (file_id, max_tokens, chunk IDs), and entries per referenced document
+        self._by_key: Dict[Tuple, List[int]] = {}
+        self._by_document: Dict[str, Set[int]] = {}
+        self._next_id = 0
+
+        # Hit/miss counters
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(file_id: Optional[str], max_tokens: Optional[int], chunks: List[Dict[str, str]]) -> Tuple:
+        """Build the exact part of the cache key from the request and its retrieved chunks"""
+        chunk_ids = tuple(
+            hashlib.blake2b(chunk["content"].encode("utf-8"), digest_size=8).hexdigest()
+            for chunk in chunks
+        )
+        return (file_id, max_tokens, chunk_ids)
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        ids = self._by_key[entry.key]
+        ids.remove(entry_id)
+        if not ids:
+            del self._by_key[entry.key]
+        for doc_id in entry.doc_ids:
+            ids = self._by_document[doc_id]
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_document[doc_id]
+
+    def _nearest(self, key: Tuple, vector: np.ndarray) -> Tuple[Optional[int], float]:
+        """Most similar live entry under a key, dropping expired ones on the way"""
+        now = time.monotonic()
+        best_id, best_similarity = None, -1.0
+        for entry_id in list(self._by_key.get(key, ())):
+            entry = self._entries[entry_id]
+            if entry.expires_at <= now:
+                self._remove(entry_id)
+                self.expirations += 1
+                continue
+            similarity = float(entry.embedding @ vector)
+            if similarity > best_similarity:
+                best_id, best_similarity = entry_id, similarity
+        return best_id, best_similarity
+
+    def get(self, embedding: List[float], key: Tuple) -> Optional[str]:
+        """Return the cached answer for a question, or None"""
+        entry_id, similarity = self._nearest(key, self._normalize(embedding))
+        if entry_id is None or similarity < self.similarity:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(entry_id)
+        self.hits += 1
+        return self._entries[entry_id].answer
+
+    def put(self, embedding: List[float], key: Tuple, chunks: List[Dict[str, str]], answer: str):
+        """Cache an answer, replacing one for a near-identical question"""
+        vector = self._normalize(embedding)
+        entry_id, similarity = self._nearest(key, vector)
+        if entry_id is not None and similarity >= self.similarity:
+            self._remove(entry_id)
+
+        doc_ids = {chunk["metadata"]["doc_id"] for chunk in chunks if chunk.get("metadata", {}).get("doc_id")}
+        if key[0]:
+            doc_ids.add(key[0])
+
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = _CachedAnswer(key, vector, answer, doc_ids, time.monotonic() + self.ttl)
+        self._by_key.setdefault(key, []).append(entry_id)
+        for doc_id in doc_ids:
+            self._by_document.setdefault(doc_id, set()).add(entry_id)
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate_documents(self, doc_ids: Iterable[str]):
+        """Drop the answers based on any of the given documents"""
+        for doc_id in doc_ids:
+            for entry_id in list(self._by_document.get(doc_id, ())):
+                self._remove(entry_id)
+                self.invalidations += 1
+
+    def stats(self) -> Dict[str, float]:
+        """Return hit/miss and removal counters and the number of cached answers"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "items": len(self._entries),
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+answer_cache = AnswerCache(
+    max_entries=settings.ANSWER_CACHE_SIZE,
+    ttl=settings.ANSWER_CACHE_TTL,
+    similarity=settings.ANSWER_CACHE_SIMILARITY,
+)
@@ -1,28 +1,49 @@
 import os
+import re
+import asyncio
 import fitz  # PyMuPDF
 import docx
 import tiktoken
-from typing import List, Dict
+import numpy as np
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
+from app.config import settings
+from app.core.pdf_extraction import extract_pdf
 from app.utils.logger import get_logger
+from app.utils.metrics import stage_timer
 
 logger = get_logger(__name__)
 
 # Initialize tokenizer for counting tokens
 tokenizer = tiktoken.get_encoding("cl100k_base")
 
-async def extract_text_from_pdf(file_content: bytes) -> str:
-    """Extract text from a PDF file"""
+# Byte length of every token ID, built on first use
+_token_lengths: Optional[np.ndarray] = None
+
+# A snapped chunk keeps at least this fraction of the token budget
+SNAP_MIN_FRACTION = 0.5
+
+# Tokens at the end of a partial buffer may merge with text that hasn't
+# arrived yet, so chunks stop this many tokens short of it
+BOUNDARY_MARGIN = 16
+
+# Text is tokenized once it adds up to about this many chunks; each buffer
+# re-tokenizes the text carried over from the previous one, which costs
+# little only when the buffer is several chunks long
+PENDING_CHUNKS = 8
+
+# End of a sentence in UTF-8: terminal punctuation plus any closing quotes/brackets
+SENTENCE_END = re.compile(r'[.!?…]["”’)\]]*(?=\s)'.encode("utf-8"))
+
+def extract_text_from_pdf(file_content: bytes) -> str:
+    """Extract text from a PDF file in the current process"""
     try:
         with fitz.open(stream=file_content, filetype="pdf") as doc:
-            text = ""
-            for page in doc:
-                text += page.get_text()
-            return text
+            return "".join(page.get_text() for page in doc)
     except Exception as e:
         logger.error("Error extracting text from PDF", exc_info=True)
         raise Exception(f"Không thể đọc file PDF: {str(e)}")
 
-async def extract_text_from_docx(file_content: bytes) -> str:
+def extract_text_from_docx(file_content: bytes) -> str:
     """Extract text from a DOCX file"""
     try:
         import io
@@ -32,7 +53,7 @@ async def extract_text_from_docx(file_content: bytes) -> str:
         logger.error("Error extracting text from DOCX", exc_info=True)
         raise Exception(f"Không thể đọc file Word: {str(e)}")
 
-async def extract_text_from_txt(file_content: bytes) -> str:
+def extract_text_from_txt(file_content: bytes) -> str:
     """Extract text from a TXT file"""
     try:
         return file_content.decode('utf-8')
@@ -44,43 +65,174 @@ async def extract_text_from_txt(file_content: bytes) -> str:
             logger.error("Error extracting text from TXT", exc_info=True)
             raise Exception(f"Không thể đọc file text: {str(e)}")
 
-async def chunk_text(text: str, chunk_size: int = 400, overlap: int = 50) -> List[str]:
-    """Split text into chunks with a specific token size and overlap"""
-    tokens = tokenizer.encode(text)
-    chunks = []
-    
-    i = 0
-    while i < len(tokens):
-        # Get a chunk of tokens
-        chunk_end = min(i + chunk_size, len(tokens))
-        chunk_tokens = tokens[i:chunk_end]
-        
-        # Convert tokens back to text
-        chunk_text = tokenizer.decode(chunk_tokens)
-        chunks.append(chunk_text)
-        
-        # Move index with overlap
-        i += (chunk_size - overlap)
-    
-    return chunks
+def _token_offsets(tokens: List[int]) -> np.ndarray:
+    """UTF-8 byte offset of each token in the encoded text, plus the total length"""
+    global _token_lengths
+    if _token_lengths is None:
+        lengths = np.zeros(tokenizer.n_vocab, dtype=np.int64)
+        for token in range(tokenizer.n_vocab):
+            try:
+                lengths[token] = len(tokenizer.decode_single_token_bytes(token))
+            except KeyError:
+                # Unused IDs in the vocabulary range
+                pass
+        _token_lengths = lengths
 
-async def process_document(file_content: bytes, filename: str) -> List[Dict[str, str]]:
-    """Process a document to extract and chunk text"""
-    _, file_ext = os.path.splitext(filename)
-    file_ext = file_ext.lower()
-    
-    # Extract text based on file type
-    if file_ext == '.pdf':
-        text = await extract_text_from_pdf(file_content)
-    elif file_ext == '.docx':
-        text = await extract_text_from_docx(file_content)
-    elif file_ext == '.txt':
-        text = await extract_text_from_txt(file_content)
+    offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum(_token_lengths[np.array(tokens, dtype=np.int64)], out=offsets[1:])
+    return offsets
+
+def _snap_end(data: bytes, offsets: np.ndarray, start: int, end: int) -> int:
+    """
+    Move a chunk's end token back to a paragraph or sentence break
+
+    Searches tokens (start + SNAP_MIN_FRACTION * budget, end] and returns
+    the token index the chunk should end before, or end if there's no break.
+    """
+    lo = start + max(int((end - start) * SNAP_MIN_FRACTION), 1)
+    if lo >= end:
+        return end
+    window_start, window_end = int(offsets[lo]), int(offsets[end])
+
+    boundary = data.rfind(b"\n\n", window_start, window_end)
+    if boundary != -1:
+        boundary += 2
     else:
-        raise Exception(f"Không hỗ trợ định dạng file {file_ext}")
-    
-    # Chunk the text
-    text_chunks = await chunk_text(text)
+        sentence = None
+        for sentence in SENTENCE_END.finditer(data, window_start, window_end):
+            pass
+        if sentence is not None:
+            boundary = sentence.end()
+        else:
+            boundary = data.rfind(b"\n", window_start, window_end)
+            if boundary == -1:
+                return end
+            boundary += 1
+
+    # First token that starts at or after the break
+    snapped = lo + int(np.searchsorted(offsets[lo:end + 1], boundary))
+    return snapped if lo < snapped <= end else end
+
+def _char_aligned(data: bytes, offsets: np.ndarray) -> np.ndarray:
+    """Whether each token offset starts a UTF-8 character (rather than falling inside one)"""
+    starts_char = (np.frombuffer(data, dtype=np.uint8) & 0xC0) != 0x80
+    return np.append(starts_char, True)[offsets]
+
+def _aligned_before(aligned: np.ndarray, start: int, end: int) -> int:
+    """
+    Last token index in (start, end] at a character boundary, or the first
+    one after end if a single character spans the whole range
+    """
+    i = end
+    while i > start and not aligned[i]:
+        i -= 1
+    if i > start:
+        return i
+    i = end
+    while not aligned[i]:
+        i += 1
+    return i
+
+def _split_buffer(
+    buffer: str,
+    chunk_size: int,
+    overlap: int,
+    snap: bool,
+    final: bool
+) -> Tuple[str, List[str]]:
+    """
+    Cut as many chunks from the front of buffer as its tokens allow
+
+    The buffer is tokenized once. Chunk text is sliced out of its UTF-8
+    bytes by token byte offsets instead of decoding every window. Chunks
+    start and end only at tokens that begin a character, so a character
+    split across tokens is never cut and its tokens count against the
+    chunk that holds it.
+
+    Returns:
+        (unconsumed text, including the overlap of the next chunk; chunks)
+    """
+    data = buffer.encode("utf-8")
+    tokens = tokenizer.encode_ordinary(buffer)
+    offsets = _token_offsets(tokens)
+    aligned = _char_aligned(data, offsets)
+    n = len(tokens)
+
+    chunks = []
+    start = 0
+    while start < n:
+        end = start + chunk_size
+        if not final and end + BOUNDARY_MARGIN > n:
+            break
+        end = min(end, n)
+        if snap and end < n:
+            end = _snap_end(data, offsets, start, end)
+        end = _aligned_before(aligned, start, end)
+
+        chunk = data[int(offsets[start]):int(offsets[end])].decode("utf-8")
+        if chunk.strip():
+            chunks.append(chunk)
+        if end == n:
+            return "", chunks
+        start = _aligned_before(aligned, start, max(end - overlap, start + 1))
+
+    return data[int(offsets[start]):].decode("utf-8"), chunks
+
+def iter_chunks(
+    pieces: Iterable[str],
+    chunk_size: int = 400,
+    overlap: int = 50,
+    snap: Optional[bool] = None
+) -> Iterator[str]:
+    """
+    Split text into chunks of at most chunk_size tokens, overlapping by overlap tokens
+
+    Text is consumed incrementally (e.g. one PDF page at a time), so only
+    about PENDING_CHUNKS chunks' worth of pending text and tokens is held
+    at once. Chunks end at character boundaries, so the overlap can be a
+    token or two off, and a single character encoded as more than
+    chunk_size tokens still makes a chunk of its own.
+
+    Args:
+        pieces: Consecutive pieces of the document text
+        chunk_size: Maximum tokens per chunk
+        overlap: Tokens shared by consecutive chunks
+        snap: End chunks at paragraph or sentence breaks when one falls in
+            the second half of the token budget (default CHUNK_SNAP_BOUNDARIES)
+
+    Yields:
+        Chunk texts, in document order
+    """
+    if snap is None:
+        snap = settings.CHUNK_SNAP_BOUNDARIES
+    overlap = min(overlap, chunk_size - 1)
+
+    # About 4 characters per token
+    min_pending = (chunk_size + BOUNDARY_MARGIN) * 4 * PENDING_CHUNKS
+
+    pending: List[str] = []
+    pending_chars = 0
+    for piece in pieces:
+        pending.append(piece)
+        pending_chars += len(piece)
+        if pending_chars < min_pending:
+            continue
+        rest, chunks = _split_buffer("".join(pending), chunk_size, overlap, snap, final=False)
+        yield from chunks
+        pending = [rest]
+        pending_chars = len(rest)
+
+    rest = "".join(pending)
+    if rest:
+        yield from _split_buffer(rest, chunk_size, overlap, snap, final=True)[1]
+
+def chunk_text(text: str, chunk_size: int = 400, overlap: int = 50) -> List[str]:
+    """Split text into chunks with a specific token size and overlap"""
+    return list(iter_chunks([text], chunk_size, overlap))
+
+def _make_chunks(pieces: Iterable[str], filename: str) -> List[Dict[str, str]]:
+    """Chunk extracted text and attach metadata (CPU-bound, runs in a worker thread)"""
+    text_chunks = iter_chunks(pieces, settings.CHUNK_SIZE, settings.CHUNK_OVERLAP)
     
     # Format chunks with metadata
     chunks = []
@@ -95,3 +247,49 @@ async def process_document(file_content: bytes, filename: str) -> List[Dict[str,
         })
     
     return chunks
+
+async def process_document(
+    file_content: bytes,
+    filename: str,
+    page_timings: Optional[List[float]] = None
+) -> List[Dict[str, str]]:
+    """
+    Process a document to extract and chunk text
+    
+    Args:
+        file_content: Binary content of the file
+        filename: Original filename
+        page_timings: If given, extended with the extraction time in
+            milliseconds of each PDF page
+    
+    Returns:
+        List of text chunks with metadata
+    """
+    _, file_ext = os.path.splitext(filename)
+    file_ext = file_ext.lower()
+    
+    # Extract text based on file type; extraction and tokenization are
+    # CPU-bound, so they run in the PDF process pool or a worker thread
+    if file_ext not in ('.pdf', '.docx', '.txt'):
+        raise Exception(f"Không hỗ trợ định dạng file {file_ext}")
+    
+    with stage_timer("extract"):
+        if file_ext == '.pdf':
+            try:
+                pages = await extract_pdf(file_content)
+            except Exception as e:
+                logger.error("Error extracting text from PDF", exc_info=True)
+                raise Exception(f"Không thể đọc file PDF: {str(e)}")
+            if page_timings is not None:
+                page_timings.extend(elapsed_ms for _, elapsed_ms in pages)
+            # Chunk page by page instead of joining the whole text first;
+            # extract_pdf still returns every page at once, so the extracted
+            # text (not its tokens) is held in full while chunking
+            pieces = [page_text for page_text, _ in pages]
+        elif file_ext == '.docx':
+            pieces = [await asyncio.to_thread(extract_text_from_docx, file_content)]
+        else:
+            pieces = [await asyncio.to_thread(extract_text_from_txt, file_content)]
+    
+    with stage_timer("chunk"):
+        return await asyncio.to_thread(_make_chunks, pieces, filename)
@@ -1,9 +1,14 @@
+import asyncio
 import openai
 import os
 import httpx
-from typing import List
+import tiktoken
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from typing import Awaitable, Callable, List
 from app.config import settings
+from app.core.embedding_cache import EmbeddingCache, embedding_cache
 from app.utils.logger import get_logger
+from app.utils.metrics import TOKENS, register_callback, stage_timer
 
 logger = get_logger(__name__)
 
@@ -17,27 +22,163 @@ if 'HTTP_PROXY' in os.environ:
 if 'HTTPS_PROXY' in os.environ:
     del os.environ['HTTPS_PROXY']
 
-# Tạo HTTP client không có proxy
-http_client = httpx.Client()
+# Client OpenAI dùng chung cho embedding và chat, tạo khi dùng lần đầu
+_client = None
 
-# Tạo client OpenAI sử dụng HTTP client tùy chỉnh
-client = openai.OpenAI(
-    api_key=settings.OPENAI_API_KEY,
-    http_client=http_client
-)
+def get_client() -> openai.AsyncOpenAI:
+    """The shared async OpenAI client, created with its connection pool on first use"""
+    global _client
+    if _client is None:
+        # HTTP client bất đồng bộ có connection pool
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(settings.OPENAI_TIMEOUT, connect=10.0),
+        )
+        _client = openai.AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            http_client=http_client
+        )
+    return _client
 
-async def get_embeddings(texts: List[str]) -> List[List[float]]:
+async def close_client():
+    """Close the shared client's connections, if it was created"""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+def _cache_metrics():
+    """Embedding cache counters, read from the cache when /metrics is scraped"""
+    stats = embedding_cache.stats()
+    lookups = CounterMetricFamily("chatbot_embedding_cache_lookups", "Embedding cache lookups by result", labels=["result"])
+    lookups.add_metric(["memory_hit"], stats["memory_hits"])
+    lookups.add_metric(["disk_hit"], stats["disk_hits"])
+    lookups.add_metric(["miss"], stats["misses"])
+    yield lookups
+    yield GaugeMetricFamily("chatbot_embedding_cache_hit_ratio", "Share of embedding cache lookups that hit", value=stats["hit_rate"])
+    items = GaugeMetricFamily("chatbot_embedding_cache_items", "Embeddings held by each cache tier", labels=["tier"])
+    items.add_metric(["memory"], stats["memory_items"])
+    items.add_metric(["disk"], stats["disk_items"])
+    yield items
+
+register_callback(_cache_metrics)
+
+# Tokenizer used to keep each request under the token limit
+tokenizer = tiktoken.get_encoding("cl100k_base")
+
+# Bounds the number of batch requests in flight across all uploads. Single
+# query embeddings bypass it so /ask never queues behind a large ingestion.
+_batch_semaphore = asyncio.Semaphore(settings.EMBEDDING_CONCURRENCY)
+
+def make_batches(texts: List[str]) -> List[List[int]]:
     """
-    Generate embeddings for a list of texts using OpenAI's embedding model
+    Group text positions into batches bounded by input count and token count
+
+    Args:
+        texts: Texts to embed
+
+    Returns:
+        List of batches, each a list of positions into texts
     """
-    try:
-        # Bỏ từ khóa await vì hàm create() không phải coroutine
-        response = client.embeddings.create(
+    token_counts = [len(tokens) for tokens in tokenizer.encode_ordinary_batch(texts)]
+
+    batches = []
+    current = []
+    current_tokens = 0
+    for i, n_tokens in enumerate(token_counts):
+        if current and (
+            len(current) >= settings.EMBEDDING_BATCH_SIZE
+            or current_tokens + n_tokens > settings.EMBEDDING_BATCH_TOKENS
+        ):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(i)
+        current_tokens += n_tokens
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+async def _embed_batch(texts: List[str]) -> List[List[float]]:
+    """Send one embeddings request and return vectors in input order"""
+    with stage_timer("embedding_request"):
+        response = await get_client().embeddings.create(
             model=settings.EMBEDDING_MODEL,
             input=texts,
         )
-        return [data.embedding for data in response.data]
-    
+    if response.usage:
+        TOKENS.labels("embedding").inc(response.usage.total_tokens)
+    return [data.embedding for data in sorted(response.data, key=lambda d: d.index)]
+
+async def _embed_batched(texts: List[str]) -> List[List[float]]:
+    """Embed texts in count- and token-bounded batches that run concurrently"""
+    batches = make_batches(texts)
+
+    async def run(batch: List[int]) -> List[List[float]]:
+        async with _batch_semaphore:
+            return await _embed_batch([texts[i] for i in batch])
+
+    if len(batches) > 1:
+        logger.info(f"Embedding {len(texts)} texts in {len(batches)} batches")
+
+    results = await asyncio.gather(*(run(batch) for batch in batches))
+
+    # Reassemble embeddings in input order
+    embeddings: List[List[float]] = [None] * len(texts)
+    for batch, batch_embeddings in zip(batches, results):
+        for i, embedding in zip(batch, batch_embeddings):
+            embeddings[i] = embedding
+
+    return embeddings
+
+async def _embed_with_cache(
+    texts: List[str],
+    embed: Callable[[List[str]], Awaitable[List[List[float]]]]
+) -> List[List[float]]:
+    """Serve texts from the embedding cache and embed only the misses"""
+    if not settings.EMBEDDING_CACHE_ENABLED:
+        return await embed(texts)
+
+    keys = [EmbeddingCache.make_key(settings.EMBEDDING_MODEL, text) for text in texts]
+
+    found = embedding_cache.get_many(keys)
+    missing = [key for key in dict.fromkeys(keys) if key not in found]
+    if missing:
+        found.update(await asyncio.to_thread(embedding_cache.load_many, missing))
+
+    # Each distinct text that is still missing is embedded once
+    pending = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in pending:
+            pending[key] = text
+
+    if pending:
+        fresh = dict(zip(pending.keys(), await embed(list(pending.values()))))
+        await asyncio.to_thread(embedding_cache.put_many, fresh)
+        found.update(fresh)
+
+    return [found[key] for key in keys]
+
+async def get_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    Generate embeddings for a list of texts using OpenAI's embedding model
+
+    Cached embeddings are reused; the rest are split into count- and
+    token-bounded batches that run concurrently. Results are returned in
+    the same order as texts.
+    """
+    if not texts:
+        return []
+
+    try:
+        with stage_timer("embed"):
+            return await _embed_with_cache(texts, _embed_batched)
+
     except Exception as e:
         logger.error(f"Error generating embeddings: {str(e)}")
         raise Exception(f"Lỗi khi tạo embedding: {str(e)}")
@@ -46,5 +187,10 @@ async def get_single_embedding(text: str) -> List[float]:
     """
     Generate embedding for a single text
     """
-    embeddings = await get_embeddings([text])
-    return embeddings[0]
+    try:
+        embeddings = await _embed_with_cache([text], _embed_batch)
+        return embeddings[0]
+
+    except Exception as e:
+        logger.error(f"Error generating embeddings: {str(e)}")
+        raise Exception(f"Lỗi khi tạo embedding: {str(e)}")
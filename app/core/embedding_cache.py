@@ -0,0 +1,179 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache
+
+    Entries are keyed on sha256(model, text). Lookups hit an in-memory LRU
+    first, then an SQLite store on disk; both tiers are bounded and evict
+    least recently used entries. The memory tier holds float32 arrays
+    (about 6 KB per 1536-dim vector, against about 49 KB as a list of
+    floats) and converts them to lists only when they are returned.
+    """
+
+    def __init__(self, path: str, memory_size: int, disk_size: int):
+        self.path = path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+
+        self._memory: "OrderedDict[str, array]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._disk_count = 0
+
+        # Hit/miss counters
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.memory_evictions = 0
+        self.disk_evictions = 0
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        """Build the cache key for a text embedded with a given model"""
+        digest = hashlib.sha256()
+        digest.update(model.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the disk store on first use"""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used)")
+            self._disk_count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, key: str, vector: array):
+        """Insert into the memory tier, evicting the least recently used entries"""
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+            self.memory_evictions += 1
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, List[float]]:
+        """Look up keys in the memory tier only (cheap, safe on the event loop)"""
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector.tolist()
+            self.memory_hits += len(found)
+        return found
+
+    def load_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """
+        Look up keys in the disk tier and promote hits into memory
+
+        Keys not found are counted as misses. This does blocking I/O and
+        should be run in a worker thread.
+        """
+        found = {}
+        if not keys:
+            return found
+
+        with self._lock:
+            conn = self._connect()
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector
+
+            if found:
+                now = time.time()
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                conn.commit()
+                for key, vector in found.items():
+                    self._remember(key, vector)
+
+            self.disk_hits += len(found)
+            self.misses += len(keys) - len(found)
+        return {key: vector.tolist() for key, vector in found.items()}
+
+    def put_many(self, items: Dict[str, List[float]]):
+        """
+        Store embeddings in both tiers
+
+        This does blocking I/O and should be run in a worker thread.
+        """
+        if not items:
+            return
+
+        vectors = {key: array("f", vector) for key, vector in items.items()}
+        with self._lock:
+            for key, vector in vectors.items():
+                self._remember(key, vector)
+
+            conn = self._connect()
+            now = time.time()
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, vector.tobytes(), now) for key, vector in vectors.items()]
+            )
+            self._disk_count += conn.total_changes - before
+
+            if self._disk_count > self.disk_size:
+                # Evict a little past the bound so we don't evict on every insert
+                excess = self._disk_count - self.disk_size + max(1, self.disk_size // 20)
+                conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (excess,)
+                )
+                self._disk_count -= excess
+                self.disk_evictions += excess
+            conn.commit()
+
+    def stats(self) -> Dict[str, float]:
+        """Return hit/miss counters and tier sizes"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_items": len(self._memory),
+            "disk_items": self._disk_count,
+            "memory_evictions": self.memory_evictions,
+            "disk_evictions": self.disk_evictions,
+        }
+
+embedding_cache = EmbeddingCache(
+    path=os.path.join(settings.VECTOR_DB_PATH, "embedding_cache.sqlite3"),
+    memory_size=settings.EMBEDDING_CACHE_MEMORY_SIZE,
+    disk_size=settings.EMBEDDING_CACHE_DISK_SIZE,
+)
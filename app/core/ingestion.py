@@ -0,0 +1,1143 @@
+import os
+import json
+import time
+import uuid
+import socket
+import shutil
+import hashlib
+import asyncio
+import zipfile
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple, Union
+from app.config import settings
+from app.core.document_processor import process_document
+from app.core.embedding import get_embeddings
+from app.core.storage import upload_file, delete_file
+from app.db.vector_store import add_document_to_vectordb, add_documents_to_vectordb, delete_document_from_vectordb
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from app.db.models import FileMetadata, IngestionJobRecord, SessionLocal
+from app.utils.logger import get_logger
+from app.utils.metrics import DOCUMENTS_INGESTED, stage_timer
+
+logger = get_logger(__name__)
+
+# Pipeline stages, in order
+STAGES = ["extract", "embed", "index", "upload", "save"]
+
+# Limits how many documents can be in each stage at once
+_stage_limits = {
+    "extract": asyncio.Semaphore(settings.INGEST_EXTRACT_CONCURRENCY),
+    "embed": asyncio.Semaphore(settings.INGEST_EMBED_CONCURRENCY),
+    "index": asyncio.Semaphore(settings.INGEST_INDEX_CONCURRENCY),
+    "upload": asyncio.Semaphore(settings.INGEST_UPLOAD_CONCURRENCY),
+    "save": asyncio.Semaphore(settings.INGEST_SAVE_CONCURRENCY),
+}
+
+os.makedirs(settings.UPLOAD_SPOOL_PATH, exist_ok=True)
+
+# Identifies this process in the jobs it runs
+_worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class QueueFullError(Exception):
+    """Raised when the ingestion queue cannot take another job"""
+
+class IngestionJob:
+    """Progress of one uploaded document through the ingestion stages"""
+
+    def __init__(self, file_id: str, filename: str, file_size: int, spool_path: Optional[str], content_hash: str):
+        self.job_id = str(uuid.uuid4())
+        self.file_id = file_id
+        self.filename = filename
+        self.file_size = file_size
+        self.spool_path = spool_path
+        self.content_hash = content_hash
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.chunks = 0
+        self.created_at = datetime.utcnow()
+        self.finished_at: Optional[datetime] = None
+        self.stages = {stage: {"status": "pending", "duration_ms": None} for stage in STAGES}
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "file_id": self.file_id,
+            "filename": self.filename,
+            "status": self.status,
+            "error": self.error,
+            "chunks": self.chunks,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "stages": self.stages,
+        }
+
+# Jobs this worker runs or ran, by ID; finished jobs beyond INGEST_JOB_HISTORY are
+# forgotten oldest first. Every job also has an IngestionJobRecord row, which is
+# how other workers report it and take it over if this worker stops
+_jobs: "OrderedDict[str, Union[IngestionJob, BulkIngestionJob]]" = OrderedDict()
+# file_id of documents this worker has queued or is ingesting, by content hash,
+# so a repeated upload is not processed twice here; once saved they are found
+# through FileMetadata.content_hash instead. Across workers the unique index on
+# content_hash decides: the copy saved second becomes a duplicate of the first
+_content_hashes: Dict[str, str] = {}
+_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+_maintenance: Optional[asyncio.Task] = None
+# Serializes job row writes so an older snapshot never overwrites a newer one
+_save_lock = asyncio.Lock()
+
+class _Stage:
+    """Async context manager that runs one stage under its concurrency limit and records it"""
+
+    def __init__(self, job: IngestionJob, name: str):
+        self.job = job
+        self.name = name
+        self.started = 0.0
+
+    async def __aenter__(self):
+        await _stage_limits[self.name].acquire()
+        self.started = time.perf_counter()
+        self.job.stages[self.name]["status"] = "running"
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _stage_limits[self.name].release()
+        stage = self.job.stages[self.name]
+        stage["status"] = "failed" if exc_type else "done"
+        stage["duration_ms"] = round((time.perf_counter() - self.started) * 1000, 1)
+        return False
+
+def _read_spool(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def _write_spool(path: str, content: bytes):
+    with open(path, "wb") as f:
+        f.write(content)
+
+def _hash_content(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+def _remove_spool(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _file_record(
+    file_id: str, filename: str, file_size: int, vector_id: str, file_url: str, content_hash: str
+) -> FileMetadata:
+    _, file_ext = os.path.splitext(filename)
+    return FileMetadata(
+        file_id=file_id,
+        filename=filename,
+        file_size=file_size,
+        file_type=file_ext.lower(),
+        vector_id=vector_id,
+        file_url=file_url,
+        content_hash=content_hash
+    )
+
+async def _find_stored(content_hashes: List[str]) -> Dict[str, str]:
+    """file_id of saved documents with the given content hashes"""
+    async with SessionLocal() as db_session:
+        result = await db_session.execute(
+            select(FileMetadata.content_hash, FileMetadata.file_id)
+            .where(FileMetadata.content_hash.in_(content_hashes))
+        )
+        return {content_hash: file_id for content_hash, file_id in result}
+
+async def _find_existing(content_hashes: List[str]) -> Dict[str, str]:
+    """file_id of documents with the given content hashes that are saved or being ingested"""
+    found = await _find_stored(content_hashes)
+    # Checked after the query so documents queued meanwhile are seen too
+    found.update(
+        (content_hash, _content_hashes[content_hash])
+        for content_hash in content_hashes if content_hash in _content_hashes
+    )
+    return found
+
+def _release_hash(content_hash: Optional[str], file_id: str):
+    if content_hash and _content_hashes.get(content_hash) == file_id:
+        del _content_hashes[content_hash]
+
+async def _save_metadata(records: List[FileMetadata]) -> Dict[str, str]:
+    """
+    Commit metadata rows in one transaction
+
+    Documents whose content another worker saved meanwhile are left out
+    and the rest committed again.
+
+    Returns:
+        The existing file_id for each left-out document, by its own file_id
+    """
+    duplicates = {}
+    while records:
+        try:
+            with stage_timer("db_save"):
+                async with SessionLocal() as db_session:
+                    db_session.add_all(records)
+                    await db_session.commit()
+            break
+        except IntegrityError:
+            stored = await _find_stored([r.content_hash for r in records if r.content_hash])
+            conflicting = [r for r in records if stored.get(r.content_hash, r.file_id) != r.file_id]
+            if not conflicting:
+                raise
+            for r in conflicting:
+                duplicates[r.file_id] = stored[r.content_hash]
+            records = [r for r in records if r.file_id not in duplicates]
+    return duplicates
+
+async def _discard_copy(file_id: str, filename: str):
+    """Remove the stored file and vectors of a document that turned out to be a duplicate"""
+    await delete_file(file_id, filename)
+    await delete_document_from_vectordb(file_id)
+
+async def _upload_job(job: IngestionJob) -> str:
+    async with _Stage(job, "upload"):
+        return await upload_file(job.file_id, job.spool_path, job.filename)
+
+async def _uploaded(upload: asyncio.Task) -> bool:
+    """Wait for an upload task to finish; True if it stored the file"""
+    await asyncio.wait([upload])
+    return not upload.cancelled() and upload.exception() is None
+
+async def _run_job(job: IngestionJob):
+    """
+    Run a job through every stage, undoing completed side effects on failure
+
+    If the worker shuts down meanwhile, the spool file is kept so the job
+    runs again after a restart.
+    """
+    job.status = "running"
+    indexed = False
+    # The original file goes to storage while it is extracted and embedded
+    upload = asyncio.create_task(_upload_job(job))
+    try:
+        file_content = await asyncio.to_thread(_read_spool, job.spool_path)
+
+        async with _Stage(job, "extract"):
+            page_timings = []
+            chunks = await process_document(file_content, job.filename, page_timings)
+            job.chunks = len(chunks)
+            if page_timings:
+                job.stages["extract"]["pages"] = len(page_timings)
+                job.stages["extract"]["slowest_pages"] = [
+                    {"page": page + 1, "duration_ms": round(page_timings[page], 1)}
+                    for page in sorted(range(len(page_timings)), key=page_timings.__getitem__, reverse=True)[:5]
+                ]
+
+        async with _Stage(job, "embed"):
+            embeddings = await get_embeddings([chunk["content"] for chunk in chunks])
+
+        async with _Stage(job, "index"):
+            vector_id = await add_document_to_vectordb(job.file_id, chunks, embeddings)
+            indexed = True
+
+        file_url = await upload
+
+        async with _Stage(job, "save"):
+            record = _file_record(job.file_id, job.filename, job.file_size, vector_id, file_url, job.content_hash)
+            duplicates = await _save_metadata([record])
+
+        if job.file_id in duplicates:
+            # Another worker saved the same content first; its file_id is the result
+            await _discard_copy(job.file_id, job.filename)
+            _release_hash(job.content_hash, job.file_id)
+            job.file_id = duplicates[job.file_id]
+            job.status = "duplicate"
+            logger.info(f"{job.filename} was saved meanwhile as {job.file_id}")
+        else:
+            job.status = "succeeded"
+            logger.info(f"Ingested {job.filename} ({job.chunks} chunks) as {job.file_id}")
+
+    except Exception as e:
+        logger.error(f"Error ingesting {job.filename} (job {job.job_id})", exc_info=True)
+        job.status = "failed"
+        job.error = str(e)
+        try:
+            # Also waited for when another stage failed, so the spool file
+            # outlives the upload and a finished upload is removed again
+            if await _uploaded(upload):
+                await delete_file(job.file_id, job.filename)
+            if indexed:
+                await delete_document_from_vectordb(job.file_id)
+        except Exception:
+            logger.error(f"Error cleaning up failed job {job.job_id}", exc_info=True)
+
+    except asyncio.CancelledError:
+        upload.cancel()
+        _release_hash(job.content_hash, job.file_id)
+        raise
+
+    job.finished_at = datetime.utcnow()
+    DOCUMENTS_INGESTED.labels(job.status).inc()
+    _remove_spool(job.spool_path)
+    _release_hash(job.content_hash, job.file_id)
+
+class BulkFile:
+    """One file of a bulk upload"""
+
+    def __init__(self, filename: str, file_size: int = 0, spool_path: Optional[str] = None, error: Optional[str] = None):
+        self.file_id = str(uuid.uuid4())
+        self.filename = filename
+        self.file_size = file_size
+        self.spool_path = spool_path
+        self.content_hash: Optional[str] = None
+        self.status = "skipped" if error else "queued"
+        self.error = error
+        self.chunks = 0
+        self.upload: Optional[asyncio.Task] = None
+        # Whether its chunks are in the vector store, to be removed if it fails
+        self.indexed = False
+
+    def fail(self, error: Exception):
+        self.status = "failed"
+        self.error = str(error)
+
+    def to_dict(self) -> Dict:
+        return {
+            "filename": self.filename,
+            "file_id": self.file_id if self.status in ("succeeded", "duplicate") else None,
+            "status": self.status,
+            "chunks": self.chunks,
+            "error": self.error,
+        }
+
+class BulkIngestionJob:
+    """Progress of a bulk upload through the pipelined ingestion stages"""
+
+    def __init__(self, files: List[BulkFile]):
+        self.job_id = str(uuid.uuid4())
+        self.files = files
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.created_at = datetime.utcnow()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+
+    def documents_per_minute(self) -> Optional[float]:
+        if self.started_at is None:
+            return None
+        elapsed = ((self.finished_at or datetime.utcnow()) - self.started_at).total_seconds()
+        succeeded = sum(1 for f in self.files if f.status == "succeeded")
+        return round(succeeded * 60 / elapsed, 1) if elapsed > 0 else None
+
+    def to_dict(self) -> Dict:
+        counts: Dict[str, int] = {}
+        for f in self.files:
+            counts[f.status] = counts.get(f.status, 0) + 1
+        return {
+            "job_id": self.job_id,
+            "type": "bulk",
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "counts": counts,
+            "documents_per_minute": self.documents_per_minute(),
+            "files": [f.to_dict() for f in self.files],
+        }
+
+# (file, chunks, embeddings) of an embedded document in the bulk pipeline
+_Embedded = Tuple[BulkFile, List[Dict[str, str]], List[List[float]]]
+
+async def _bulk_upload(f: BulkFile) -> str:
+    async with _stage_limits["upload"]:
+        return await upload_file(f.file_id, f.spool_path, f.filename)
+
+async def _bulk_extract(f: BulkFile, extracted: asyncio.Queue):
+    """Start uploading one file, extract it and hand its chunks to the embedding stage (extract slot already held)"""
+    f.upload = asyncio.create_task(_bulk_upload(f))
+    try:
+        f.status = "extracting"
+        file_content = await asyncio.to_thread(_read_spool, f.spool_path)
+        chunks = await process_document(file_content, f.filename)
+        f.chunks = len(chunks)
+        f.status = "extracted"
+    except Exception as e:
+        logger.error(f"Error extracting {f.filename}", exc_info=True)
+        f.fail(e)
+        return
+    await extracted.put((f, chunks))
+
+async def _bulk_extract_all(files: List[BulkFile], extracted: asyncio.Queue):
+    """
+    Extract files in order, each once an extract slot is free
+
+    A file keeps its slot until its chunks are queued, so while the
+    embedding stage falls behind no other extraction starts: at most the
+    slots' and the queue's worth of documents are held in memory.
+    """
+    tasks = []
+    try:
+        for f in files:
+            await _stage_limits["extract"].acquire()
+            task = asyncio.create_task(_bulk_extract(f, extracted))
+            # Released even if the task is cancelled before it starts
+            task.add_done_callback(lambda _: _stage_limits["extract"].release())
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    await extracted.put(None)
+
+class _PendingEmbedding:
+    """A document whose chunks are spread over one or more embedding batches"""
+
+    def __init__(self, f: BulkFile, chunks: List[Dict[str, str]]):
+        self.file = f
+        self.chunks = chunks
+        self.embeddings: List[Optional[List[float]]] = [None] * len(chunks)
+        self.remaining = len(chunks)
+
+async def _bulk_embed_batch(batch: List[Tuple[_PendingEmbedding, int]], embedded: asyncio.Queue):
+    """Embed one batch of chunks from any number of documents (embed slot already held)"""
+    try:
+        embeddings = await get_embeddings([doc.chunks[i]["content"] for doc, i in batch])
+    except Exception as e:
+        logger.error(f"Error embedding a batch of {len(batch)} chunks", exc_info=True)
+        for doc, _ in batch:
+            doc.file.fail(e)
+        return
+
+    for (doc, i), embedding in zip(batch, embeddings):
+        doc.embeddings[i] = embedding
+        doc.remaining -= 1
+        if doc.remaining == 0 and doc.file.status != "failed":
+            await embedded.put([(doc.file, doc.chunks, doc.embeddings)])
+
+async def _bulk_embed(extracted: asyncio.Queue, embedded: asyncio.Queue):
+    """
+    Pack chunks of consecutive documents into EMBEDDING_BATCH_SIZE batches
+    so requests are filled across document boundaries; a document moves on
+    once all of its batches are done
+    """
+    tasks = []
+    pending: List[Tuple[_PendingEmbedding, int]] = []
+
+    async def flush(size: int):
+        nonlocal pending
+        # Waiting for an embed slot here stops this stage from pulling more
+        # documents, which in turn holds back extraction
+        await _stage_limits["embed"].acquire()
+        batch, pending = pending[:size], pending[size:]
+        task = asyncio.create_task(_bulk_embed_batch(batch, embedded))
+        # Released once the request is done, even if cancelled before it starts
+        task.add_done_callback(lambda _: _stage_limits["embed"].release())
+        tasks.append(task)
+
+    try:
+        while True:
+            item = await extracted.get()
+            if item is None:
+                break
+            f, chunks = item
+            if not chunks:
+                await embedded.put([(f, chunks, [])])
+                continue
+            f.status = "embedding"
+            doc = _PendingEmbedding(f, chunks)
+            pending.extend((doc, i) for i in range(len(chunks)))
+            while len(pending) >= settings.EMBEDDING_BATCH_SIZE:
+                await flush(settings.EMBEDDING_BATCH_SIZE)
+        if pending:
+            await flush(len(pending))
+
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    await embedded.put(None)
+
+async def _bulk_write_batch(batch: List[_Embedded]):
+    """Index, upload and save a batch of embedded documents with bulk commits"""
+    files = [f for f, _, _ in batch]
+    try:
+        async with _stage_limits["index"]:
+            for f in files:
+                f.status = "indexing"
+            await add_documents_to_vectordb([(f.file_id, chunks, embeddings) for f, chunks, embeddings in batch])
+            for f in files:
+                f.indexed = True
+    except Exception as e:
+        logger.error(f"Error indexing {len(files)} documents", exc_info=True)
+        for f in files:
+            f.fail(e)
+        return
+
+    # Uploads started at extraction and have usually finished by now
+    for f in files:
+        f.status = "uploading"
+    file_urls = {}
+    uploaded = []
+    for f, result in zip(files, await asyncio.gather(*(f.upload for f in files), return_exceptions=True)):
+        if isinstance(result, Exception):
+            logger.error(f"Error uploading {f.filename}: {str(result)}")
+            f.fail(result)
+            try:
+                await delete_document_from_vectordb(f.file_id)
+                f.indexed = False
+            except Exception:
+                logger.error(f"Error cleaning up {f.filename}", exc_info=True)
+        else:
+            file_urls[f.file_id] = result
+            uploaded.append(f)
+
+    try:
+        async with _stage_limits["save"]:
+            for f in uploaded:
+                f.status = "saving"
+            records = [
+                _file_record(f.file_id, f.filename, f.file_size, f.file_id, file_urls[f.file_id], f.content_hash)
+                for f in uploaded
+            ]
+            duplicates = await _save_metadata(records)
+    except Exception as e:
+        logger.error(f"Error saving metadata for {len(uploaded)} documents", exc_info=True)
+        for f in uploaded:
+            f.fail(e)
+            try:
+                await delete_file(f.file_id, f.filename)
+                await delete_document_from_vectordb(f.file_id)
+                f.indexed = False
+            except Exception:
+                logger.error(f"Error cleaning up {f.filename}", exc_info=True)
+        return
+
+    for f in uploaded:
+        if f.file_id not in duplicates:
+            f.status = "succeeded"
+            continue
+        # Another worker saved the same content first; its file_id is the result
+        try:
+            await _discard_copy(f.file_id, f.filename)
+            f.indexed = False
+        except Exception:
+            logger.error(f"Error cleaning up {f.filename}", exc_info=True)
+        _release_hash(f.content_hash, f.file_id)
+        f.file_id = duplicates[f.file_id]
+        f.status = "duplicate"
+
+async def _bulk_write(embedded: asyncio.Queue):
+    """Write embedded documents in batches of up to BULK_WRITE_DOCS"""
+    done = False
+    while not done:
+        item = await embedded.get()
+        if item is None:
+            break
+        batch = list(item)
+        # Take whatever else is ready so one write covers as many documents as possible
+        while len(batch) < settings.BULK_WRITE_DOCS:
+            try:
+                item = embedded.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if item is None:
+                done = True
+                break
+            batch.extend(item)
+        await _bulk_write_batch(batch)
+
+async def _run_bulk_job(job: BulkIngestionJob):
+    """
+    Run a bulk upload as a pipeline: extraction, embedding and writes of
+    different documents overlap, each stage under its concurrency limit
+
+    Only queued files are processed, so a job taken over from a stopped
+    worker skips the files that worker finished. If this worker shuts down
+    meanwhile, the spool files are kept so the job runs again after a restart.
+    """
+    job.status = "running"
+    job.started_at = datetime.utcnow()
+    files = [f for f in job.files if f.status == "queued"]
+    try:
+        # Bounded queues between stages keep a slow stage from piling up work in memory
+        extracted: asyncio.Queue = asyncio.Queue(maxsize=settings.INGEST_EXTRACT_CONCURRENCY * 2)
+        embedded: asyncio.Queue = asyncio.Queue(maxsize=settings.INGEST_EMBED_CONCURRENCY * 2)
+
+        stages = [
+            asyncio.create_task(_bulk_extract_all(files, extracted)),
+            asyncio.create_task(_bulk_embed(extracted, embedded)),
+            asyncio.create_task(_bulk_write(embedded)),
+        ]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            # A failed stage would leave the others waiting on its queue forever
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+
+    except Exception as e:
+        logger.error(f"Error running bulk job {job.job_id}", exc_info=True)
+        job.error = str(e)
+        for f in files:
+            if f.status not in ("succeeded", "duplicate", "failed"):
+                f.fail(e)
+
+    except asyncio.CancelledError:
+        for f in files:
+            if f.upload is not None:
+                f.upload.cancel()
+            _release_hash(f.content_hash, f.file_id)
+        raise
+
+    for f in files:
+        if f.status in ("succeeded", "duplicate"):
+            continue
+        try:
+            # Files that failed before their write still finish uploading; remove them again
+            if f.upload is not None and await _uploaded(f.upload):
+                await delete_file(f.file_id, f.filename)
+            # E.g. indexed before another stage failed and the write was cancelled
+            if f.indexed:
+                await delete_document_from_vectordb(f.file_id)
+        except Exception:
+            logger.error(f"Error cleaning up {f.filename}", exc_info=True)
+    job.finished_at = datetime.utcnow()
+    for f in files:
+        _remove_spool(f.spool_path)
+        _release_hash(f.content_hash, f.file_id)
+
+    succeeded = sum(1 for f in files if f.status == "succeeded")
+    duplicates = sum(1 for f in files if f.status == "duplicate")
+    DOCUMENTS_INGESTED.labels("succeeded").inc(succeeded)
+    DOCUMENTS_INGESTED.labels("duplicate").inc(duplicates)
+    DOCUMENTS_INGESTED.labels("failed").inc(len(files) - succeeded - duplicates)
+    _finish_bulk_status(job)
+    logger.info(
+        f"Bulk job {job.job_id}: {succeeded}/{len(files)} documents ingested, "
+        f"{job.documents_per_minute()} documents/minute"
+    )
+
+def _finish_bulk_status(job: BulkIngestionJob):
+    """Overall status from the files that were to be ingested (not skipped or duplicates)"""
+    files = [f for f in job.files if f.status not in ("skipped", "duplicate")]
+    succeeded = sum(1 for f in files if f.status == "succeeded")
+    job.status = "succeeded" if succeeded == len(files) else "failed" if not succeeded else "partially_succeeded"
+
+def _json_default(value):
+    # Datetimes are the only values in a job's progress JSON doesn't handle
+    return value.isoformat()
+
+def _job_files(job: Union[IngestionJob, BulkIngestionJob]) -> List[Union[IngestionJob, BulkFile]]:
+    """The documents of a job: the job itself for a single document"""
+    return job.files if isinstance(job, BulkIngestionJob) else [job]
+
+def _job_values(job: Union[IngestionJob, BulkIngestionJob]) -> Dict:
+    """Column values of a job's row for its current progress"""
+    stage = None
+    if isinstance(job, IngestionJob):
+        stage = next((name for name, s in job.stages.items() if s["status"] == "running"), None)
+    state = {
+        "files": [
+            {
+                "file_id": f.file_id,
+                "filename": f.filename,
+                "file_size": f.file_size,
+                "spool_path": f.spool_path,
+                "content_hash": f.content_hash,
+                "status": f.status,
+                "chunks": f.chunks,
+                "error": f.error,
+            }
+            for f in _job_files(job)
+        ]
+    }
+    return {
+        "status": job.status,
+        "stage": stage,
+        "error": job.error,
+        "worker": _worker_id,
+        "progress": json.dumps(job.to_dict(), default=_json_default),
+        "state": json.dumps(state),
+        "updated_at": datetime.utcnow(),
+        "finished_at": job.finished_at,
+    }
+
+async def _insert_job(job: Union[IngestionJob, BulkIngestionJob]):
+    async with _save_lock, SessionLocal() as db_session:
+        db_session.add(IngestionJobRecord(
+            job_id=job.job_id,
+            job_type="bulk" if isinstance(job, BulkIngestionJob) else "document",
+            created_at=job.created_at,
+            **_job_values(job)
+        ))
+        await db_session.commit()
+
+async def _delete_job(job_id: str):
+    async with SessionLocal() as db_session:
+        await db_session.execute(delete(IngestionJobRecord).where(IngestionJobRecord.job_id == job_id))
+        await db_session.commit()
+
+async def _save_jobs(jobs: List[Union[IngestionJob, BulkIngestionJob]]):
+    """Write the current progress of jobs to their rows in one transaction"""
+    if not jobs:
+        return
+    async with _save_lock, SessionLocal() as db_session:
+        for job in jobs:
+            await db_session.execute(
+                update(IngestionJobRecord)
+                .where(IngestionJobRecord.job_id == job.job_id)
+                .values(**_job_values(job))
+            )
+        await db_session.commit()
+
+async def _worker():
+    while True:
+        job = await _queue.get()
+        try:
+            if isinstance(job, BulkIngestionJob):
+                await _run_bulk_job(job)
+            else:
+                await _run_job(job)
+            await _save_jobs([job])
+        except Exception:
+            # The row is refreshed again by the next heartbeat
+            logger.error(f"Error saving job {job.job_id}", exc_info=True)
+        finally:
+            _queue.task_done()
+
+def _spool_exists(path: Optional[str]) -> bool:
+    return bool(path) and os.path.exists(path)
+
+async def _claim_job(record: IngestionJobRecord) -> bool:
+    """Take over a stale job; False if another worker took it first"""
+    async with SessionLocal() as db_session:
+        result = await db_session.execute(
+            update(IngestionJobRecord)
+            .where(
+                IngestionJobRecord.job_id == record.job_id,
+                IngestionJobRecord.finished_at.is_(None),
+                IngestionJobRecord.updated_at == record.updated_at,
+            )
+            .values(worker=_worker_id, updated_at=datetime.utcnow())
+        )
+        await db_session.commit()
+    return result.rowcount == 1
+
+def _restore_job(record: IngestionJobRecord) -> Union[IngestionJob, BulkIngestionJob]:
+    """Rebuild a job from its row"""
+    state = json.loads(record.state)
+    progress = json.loads(record.progress)
+    if record.job_type == "bulk":
+        files = []
+        for file_state in state["files"]:
+            f = BulkFile(file_state["filename"], file_state["file_size"], file_state["spool_path"])
+            f.file_id = file_state["file_id"]
+            f.content_hash = file_state["content_hash"]
+            f.status = file_state["status"]
+            f.chunks = file_state["chunks"]
+            f.error = file_state["error"]
+            files.append(f)
+        job = BulkIngestionJob(files)
+    else:
+        file_state = state["files"][0]
+        job = IngestionJob(
+            file_state["file_id"], file_state["filename"], file_state["file_size"],
+            file_state["spool_path"], file_state["content_hash"]
+        )
+        job.chunks = file_state["chunks"]
+        job.stages = progress["stages"]
+    job.job_id = record.job_id
+    job.created_at = record.created_at
+    return job
+
+async def _recover_job(record: IngestionJobRecord):
+    """
+    Finish or requeue a job whose worker stopped
+
+    A document whose metadata was saved succeeded. Any other unfinished
+    document has its partly written vectors removed and, if its spool file
+    is still there, is queued again; otherwise it failed.
+    """
+    job = _restore_job(record)
+    files = [
+        f for f in _job_files(job)
+        if f.status not in ("succeeded", "failed", "skipped", "duplicate")
+    ]
+    async with SessionLocal() as db_session:
+        result = await db_session.execute(
+            select(FileMetadata.file_id).where(FileMetadata.file_id.in_([f.file_id for f in files]))
+        )
+        stored = set(result.scalars())
+
+    requeued = []
+    for f in files:
+        if f.file_id in stored:
+            f.status = "succeeded"
+            _remove_spool(f.spool_path)
+            continue
+        await delete_document_from_vectordb(f.file_id)
+        if _spool_exists(f.spool_path):
+            # The upload is simply stored again under the same name
+            f.status = "queued"
+            f.error = None
+            f.chunks = 0
+            requeued.append(f)
+            continue
+        f.status = "failed"
+        f.error = "Xử lý tài liệu bị gián đoạn và file tạm không còn"
+        try:
+            await delete_file(f.file_id, f.filename)
+        except Exception:
+            logger.error(f"Error cleaning up {f.filename}", exc_info=True)
+
+    if requeued:
+        if isinstance(job, IngestionJob):
+            job.stages = {stage: {"status": "pending", "duration_ms": None} for stage in STAGES}
+        job.status = "queued"
+        try:
+            _queue.put_nowait(job)
+        except asyncio.QueueFull:
+            # Left stale, so it is taken over again once the queue has room
+            logger.warning(f"Queue full, job {job.job_id} is recovered later")
+            return
+        for f in requeued:
+            _content_hashes[f.content_hash] = f.file_id
+        logger.info(f"Requeued job {job.job_id} ({len(requeued)} documents) from worker {record.worker}")
+    else:
+        if isinstance(job, BulkIngestionJob):
+            _finish_bulk_status(job)
+        else:
+            for stage in job.stages.values():
+                if stage["status"] == "running":
+                    stage["status"] = "done" if job.status == "succeeded" else "failed"
+        job.finished_at = datetime.utcnow()
+        logger.info(f"Finished job {job.job_id} from worker {record.worker} as {job.status}")
+
+    _jobs[job.job_id] = job
+    _forget_old_jobs()
+    await _save_jobs([job])
+
+async def _recover_stale_jobs():
+    """Take over unfinished jobs whose worker stopped refreshing them"""
+    cutoff = datetime.utcnow() - timedelta(seconds=settings.INGEST_JOB_STALE_AFTER)
+    async with SessionLocal() as db_session:
+        result = await db_session.execute(
+            select(IngestionJobRecord)
+            .where(IngestionJobRecord.finished_at.is_(None), IngestionJobRecord.updated_at < cutoff)
+            .order_by(IngestionJobRecord.created_at)
+        )
+        records = result.scalars().all()
+
+    for record in records:
+        if _queue.full():
+            break
+        if not await _claim_job(record):
+            continue
+        try:
+            await _recover_job(record)
+        except Exception:
+            # Goes stale again and is retried
+            logger.error(f"Error recovering job {record.job_id}", exc_info=True)
+
+def _remove_orphan_spool(referenced: Set[str], cutoff: float) -> int:
+    removed = 0
+    for entry in os.scandir(settings.UPLOAD_SPOOL_PATH):
+        # Recent files may belong to an upload still being spooled
+        if entry.is_file() and entry.name not in referenced and entry.stat().st_mtime < cutoff:
+            _remove_spool(entry.path)
+            removed += 1
+    return removed
+
+async def _clean_spool():
+    """Remove spool files left behind by stopped workers that no unfinished job refers to"""
+    cutoff = time.time() - settings.INGEST_JOB_STALE_AFTER
+    async with SessionLocal() as db_session:
+        result = await db_session.execute(
+            select(IngestionJobRecord.state).where(IngestionJobRecord.finished_at.is_(None))
+        )
+        states = [json.loads(state) for state in result.scalars()]
+    referenced = {
+        os.path.basename(f["spool_path"])
+        for state in states for f in state["files"] if f["spool_path"]
+    }
+    # Also jobs whose row is being written
+    referenced.update(
+        os.path.basename(f.spool_path)
+        for job in list(_jobs.values()) for f in _job_files(job) if f.spool_path
+    )
+    removed = await asyncio.to_thread(_remove_orphan_spool, referenced, cutoff)
+    if removed:
+        logger.info(f"Removed {removed} leftover spool files")
+
+async def _forget_old_job_rows():
+    """Delete the oldest finished job rows beyond INGEST_JOB_HISTORY"""
+    async with SessionLocal() as db_session:
+        result = await db_session.execute(
+            select(IngestionJobRecord.finished_at)
+            .where(IngestionJobRecord.finished_at.is_not(None))
+            .order_by(IngestionJobRecord.finished_at.desc())
+            .offset(max(settings.INGEST_JOB_HISTORY - 1, 0))
+            .limit(1)
+        )
+        oldest_kept = result.scalar()
+        if oldest_kept is not None:
+            await db_session.execute(
+                delete(IngestionJobRecord).where(IngestionJobRecord.finished_at < oldest_kept)
+            )
+            await db_session.commit()
+
+async def _maintain_jobs():
+    """
+    Every INGEST_JOB_HEARTBEAT seconds, refresh the rows of this worker's
+    unfinished jobs, take over stale jobs of stopped workers, remove
+    leftover spool files and trim the job history
+    """
+    while True:
+        for step in (
+            lambda: _save_jobs([job for job in _jobs.values() if job.finished_at is None]),
+            _recover_stale_jobs,
+            _clean_spool,
+            _forget_old_job_rows,
+        ):
+            try:
+                await step()
+            except Exception:
+                logger.error("Error maintaining ingestion jobs", exc_info=True)
+        await asyncio.sleep(settings.INGEST_JOB_HEARTBEAT)
+
+def _ensure_workers():
+    """Start the worker pool and job maintenance on the running event loop the first time it's needed"""
+    global _queue, _maintenance
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=settings.INGEST_QUEUE_SIZE)
+    if not _workers:
+        _workers.extend(asyncio.create_task(_worker()) for _ in range(settings.INGEST_WORKERS))
+    if _maintenance is None:
+        _maintenance = asyncio.create_task(_maintain_jobs())
+
+def start_workers():
+    """Start ingestion at startup, so jobs interrupted by a restart are picked up without waiting for an upload"""
+    _ensure_workers()
+
+async def shutdown_workers():
+    """
+    Stop the workers; jobs they were running keep their spool files and
+    unfinished rows, so they run again once stale
+    """
+    global _maintenance
+    tasks = list(_workers)
+    if _maintenance is not None:
+        tasks.append(_maintenance)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _workers.clear()
+    _maintenance = None
+
+def _forget_old_jobs():
+    """Drop the oldest finished jobs beyond INGEST_JOB_HISTORY"""
+    excess = len(_jobs) - settings.INGEST_JOB_HISTORY
+    for job_id in [job_id for job_id, job in _jobs.items() if job.finished_at][:max(excess, 0)]:
+        del _jobs[job_id]
+
+async def submit_document(file_content: bytes, filename: str) -> IngestionJob:
+    """
+    Spool an uploaded file and queue it for ingestion
+
+    Args:
+        file_content: Binary content of the file
+        filename: Original filename
+
+    Returns:
+        The queued job, or a finished job with status "duplicate" and the
+        existing file_id when the same content was already uploaded
+
+    Raises:
+        QueueFullError: If INGEST_QUEUE_SIZE jobs are already waiting
+    """
+    _ensure_workers()
+    if _queue.full():
+        raise QueueFullError("Hàng đợi xử lý tài liệu đã đầy, vui lòng thử lại sau")
+
+    content_hash = await asyncio.to_thread(_hash_content, file_content)
+    existing = (await _find_existing([content_hash])).get(content_hash)
+    if existing:
+        job = IngestionJob(existing, filename, len(file_content), None, content_hash)
+        job.status = "duplicate"
+        job.finished_at = datetime.utcnow()
+        for stage in job.stages.values():
+            stage["status"] = "skipped"
+        await _insert_job(job)
+        _jobs[job.job_id] = job
+        _forget_old_jobs()
+        DOCUMENTS_INGESTED.labels("duplicate").inc()
+        logger.info(f"{filename} is a duplicate of {existing}")
+        return job
+
+    file_id = str(uuid.uuid4())
+    _content_hashes[content_hash] = file_id
+    _, file_ext = os.path.splitext(filename)
+    spool_path = os.path.join(settings.UPLOAD_SPOOL_PATH, f"{file_id}{file_ext.lower()}")
+    try:
+        await asyncio.to_thread(_write_spool, spool_path, file_content)
+    except Exception:
+        _release_hash(content_hash, file_id)
+        raise
+
+    job = IngestionJob(file_id, filename, len(file_content), spool_path, content_hash)
+    try:
+        await _insert_job(job)
+    except Exception:
+        _remove_spool(spool_path)
+        _release_hash(content_hash, file_id)
+        raise
+    try:
+        _queue.put_nowait(job)
+    except asyncio.QueueFull:
+        # Filled up by concurrent uploads while the file was being spooled
+        os.remove(spool_path)
+        _release_hash(content_hash, file_id)
+        await _delete_job(job.job_id)
+        raise QueueFullError("Hàng đợi xử lý tài liệu đã đầy, vui lòng thử lại sau")
+
+    _jobs[job.job_id] = job
+    _forget_old_jobs()
+    return job
+
+def _copy_to_spool(source: BinaryIO, path: str, limit: int) -> Tuple[int, str]:
+    """
+    Copy a file object to the spool, stopping just past limit bytes
+
+    Returns:
+        (bytes copied, SHA-256 of the copied content)
+    """
+    copied = 0
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        while copied <= limit:
+            block = source.read(1024 * 1024)
+            if not block:
+                break
+            f.write(block)
+            digest.update(block)
+            copied += len(block)
+    return copied, digest.hexdigest()
+
+def _spool_upload(filename: str, source: BinaryIO, files: List[BulkFile], in_archive: bool = False):
+    """Spool one uploaded file, expanding ZIP archives (not nested ones) into their documents"""
+    _, file_ext = os.path.splitext(filename)
+    file_ext = file_ext.lower()
+
+    if file_ext == ".zip" and not in_archive:
+        archive_path = os.path.join(settings.UPLOAD_SPOOL_PATH, f"{uuid.uuid4()}.zip")
+        try:
+            with open(archive_path, "wb") as f:
+                shutil.copyfileobj(source, f)
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    name = info.filename
+                    if info.is_dir() or name.startswith("__MACOSX/") or os.path.basename(name).startswith("."):
+                        continue
+                    # Sizes come from the archive directory, so oversized entries are skipped unread
+                    if info.file_size > settings.MAX_FILE_SIZE:
+                        files.append(BulkFile(name, info.file_size, error="File quá lớn"))
+                        continue
+                    with archive.open(info) as entry:
+                        _spool_upload(name, entry, files, in_archive=True)
+        except zipfile.BadZipFile as e:
+            files.append(BulkFile(filename, error=f"File ZIP không hợp lệ: {str(e)}"))
+        finally:
+            _remove_spool(archive_path)
+        return
+
+    if file_ext not in settings.ALLOWED_EXTENSIONS:
+        files.append(BulkFile(filename, error=f"Không hỗ trợ định dạng file {file_ext}"))
+        return
+    if sum(1 for f in files if f.status == "queued") >= settings.BULK_MAX_FILES:
+        files.append(BulkFile(filename, error=f"Vượt quá {settings.BULK_MAX_FILES} file mỗi lần tải lên"))
+        return
+
+    bulk_file = BulkFile(filename)
+    bulk_file.spool_path = os.path.join(settings.UPLOAD_SPOOL_PATH, f"{bulk_file.file_id}{file_ext}")
+    bulk_file.file_size, bulk_file.content_hash = _copy_to_spool(source, bulk_file.spool_path, settings.MAX_FILE_SIZE)
+    if bulk_file.file_size > settings.MAX_FILE_SIZE:
+        _remove_spool(bulk_file.spool_path)
+        bulk_file.status = "skipped"
+        bulk_file.error = "File quá lớn"
+    files.append(bulk_file)
+
+def _spool_uploads(uploads: List[Tuple[str, BinaryIO]]) -> List[BulkFile]:
+    files: List[BulkFile] = []
+    for filename, source in uploads:
+        _spool_upload(filename, source, files)
+    return files
+
+async def submit_bulk(uploads: List[Tuple[str, BinaryIO]]) -> BulkIngestionJob:
+    """
+    Spool several uploaded files (or ZIP archives of them) and queue them as one bulk job
+
+    Unsupported, oversized or excess files are recorded as skipped rather
+    than failing the whole upload. Files whose content was already uploaded
+    (or appears earlier in the same upload) are recorded as duplicates of
+    the existing file_id.
+
+    Args:
+        uploads: (filename, file object) for each uploaded file
+
+    Returns:
+        The queued job
+
+    Raises:
+        QueueFullError: If INGEST_QUEUE_SIZE jobs are already waiting
+    """
+    _ensure_workers()
+    if _queue.full():
+        raise QueueFullError("Hàng đợi xử lý tài liệu đã đầy, vui lòng thử lại sau")
+
+    files = await asyncio.to_thread(_spool_uploads, uploads)
+    queued = [f for f in files if f.status == "queued"]
+    existing = await _find_existing(list({f.content_hash for f in queued}))
+    for f in queued:
+        if f.content_hash in existing:
+            f.status = "duplicate"
+            f.file_id = existing[f.content_hash]
+            _remove_spool(f.spool_path)
+        else:
+            existing[f.content_hash] = _content_hashes[f.content_hash] = f.file_id
+
+    job = BulkIngestionJob(files)
+
+    def discard():
+        for f in files:
+            if f.spool_path:
+                _remove_spool(f.spool_path)
+            _release_hash(f.content_hash, f.file_id)
+
+    try:
+        await _insert_job(job)
+    except Exception:
+        discard()
+        raise
+    try:
+        _queue.put_nowait(job)
+    except asyncio.QueueFull:
+        discard()
+        await _delete_job(job.job_id)
+        raise QueueFullError("Hàng đợi xử lý tài liệu đã đầy, vui lòng thử lại sau")
+    DOCUMENTS_INGESTED.labels("duplicate").inc(sum(1 for f in files if f.status == "duplicate"))
+
+    _jobs[job.job_id] = job
+    _forget_old_jobs()
+    return job
+
+async def get_job(job_id: str) -> Optional[Dict]:
+    """
+    Progress of a job by ID
+
+    Jobs run by this worker are reported as they are; those of other
+    workers as of their last heartbeat, from the database.
+    """
+    job = _jobs.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    async with SessionLocal() as db_session:
+        record = await db_session.get(IngestionJobRecord, job_id)
+    return json.loads(record.progress) if record else None
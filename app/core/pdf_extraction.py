@@ -0,0 +1,82 @@
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+import fitz  # PyMuPDF
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Text and extraction time in milliseconds of one page
+PageResult = Tuple[str, float]
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Create the PDF worker processes the first time they're needed"""
+    global _pool
+    if _pool is None:
+        # spawn: the server process has threads, which don't survive a fork safely
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.PDF_WORKERS or None,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+def shutdown_pool():
+    """Stop the PDF worker processes"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+def count_pages(file_content: bytes) -> int:
+    """Number of pages in a PDF"""
+    with fitz.open(stream=file_content, filetype="pdf") as doc:
+        return doc.page_count
+
+def extract_pages(file_content: bytes, start: int, end: int) -> List[PageResult]:
+    """Extract pages [start, end) of a PDF, timing each page (runs in a worker process)"""
+    results = []
+    with fitz.open(stream=file_content, filetype="pdf") as doc:
+        for page_number in range(start, end):
+            started = time.perf_counter()
+            text = doc[page_number].get_text()
+            results.append((text, (time.perf_counter() - started) * 1000))
+    return results
+
+async def extract_pdf(file_content: bytes) -> List[PageResult]:
+    """
+    Extract every page of a PDF in the process pool
+
+    Documents longer than PDF_PAGES_PER_TASK pages are split into page
+    ranges that are extracted in parallel.
+
+    Args:
+        file_content: Binary content of the PDF
+
+    Returns:
+        (text, milliseconds) for each page, in page order
+    """
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    page_count = await loop.run_in_executor(pool, count_pages, file_content)
+
+    step = max(settings.PDF_PAGES_PER_TASK, 1)
+    ranges = [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    parts = await asyncio.gather(*(
+        loop.run_in_executor(pool, extract_pages, file_content, start, end)
+        for start, end in ranges
+    ))
+
+    pages = [page for part in parts for page in part]
+    for page_number, (_, elapsed_ms) in enumerate(pages):
+        if elapsed_ms > settings.PDF_SLOW_PAGE_MS:
+            logger.warning(f"Slow PDF page {page_number + 1}: {elapsed_ms:.0f} ms")
+    logger.info(
+        f"Extracted {page_count} PDF pages in {len(ranges)} tasks, "
+        f"{sum(elapsed_ms for _, elapsed_ms in pages):.0f} ms of page time"
+    )
+    return pages
@@ -1,30 +1,203 @@
-import openai
-import os
-import httpx
-from typing import List, Dict
+import time
+from typing import AsyncIterator, List, Dict, Optional, Set, Tuple
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from app.config import settings
+from app.core.answer_cache import answer_cache
+from app.core.document_processor import tokenizer
+from app.core.embedding import get_client
 from app.utils.logger import get_logger
+from app.utils.metrics import CONTEXT_TOKENS, CONTEXT_TOKENS_SAVED, TOKENS, observe_stage, register_callback, stage_timer
 
 logger = get_logger(__name__)
 
-# Xóa các biến môi trường proxy nếu có
-if 'http_proxy' in os.environ:
-    del os.environ['http_proxy']
-if 'https_proxy' in os.environ:
-    del os.environ['https_proxy']
-if 'HTTP_PROXY' in os.environ:
-    del os.environ['HTTP_PROXY']
-if 'HTTPS_PROXY' in os.environ:
-    del os.environ['HTTPS_PROXY']
+SYSTEM_MESSAGE = """
+        Bạn là trợ lý AI chuyên trả lời câu hỏi dựa trên thông tin từ tài liệu. 
+        Hãy trả lời dựa trên ngữ cảnh được cung cấp.
+        Nếu câu trả lời không có trong ngữ cảnh, hãy trung thực nói rằng bạn không có thông tin.
+        Không được tự tạo ra thông tin hay suy diễn quá xa những gì có trong ngữ cảnh.
+        Trả lời đầy đủ thông tin, dễ hiểu.
+        """
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+# Characters of a chunk's start looked up in the previous chunk to find their overlap
+OVERLAP_PROBE_CHARS = 32
+
+# Token n-grams compared to detect near-duplicate passages
+SHINGLE_SIZE = 3
+
+def _overlap_length(previous: str, following: str) -> int:
+    """Length of the longest suffix of previous that is also a prefix of following"""
+    probe = following[:OVERLAP_PROBE_CHARS]
+    if not probe:
+        return 0
+    pos = previous.find(probe, max(len(previous) - len(following), 0))
+    while pos != -1:
+        if following.startswith(previous[pos:]):
+            return len(previous) - pos
+        pos = previous.find(probe, pos + 1)
+    return 0
+
+def _merge_adjacent(context_chunks: List[Dict[str, str]]) -> Tuple[List[Dict], int]:
+    """
+    Join retrieved chunks that are consecutive in the same document
+    
+    The overlapping text the chunker repeats at the start of each chunk is
+    kept once. Passages keep the rank of their best chunk.
+    
+    Returns:
+        (passages with "content", "metadata" and "rank", in rank order;
+        number of chunks merged into a previous one)
+    """
+    def position(chunk: Dict) -> Tuple[Optional[str], Optional[int]]:
+        metadata = chunk.get("metadata") or {}
+        document = metadata.get("doc_id") or metadata.get("source") or metadata.get("filename")
+        return document, metadata.get("chunk")
+    
+    order = sorted(
+        range(len(context_chunks)),
+        key=lambda i: (str(position(context_chunks[i])[0]), position(context_chunks[i])[1] or 0, i)
+    )
+    passages: List[Dict] = []
+    merged = 0
+    last = None
+    for i in order:
+        chunk = context_chunks[i]
+        document, number = position(chunk)
+        if (
+            last is not None and document is not None and number is not None
+            and last == (document, number - 1)
+        ):
+            passage = passages[-1]
+            passage["content"] += chunk["content"][_overlap_length(passage["content"], chunk["content"]):]
+            passage["rank"] = min(passage["rank"], i)
+            merged += 1
+        elif last is not None and last == (document, number) and number is not None:
+            # The same chunk retrieved twice
+            merged += 1
+            continue
+        else:
+            passages.append({"content": chunk["content"], "metadata": chunk.get("metadata"), "rank": i})
+        last = (document, number)
+    
+    passages.sort(key=lambda passage: passage["rank"])
+    return passages, merged
+
+def _shingles(tokens: List[int]) -> Set[Tuple[int, ...]]:
+    if len(tokens) < SHINGLE_SIZE:
+        return {tuple(tokens)}
+    return {tuple(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+
+def build_context(
+    context_chunks: List[Dict[str, str]],
+    max_tokens: Optional[int] = None
+) -> Tuple[str, Dict[str, int]]:
+    """
+    Assemble the prompt context from retrieved chunks within a token budget
+    
+    Consecutive chunks of a document are merged without their overlap,
+    passages nearly identical to a more relevant one are dropped, and the
+    rest are added in relevance order while they fit in the budget (the
+    most relevant passage is cut to fit if it's too long on its own).
+    
+    Args:
+        context_chunks: Retrieved chunks, most relevant first
+        max_tokens: Token budget for the context (default QA_CONTEXT_TOKENS)
+    
+    Returns:
+        (context text, token statistics: raw_tokens for the chunks joined
+        as they are, context_tokens, tokens_saved, merged, duplicates, dropped)
+    """
+    if max_tokens is None:
+        max_tokens = settings.QA_CONTEXT_TOKENS
+    separator_tokens = len(tokenizer.encode_ordinary(CONTEXT_SEPARATOR))
+    raw_tokens = sum(len(tokenizer.encode_ordinary(chunk["content"])) for chunk in context_chunks)
+    raw_tokens += separator_tokens * max(len(context_chunks) - 1, 0)
+    
+    passages, merged = _merge_adjacent(context_chunks)
+    
+    kept: List[str] = []
+    kept_shingles: List[Set[Tuple[int, ...]]] = []
+    used = 0
+    duplicates = 0
+    dropped = 0
+    for passage in passages:
+        tokens = tokenizer.encode_ordinary(passage["content"])
+        shingles = _shingles(tokens)
+        if any(
+            len(shingles & other) / len(shingles | other) >= settings.QA_CONTEXT_DUPLICATE_THRESHOLD
+            for other in kept_shingles
+        ):
+            duplicates += 1
+            continue
+        
+        cost = len(tokens) + (separator_tokens if kept else 0)
+        if used + cost > max_tokens:
+            if kept or max_tokens <= 0:
+                dropped += 1
+                continue
+            tokens = tokens[:max_tokens]
+            passage["content"] = tokenizer.decode(tokens)
+            cost = len(tokens)
+        kept.append(passage["content"])
+        kept_shingles.append(shingles)
+        used += cost
+    
+    stats = {
+        "raw_tokens": raw_tokens,
+        "context_tokens": used,
+        "tokens_saved": raw_tokens - used,
+        "merged": merged,
+        "duplicates": duplicates,
+        "dropped": dropped,
+    }
+    return CONTEXT_SEPARATOR.join(kept), stats
+
+def build_messages(question: str, context_chunks: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Build the chat messages for a question and its context chunks"""
+    # Format context for the prompt
+    with stage_timer("context"):
+        formatted_context, stats = build_context(context_chunks)
+    CONTEXT_TOKENS.inc(stats["context_tokens"])
+    CONTEXT_TOKENS_SAVED.inc(stats["tokens_saved"])
+    logger.info(
+        f"Context: {stats['context_tokens']}/{stats['raw_tokens']} tokens, saved {stats['tokens_saved']} "
+        f"({stats['merged']} chunks merged, {stats['duplicates']} duplicates, {stats['dropped']} over budget)"
+    )
+    
+    user_message = f"""
+        Câu hỏi: {question}
+        
+        Ngữ cảnh:
+        {formatted_context}
+        """
+    
+    return [
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {"role": "user", "content": user_message}
+    ]
 
-# Tạo HTTP client không có proxy
-http_client = httpx.Client()
+def _answer_cache_metrics():
+    """Answer cache counters, read from the cache when /metrics is scraped"""
+    stats = answer_cache.stats()
+    lookups = CounterMetricFamily("chatbot_answer_cache_lookups", "Answer cache lookups by result", labels=["result"])
+    lookups.add_metric(["hit"], stats["hits"])
+    lookups.add_metric(["miss"], stats["misses"])
+    yield lookups
+    yield GaugeMetricFamily("chatbot_answer_cache_hit_ratio", "Share of answer cache lookups that hit", value=stats["hit_rate"])
+    yield GaugeMetricFamily("chatbot_answer_cache_items", "Answers held by the answer cache", value=stats["items"])
+    removed = CounterMetricFamily("chatbot_answer_cache_removals", "Answers dropped from the answer cache by reason", labels=["reason"])
+    removed.add_metric(["expired"], stats["expirations"])
+    removed.add_metric(["evicted"], stats["evictions"])
+    removed.add_metric(["invalidated"], stats["invalidations"])
+    yield removed
 
-# Tạo client OpenAI sử dụng HTTP client tùy chỉnh
-client = openai.OpenAI(
-    api_key=settings.OPENAI_API_KEY,
-    http_client=http_client
-)
+register_callback(_answer_cache_metrics)
+
+def _count_usage(usage):
+    if usage:
+        TOKENS.labels("prompt").inc(usage.prompt_tokens)
+        TOKENS.labels("completion").inc(usage.completion_tokens)
 
 async def get_answer(question: str, context_chunks: List[Dict[str, str]], max_tokens: int = 1000) -> str:
     """
@@ -39,39 +212,69 @@ async def get_answer(question: str, context_chunks: List[Dict[str, str]], max_to
         Answer text
     """
     try:
-        # Format context for the prompt
-        formatted_context = "\n\n---\n\n".join([chunk["content"] for chunk in context_chunks])
+        # Uses the shared async client, so the event loop isn't blocked while the model answers
+        messages = build_messages(question, context_chunks)
+        with stage_timer("completion"):
+            response = await get_client().chat.completions.create(
+                model=settings.QA_MODEL,
+                messages=messages,
+                temperature=1.0,
+                max_completion_tokens=max_tokens,  # Changed from max_tokens to max_completion_tokens
+            )
+        _count_usage(response.usage)
         
-        # Create system and user messages
-        system_message = """
-        Bạn là trợ lý AI chuyên trả lời câu hỏi dựa trên thông tin từ tài liệu. 
-        Hãy trả lời dựa trên ngữ cảnh được cung cấp.
-        Nếu câu trả lời không có trong ngữ cảnh, hãy trung thực nói rằng bạn không có thông tin.
-        Không được tự tạo ra thông tin hay suy diễn quá xa những gì có trong ngữ cảnh.
-        Trả lời đầy đủ thông tin, dễ hiểu.
-        """
-        
-        user_message = f"""
-        Câu hỏi: {question}
-        
-        Ngữ cảnh:
-        {formatted_context}
-        """
+        return response.choices[0].message.content.strip()
+    
+    except Exception as e:
+        logger.error(f"Error getting answer from OpenAI: {str(e)}")
+        raise Exception(f"Lỗi khi lấy câu trả lời: {str(e)}")
+
+async def stream_answer(
+    question: str,
+    context_chunks: List[Dict[str, str]],
+    max_tokens: int = 1000
+) -> AsyncIterator[str]:
+    """
+    Generate an answer like get_answer, yielding text deltas as the model produces them
+    
+    Args:
+        question: User's question
+        context_chunks: List of relevant text chunks
+        max_tokens: Maximum tokens for the response
         
-        # Call OpenAI API - using client instead of openai global
-        # Remove await since client.chat.completions.create is not async
-        response = client.chat.completions.create(
+    Yields:
+        Pieces of the answer text, in order
+    """
+    try:
+        messages = build_messages(question, context_chunks)
+        started = time.perf_counter()
+        first_token = True
+        stream = await get_client().chat.completions.create(
             model=settings.QA_MODEL,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
+            messages=messages,
             temperature=1.0,
-            max_completion_tokens=max_tokens,  # Changed from max_tokens to max_completion_tokens
+            max_completion_tokens=max_tokens,
+            stream=True,
+            # The last chunk then carries the token usage (and no choices)
+            stream_options={"include_usage": True},
         )
         
-        return response.choices[0].message.content.strip()
+        async for chunk in stream:
+            if chunk.usage:
+                _count_usage(chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if first_token:
+                elapsed = time.perf_counter() - started
+                observe_stage("completion_first_token", elapsed)
+                logger.info(f"First answer token after {elapsed * 1000:.0f} ms")
+                first_token = False
+            yield delta
+        observe_stage("completion", time.perf_counter() - started)
     
     except Exception as e:
-        logger.error(f"Error getting answer from OpenAI: {str(e)}")
+        logger.error(f"Error streaming answer from OpenAI: {str(e)}")
         raise Exception(f"Lỗi khi lấy câu trả lời: {str(e)}")
@@ -1,104 +1,162 @@
 import os
 import json
-import firebase_admin
-from firebase_admin import credentials, storage
+import shutil
+import asyncio
+import threading
+from pathlib import Path
 from app.config import settings
 from app.utils.logger import get_logger
+from app.utils.metrics import stage_timer
 
 logger = get_logger(__name__)
 
-# Initialize Firebase
-try:
-    # If FIREBASE_CREDENTIALS is a JSON string, parse it
-    if settings.FIREBASE_CREDENTIALS and settings.FIREBASE_CREDENTIALS.startswith('{'):
-        cred_dict = json.loads(settings.FIREBASE_CREDENTIALS)
-        cred = credentials.Certificate(cred_dict)
-    # If it's a file path, load it
-    elif settings.FIREBASE_CREDENTIALS and os.path.exists(settings.FIREBASE_CREDENTIALS):
-        cred = credentials.Certificate(settings.FIREBASE_CREDENTIALS)
-    else:
-        logger.warning("Firebase credentials not provided. Firebase storage won't be available.")
-        firebase_app = None
-
-    if 'cred' in locals():
-        firebase_app = firebase_admin.initialize_app(cred, {
-            'storageBucket': settings.FIREBASE_BUCKET
-        })
-    
-except Exception as e:
-    logger.error(f"Failed to initialize Firebase: {e}")
-    firebase_app = None
-
-async def upload_to_firebase(file_id: str, file_content: bytes, filename: str) -> str:
+def _blob_path(file_id: str, filename: str) -> str:
+    _, ext = os.path.splitext(filename)
+    return f"documents/{file_id}{ext}"
+
+def _content_type(filename: str) -> str:
+    _, ext = os.path.splitext(filename)
+    return f"application/{ext[1:]}" if ext[1:] in ['pdf', 'docx'] else 'text/plain'
+
+class FirebaseStorage:
+    """Documents in a Firebase Storage bucket"""
+
+    def __init__(self):
+        import firebase_admin
+        from firebase_admin import credentials, storage
+
+        self._storage = storage
+        self.app = None
+        try:
+            # If FIREBASE_CREDENTIALS is a JSON string, parse it
+            if settings.FIREBASE_CREDENTIALS and settings.FIREBASE_CREDENTIALS.startswith('{'):
+                cred = credentials.Certificate(json.loads(settings.FIREBASE_CREDENTIALS))
+            # If it's a file path, load it
+            elif settings.FIREBASE_CREDENTIALS and os.path.exists(settings.FIREBASE_CREDENTIALS):
+                cred = credentials.Certificate(settings.FIREBASE_CREDENTIALS)
+            else:
+                logger.warning("Firebase credentials not provided. Firebase storage won't be available.")
+                return
+
+            self.app = firebase_admin.initialize_app(cred, {
+                'storageBucket': settings.FIREBASE_BUCKET
+            })
+
+        except Exception as e:
+            logger.error(f"Failed to initialize Firebase: {e}")
+            self.app = None
+
+    def upload(self, file_id: str, path: str, filename: str) -> str:
+        if not self.app:
+            logger.warning("Firebase not initialized. Skipping upload.")
+            return "firebase_not_initialized"
+
+        blob = self._storage.bucket().blob(_blob_path(file_id, filename))
+        # Files larger than one chunk go up as a resumable upload, one chunk
+        # per request, so a dropped connection only retries the current chunk
+        if os.path.getsize(path) > settings.STORAGE_CHUNK_SIZE:
+            blob.chunk_size = settings.STORAGE_CHUNK_SIZE
+        # Streamed from the spooled file instead of held in memory
+        blob.upload_from_filename(path, content_type=_content_type(filename))
+
+        # Make the file publicly accessible
+        blob.make_public()
+        return blob.public_url
+
+    def delete(self, file_id: str, filename: str):
+        if not self.app:
+            logger.warning("Firebase not initialized. Skipping deletion.")
+            return
+        self._storage.bucket().blob(_blob_path(file_id, filename)).delete()
+
+class LocalStorage:
+    """Documents in a directory on the local filesystem"""
+
+    def __init__(self, root: str, base_url: str = ""):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(os.path.join(root, "documents"), exist_ok=True)
+
+    def upload(self, file_id: str, path: str, filename: str) -> str:
+        blob_path = _blob_path(file_id, filename)
+        dest = os.path.join(self.root, blob_path)
+        # Copy under a temporary name so a partial file is never visible
+        tmp_path = dest + ".tmp"
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, dest)
+        if self.base_url:
+            return f"{self.base_url}/{blob_path}"
+        return Path(dest).resolve().as_uri()
+
+    def delete(self, file_id: str, filename: str):
+        try:
+            os.remove(os.path.join(self.root, _blob_path(file_id, filename)))
+        except FileNotFoundError:
+            pass
+
+# Storage backend chosen by config, created on first use
+_backend = None
+# The warm-up and an early upload may both make the first call, from different
+# threads; Firebase must be initialized only once
+_backend_lock = threading.Lock()
+
+def get_backend():
     """
-    Upload a file to Firebase Storage
-    
+    The configured storage backend; Firebase is initialized on the first call
+
+    Blocking on that first call, so call it from a worker thread.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if settings.STORAGE_BACKEND == "local":
+                    _backend = LocalStorage(settings.LOCAL_STORAGE_PATH, settings.LOCAL_STORAGE_BASE_URL)
+                elif settings.STORAGE_BACKEND == "firebase":
+                    _backend = FirebaseStorage()
+                else:
+                    raise Exception(f"STORAGE_BACKEND={settings.STORAGE_BACKEND} không được hỗ trợ (firebase, local)")
+    return _backend
+
+async def upload_file(file_id: str, path: str, filename: str) -> str:
+    """
+    Upload a document to the configured storage backend
+
+    The blocking upload runs in a worker thread, reading the file from disk.
+
     Args:
         file_id: Unique ID for the file
-        file_content: Binary content of the file
+        path: Path of the file on local disk (e.g. the upload spool)
         filename: Original filename
-        
+
     Returns:
         URL of the uploaded file
     """
-    if not firebase_app:
-        logger.warning("Firebase not initialized. Skipping upload.")
-        return "firebase_not_initialized"
-    
     try:
-        # Get bucket
-        bucket = storage.bucket()
-        
-        # Create a storage reference
-        _, ext = os.path.splitext(filename)
-        blob_path = f"documents/{file_id}{ext}"
-        blob = bucket.blob(blob_path)
-        
-        # Upload file
-        blob.upload_from_string(
-            file_content,
-            content_type=f"application/{ext[1:]}" if ext[1:] in ['pdf', 'docx'] else 'text/plain'
-        )
-        
-        # Make the file publicly accessible
-        blob.make_public()
-        
-        # Return public URL
-        return blob.public_url
-    
+        with stage_timer("storage_upload"):
+            # The backend is resolved in the thread too, as creating it may block
+            return await asyncio.to_thread(lambda: get_backend().upload(file_id, path, filename))
+
     except Exception as e:
-        logger.error(f"Error uploading to Firebase: {str(e)}", exc_info=True)
-        raise Exception(f"Lỗi khi tải lên Firebase: {str(e)}")
+        logger.error(f"Error uploading to storage: {str(e)}", exc_info=True)
+        raise Exception(f"Lỗi khi tải lên storage: {str(e)}")
 
-async def delete_from_firebase(file_id: str, filename: str) -> bool:
+async def delete_file(file_id: str, filename: str) -> bool:
     """
-    Delete a file from Firebase Storage
-    
+    Delete a document from the configured storage backend
+
     Args:
         file_id: Unique ID of the file
         filename: Original filename
-        
+
     Returns:
         True if successful
     """
-    if not firebase_app:
-        logger.warning("Firebase not initialized. Skipping deletion.")
-        return True
-    
     try:
-        # Get bucket
-        bucket = storage.bucket()
-        
-        # Create a storage reference
-        _, ext = os.path.splitext(filename)
-        blob_path = f"documents/{file_id}{ext}"
-        blob = bucket.blob(blob_path)
-        
-        # Delete the blob
-        blob.delete()
-        
+        with stage_timer("storage_delete"):
+            await asyncio.to_thread(lambda: get_backend().delete(file_id, filename))
         return True
-    
+
     except Exception as e:
-        logger.error(f"Error deleting from Firebase: {str(e)}", exc_info=True)
-        raise Exception(f"Lỗi khi xóa từ Firebase: {str(e)}")
+        logger.error(f"Error deleting from storage: {str(e)}", exc_info=True)
+        raise Exception(f"Lỗi khi xóa từ storage: {str(e)}")
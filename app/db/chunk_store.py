@@ -0,0 +1,464 @@
+import os
+import json
+import mmap
+import hashlib
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# One fixed-width record per chunk: end offsets into the text and metadata
+# blobs (the start is the previous record's end) and the document ordinal
+ROW_DTYPE = np.dtype([("text_end", "<i8"), ("meta_end", "<i8"), ("doc", "<i4")])
+
+# A document referencing a row stored by another document; row -1 records
+# that the document was deleted, -2 that it was added again. The referencing document's own metadata
+# for the chunk is a JSON blob, whose end offset is kept per record
+REF_DTYPE = np.dtype([("doc", "<i4"), ("row", "<i8")])
+
+MANIFEST_FILE = "manifest.json"
+TEXT_FILE = "text.bin"
+META_FILE = "meta.bin"
+ROWS_FILE = "rows.bin"
+DOCS_FILE = "docs.txt"
+VECTORS_FILE = "vectors.f32"
+DELETED_FILE = "deleted.i64"
+HASHES_FILE = "hashes.u8"
+REFS_FILE = "refs.bin"
+REF_META_FILE = "ref_meta.bin"
+REF_META_ENDS_FILE = "ref_meta.i64"
+
+class ChunkStore:
+    """
+    Append-only, columnar store for chunk text, metadata and vectors
+
+    Row N of the store is vector ID N of the index. Chunk text and JSON
+    metadata live in blob files read lazily through mmap; offsets, document
+    ordinals, content hashes and vectors are fixed-width arrays. Appends only
+    write the new records, then publish them by atomically replacing a small
+    manifest, so anything past the manifest counts (e.g. after a crash) is
+    ignored.
+
+    A document can also reference rows stored by other documents (shared
+    chunks); references, with the referencing document's metadata for the
+    chunk, and document deletions go to an append-only log.
+
+    Several processes can open the same store. Only one may write at a time,
+    and only a writer opens it with recover=True; readers see the data
+    published by the manifest they read and reopen the store to see more.
+    """
+
+    def __init__(self, path: str, dimension: int = 1536, recover: bool = True):
+        self.path = path
+        if recover:
+            os.makedirs(path, exist_ok=True)
+
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        elif not recover:
+            # E.g. a generation removed by a compaction in another process
+            raise FileNotFoundError(f"No chunk store in {path}")
+        else:
+            self.manifest = {
+                "dimension": dimension,
+                "rows": 0,
+                "docs": 0,
+                "deleted": 0,
+                "text_bytes": 0,
+                "meta_bytes": 0,
+                "docs_bytes": 0,
+                "refs": 0,
+                "ref_meta_bytes": 0,
+            }
+            self._write_manifest()
+
+        # Stores written before shared chunks existed have no reference log,
+        # and those written before references kept metadata have none for it
+        self.manifest.setdefault("refs", 0)
+        self.manifest.setdefault("ref_meta_bytes", 0)
+        self.dimension = self.manifest["dimension"]
+        if recover:
+            self._truncate_to_manifest()
+
+        # Document table: ordinal -> doc_id and doc_id -> ordinal. A writer
+        # may be appending past the published size
+        self.doc_ids: List[str] = []
+        with open(self._file(DOCS_FILE), "a+b") as f:
+            f.seek(0)
+            self.doc_ids = f.read(self.manifest["docs_bytes"]).decode("utf-8").splitlines()
+        self._doc_ordinals = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+
+        self._text_map = None
+        self._meta_map = None
+        self._rows = np.empty(0, dtype=ROW_DTYPE)
+        self._vectors = np.empty((0, self.dimension), dtype=np.float32)
+        self._hashes = np.empty(0, dtype="<u8")
+        self._ref_meta_map = None
+        self._ref_meta_ends = np.empty(0, dtype="<i8")
+        self._remap()
+        if recover:
+            self._fill_missing_hashes()
+            self._fill_missing_ref_metadata()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _write_manifest(self):
+        """Atomically publish the manifest"""
+        tmp_path = self._file(MANIFEST_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._file(MANIFEST_FILE))
+
+    def _truncate_to_manifest(self):
+        """Drop bytes written after the last published manifest"""
+        sizes = {
+            TEXT_FILE: self.manifest["text_bytes"],
+            META_FILE: self.manifest["meta_bytes"],
+            ROWS_FILE: self.manifest["rows"] * ROW_DTYPE.itemsize,
+            DOCS_FILE: self.manifest["docs_bytes"],
+            VECTORS_FILE: self.manifest["rows"] * self.dimension * 4,
+            DELETED_FILE: self.manifest["deleted"] * 8,
+            HASHES_FILE: self.manifest["rows"] * 8,
+            REFS_FILE: self.manifest["refs"] * REF_DTYPE.itemsize,
+            REF_META_FILE: self.manifest["ref_meta_bytes"],
+            REF_META_ENDS_FILE: self.manifest["refs"] * 8,
+        }
+        for name, size in sizes.items():
+            file_path = self._file(name)
+            if not os.path.exists(file_path):
+                open(file_path, "wb").close()
+            elif os.path.getsize(file_path) > size:
+                logger.warning(f"Truncating unpublished data in {file_path}")
+                with open(file_path, "r+b") as f:
+                    f.truncate(size)
+
+    def _map_blob(self, name: str, size: int):
+        if size == 0:
+            return None
+        with open(self._file(name), "rb") as f:
+            return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _remap(self):
+        """Map the published part of every file"""
+        rows = self.manifest["rows"]
+        self._text_map = self._map_blob(TEXT_FILE, self.manifest["text_bytes"])
+        self._meta_map = self._map_blob(META_FILE, self.manifest["meta_bytes"])
+        self._ref_meta_map = self._map_blob(REF_META_FILE, self.manifest["ref_meta_bytes"])
+        # Like content hashes, offsets of reference metadata may be missing until a writer fills them in
+        ends_path = self._file(REF_META_ENDS_FILE)
+        ends = min(self.manifest["refs"], os.path.getsize(ends_path) // 8 if os.path.exists(ends_path) else 0)
+        self._ref_meta_ends = (
+            np.memmap(ends_path, dtype="<i8", mode="r", shape=(ends,))
+            if ends else np.empty(0, dtype="<i8")
+        )
+        if rows:
+            self._rows = np.memmap(self._file(ROWS_FILE), dtype=ROW_DTYPE, mode="r", shape=(rows,))
+            self._vectors = np.memmap(
+                self._file(VECTORS_FILE), dtype=np.float32, mode="r", shape=(rows, self.dimension)
+            )
+            # Stores written before content hashes were kept have fewer, until
+            # a writer fills in the rest
+            hashes_path = self._file(HASHES_FILE)
+            hashed = min(rows, os.path.getsize(hashes_path) // 8 if os.path.exists(hashes_path) else 0)
+            self._hashes = (
+                np.memmap(hashes_path, dtype="<u8", mode="r", shape=(hashed,))
+                if hashed else np.empty(0, dtype="<u8")
+            )
+        else:
+            self._rows = np.empty(0, dtype=ROW_DTYPE)
+            self._vectors = np.empty((0, self.dimension), dtype=np.float32)
+            self._hashes = np.empty(0, dtype="<u8")
+
+    def _fill_missing_hashes(self):
+        """Hash the rows of a store written before content hashes were kept"""
+        hashed = os.path.getsize(self._file(HASHES_FILE)) // 8
+        if hashed >= len(self):
+            return
+        logger.info(f"Hashing {len(self) - hashed} chunks in {self.path}")
+        hashes = np.array(
+            [self.content_hash(self.get(row)["content"]) for row in range(hashed, len(self))],
+            dtype="<u8"
+        )
+        with open(self._file(HASHES_FILE), "ab") as f:
+            f.write(hashes.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self._remap()
+
+    def _fill_missing_ref_metadata(self):
+        """Record empty metadata for references logged before references kept metadata"""
+        recorded = os.path.getsize(self._file(REF_META_ENDS_FILE)) // 8
+        if recorded >= self.manifest["refs"]:
+            return
+        ends = np.full(self.manifest["refs"] - recorded, self.manifest["ref_meta_bytes"], dtype="<i8")
+        self._append_log(REF_META_ENDS_FILE, ends.tobytes())
+        self._remap()
+
+    @staticmethod
+    def content_hash(text: str) -> int:
+        """64-bit hash identifying a chunk's text"""
+        return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+    def __len__(self) -> int:
+        return self.manifest["rows"]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """Read-only (rows x dimension) view of all stored vectors"""
+        return self._vectors
+
+    @property
+    def hashes(self) -> np.ndarray:
+        """Read-only view of every row's content hash"""
+        return self._hashes
+
+    def append(self, doc_id: str, chunks: List[Dict], embeddings: np.ndarray) -> Tuple[int, int]:
+        """
+        Append a document's chunks and vectors
+
+        Args:
+            doc_id: Document ID
+            chunks: Chunks with "content" and "metadata"
+            embeddings: (len(chunks) x dimension) float32 array
+
+        Returns:
+            The [start, end) row range of the new chunks
+        """
+        return self.append_many([(doc_id, chunks, embeddings)])[0]
+
+    def append_many(
+        self,
+        documents: Iterable[Tuple[str, List[Dict], np.ndarray]],
+        refs: Optional[List[Tuple[str, np.ndarray, List[Optional[Dict]]]]] = None,
+        deleted_doc_ids: Iterable[str] = (),
+        restored_doc_ids: Iterable[str] = ()
+    ) -> List[Tuple[int, int]]:
+        """
+        Append several documents and publish them with one manifest write
+
+        Args:
+            documents: (doc_id, chunks, embeddings) for each document
+            refs: (doc_id, rows, metadata) for documents that also reference
+                rows stored by others, with the document's metadata for each
+                of those chunks (None if unknown); rows may be ones appended
+                by this call. Reference records are numbered in this order
+            deleted_doc_ids: Documents to record as deleted
+            restored_doc_ids: Deleted documents to record as added again
+
+        Returns:
+            The [start, end) row range of each document's new chunks
+        """
+        # A writer that crashed in another process may have left unpublished bytes
+        self._truncate_to_manifest()
+        manifest = dict(self.manifest)
+        ranges = []
+        new_docs = []
+        text_parts, meta_parts, row_parts, vector_parts, hash_parts = [], [], [], [], []
+
+        new_ordinals = {}
+        for doc_id, chunks, embeddings in documents:
+            ordinal = self._doc_ordinals.get(doc_id, new_ordinals.get(doc_id))
+            if ordinal is None:
+                ordinal = new_ordinals[doc_id] = len(self.doc_ids) + len(new_docs)
+                new_docs.append(doc_id)
+
+            rows = np.empty(len(chunks), dtype=ROW_DTYPE)
+            for i, chunk in enumerate(chunks):
+                text = chunk["content"].encode("utf-8")
+                meta = json.dumps(chunk["metadata"], ensure_ascii=False).encode("utf-8")
+                manifest["text_bytes"] += len(text)
+                manifest["meta_bytes"] += len(meta)
+                rows[i] = (manifest["text_bytes"], manifest["meta_bytes"], ordinal)
+                text_parts.append(text)
+                meta_parts.append(meta)
+
+            hash_parts.append(np.array([self.content_hash(chunk["content"]) for chunk in chunks], dtype="<u8"))
+            row_parts.append(rows)
+            vector_parts.append(np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, self.dimension))
+            ranges.append((manifest["rows"], manifest["rows"] + len(chunks)))
+            manifest["rows"] += len(chunks)
+
+        docs_blob = "".join(f"{doc_id}\n" for doc_id in new_docs).encode("utf-8")
+        manifest["docs"] += len(new_docs)
+        manifest["docs_bytes"] += len(docs_blob)
+
+        ref_records, ref_meta_ends, ref_meta_blob = self._ref_records(
+            refs or [], deleted_doc_ids, new_ordinals, manifest["ref_meta_bytes"], restored_doc_ids
+        )
+        manifest["refs"] += len(ref_records)
+        manifest["ref_meta_bytes"] += len(ref_meta_blob)
+
+        for name, parts in (
+            (TEXT_FILE, text_parts),
+            (META_FILE, meta_parts),
+            (ROWS_FILE, [rows.tobytes() for rows in row_parts]),
+            (VECTORS_FILE, [vectors.tobytes() for vectors in vector_parts]),
+            (HASHES_FILE, [hashes.tobytes() for hashes in hash_parts]),
+            (DOCS_FILE, [docs_blob]),
+            (REFS_FILE, [ref_records.tobytes()]),
+            (REF_META_FILE, [ref_meta_blob]),
+            (REF_META_ENDS_FILE, [ref_meta_ends.tobytes()]),
+        ):
+            with open(self._file(name), "ab") as f:
+                f.writelines(parts)
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.manifest = manifest
+        self._write_manifest()
+        self.doc_ids.extend(new_docs)
+        self._doc_ordinals.update(new_ordinals)
+        self._remap()
+        return ranges
+
+    def _ref_records(
+        self,
+        refs: List[Tuple[str, np.ndarray, List[Optional[Dict]]]],
+        deleted_doc_ids: Iterable[str],
+        new_ordinals: Optional[Dict[str, int]] = None,
+        meta_start: int = 0,
+        restored_doc_ids: Iterable[str] = ()
+    ) -> Tuple[np.ndarray, np.ndarray, bytes]:
+        """
+        Reference log records for refs, document deletions and restored documents
+
+        Returns:
+            (records, end offset of each record's metadata, metadata blob);
+            unknown metadata and deletions have none
+        """
+        ordinals = dict(self._doc_ordinals, **(new_ordinals or {}))
+        parts, meta_parts, ends = [], [], []
+        meta_end = meta_start
+        for doc_id, rows, metadata in refs:
+            records = np.empty(len(rows), dtype=REF_DTYPE)
+            records["doc"] = ordinals[doc_id]
+            records["row"] = rows
+            parts.append(records)
+            for chunk_metadata in metadata:
+                if chunk_metadata is not None:
+                    meta = json.dumps(chunk_metadata, ensure_ascii=False).encode("utf-8")
+                    meta_end += len(meta)
+                    meta_parts.append(meta)
+                ends.append(meta_end)
+        for doc_ids, row in ((deleted_doc_ids, -1), (restored_doc_ids, -2)):
+            marked = [ordinals[doc_id] for doc_id in doc_ids if doc_id in ordinals]
+            if marked:
+                records = np.empty(len(marked), dtype=REF_DTYPE)
+                records["doc"] = marked
+                records["row"] = row
+                parts.append(records)
+                ends.extend([meta_end] * len(marked))
+        return (
+            np.concatenate(parts) if parts else np.empty(0, dtype=REF_DTYPE),
+            np.array(ends, dtype="<i8"),
+            b"".join(meta_parts),
+        )
+
+    def _append_log(self, name: str, data: bytes):
+        with open(self._file(name), "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add_refs(
+        self, refs: List[Tuple[str, np.ndarray, List[Optional[Dict]]]], deleted_doc_ids: Iterable[str] = ()
+    ):
+        """Record references to shared rows and deleted documents, adding documents that own no rows"""
+        self.append_many(
+            [
+                (doc_id, [], np.empty((0, self.dimension), dtype=np.float32))
+                for doc_id, _, _ in refs if doc_id not in self._doc_ordinals
+            ],
+            refs,
+            deleted_doc_ids,
+        )
+
+    def mark_deleted(self, rows: np.ndarray, doc_ids: Iterable[str] = ()):
+        """Append row IDs to the deletion log and record the documents as deleted"""
+        rows = np.asarray(rows, dtype="<i8")
+        records, ref_meta_ends, _ = self._ref_records([], doc_ids, meta_start=self.manifest["ref_meta_bytes"])
+        self._truncate_to_manifest()
+        self._append_log(DELETED_FILE, rows.tobytes())
+        self._append_log(REFS_FILE, records.tobytes())
+        self._append_log(REF_META_ENDS_FILE, ref_meta_ends.tobytes())
+        self.manifest = dict(
+            self.manifest,
+            deleted=self.manifest["deleted"] + len(rows),
+            refs=self.manifest["refs"] + len(records),
+        )
+        self._write_manifest()
+
+    def deleted_rows(self) -> np.ndarray:
+        """Return every row ID in the deletion log"""
+        return np.fromfile(self._file(DELETED_FILE), dtype="<i8", count=self.manifest["deleted"])
+
+    @property
+    def num_refs(self) -> int:
+        """Number of records in the reference log"""
+        return self.manifest["refs"]
+
+    def refs(self) -> np.ndarray:
+        """Return every record of the reference log (REF_DTYPE)"""
+        return np.fromfile(self._file(REFS_FILE), dtype=REF_DTYPE, count=self.manifest["refs"])
+
+    def ref_metadata(self, ref: int) -> Optional[Dict]:
+        """Read the metadata of a reference log record, or None if none was recorded"""
+        if ref >= len(self._ref_meta_ends):
+            return None
+        start = int(self._ref_meta_ends[ref - 1]) if ref else 0
+        end = int(self._ref_meta_ends[ref])
+        if end == start:
+            return None
+        return json.loads(self._ref_meta_map[start:end])
+
+    def doc_id(self, row: int) -> str:
+        """Return the document ID of a row"""
+        return self.doc_ids[self._rows[row]["doc"]]
+
+    def get(self, row: int) -> Dict:
+        """Read one chunk: its document ID, text and metadata"""
+        record = self._rows[row]
+        text_start = int(self._rows[row - 1]["text_end"]) if row else 0
+        meta_start = int(self._rows[row - 1]["meta_end"]) if row else 0
+        return {
+            "doc_id": self.doc_ids[record["doc"]],
+            "content": self._text_map[text_start:int(record["text_end"])].decode("utf-8"),
+            "metadata": json.loads(self._meta_map[meta_start:int(record["meta_end"])]),
+        }
+
+    def doc_ranges(self) -> Dict[str, Tuple[int, int]]:
+        """Map each document ID to the [start, end) range of its rows"""
+        docs = np.asarray(self._rows["doc"])
+        if not len(docs):
+            return {}
+        # Rows of one document are contiguous, so ranges start where the ordinal changes
+        starts = np.flatnonzero(np.diff(docs, prepend=-1))
+        ends = np.append(starts[1:], len(docs))
+        return {self.doc_ids[docs[start]]: (int(start), int(end)) for start, end in zip(starts, ends)}
+
+    def copy_rows(self, rows: np.ndarray, dest: "ChunkStore", batch_rows: int = 10000):
+        """Append the given rows, grouped by document, to another store"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+        docs = np.asarray(self._rows["doc"][rows])
+        boundaries = np.flatnonzero(np.diff(docs)) + 1
+
+        documents = []
+        pending = 0
+        for group in np.split(rows, boundaries):
+            chunks = [self.get(int(row)) for row in group]
+            documents.append((chunks[0]["doc_id"], chunks, np.asarray(self._vectors[group])))
+            pending += len(group)
+            if pending >= batch_rows:
+                dest.append_many(documents)
+                documents = []
+                pending = 0
+        if documents:
+            dest.append_many(documents)
@@ -1,19 +1,51 @@
-from sqlalchemy import create_engine, Column, String, Integer, DateTime, Text
+from typing import AsyncIterator, Dict, Union
+from sqlalchemy import event, inspect, text, Column, String, Integer, DateTime, Index, Text
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 from app.config import settings
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
-# Database URL
-DATABASE_URL = f"postgresql://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{settings.POSTGRES_HOST}:{settings.POSTGRES_PORT}/{settings.POSTGRES_DB}"
+# Database URL (asyncpg driver); DATABASE_URL overrides it, e.g. sqlite+aiosqlite:///./test.db
+DATABASE_URL = settings.DATABASE_URL or f"postgresql+asyncpg://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{settings.POSTGRES_HOST}:{settings.POSTGRES_PORT}/{settings.POSTGRES_DB}"
+
+def _pool_options() -> Dict[str, int]:
+    """Pool sizing for dialects that use a queue pool; e.g. in-memory SQLite uses a StaticPool, which takes none"""
+    url = make_url(DATABASE_URL)
+    if not issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        return {}
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+    }
 
 # Initialize SQLAlchemy
 Base = declarative_base()
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    # Replaces connections the server closed while they sat idle in the pool
+    pool_pre_ping=True,
+    **_pool_options(),
+)
+# Objects stay usable after commit without another round-trip to reload them
+SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
+
+# Pool activity since startup
+_pool_counters = {"connections_opened": 0, "checkouts": 0}
+
+@event.listens_for(engine.sync_engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    _pool_counters["connections_opened"] += 1
+
+@event.listens_for(engine.sync_engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    _pool_counters["checkouts"] += 1
 
 # File metadata model
 class FileMetadata(Base):
@@ -26,20 +58,112 @@ class FileMetadata(Base):
     vector_id = Column(String)
     file_url = Column(String)
     upload_time = Column(DateTime, default=datetime.utcnow)
+    # SHA-256 of the file content; identical uploads resolve to the existing file.
+    # Unique, so when workers ingest the same content at once only one copy is saved
+    content_hash = Column(String, index=True, unique=True)
+    
+    __table_args__ = (
+        # Keyset pagination of the document list (newest first), overall and per file type
+        Index("ix_files_upload_time_file_id", "upload_time", "file_id"),
+        Index("ix_files_file_type_upload_time_file_id", "file_type", "upload_time", "file_id"),
+        # Filename prefix filters (LIKE 'prefix%'); text_pattern_ops lets Postgres
+        # use the index whatever the database collation
+        Index("ix_files_filename_prefix", "filename", postgresql_ops={"filename": "text_pattern_ops"}),
+    )
+
+# Ingestion job model; rows let every worker report a job and take over
+# jobs whose worker stopped
+class IngestionJobRecord(Base):
+    __tablename__ = "ingestion_jobs"
+    
+    job_id = Column(String, primary_key=True)
+    # "document" or "bulk"
+    job_type = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    # Stage a document job is in; bulk jobs report it per file in progress
+    stage = Column(String)
+    error = Column(Text)
+    # Worker process that runs the job (host:pid:id)
+    worker = Column(String)
+    # The job's status response as JSON, served by every worker
+    progress = Column(Text)
+    # Spooled files and their content hashes, needed to run the job again
+    state = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Refreshed by the running worker; a stale unfinished job is taken over
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+    
+    __table_args__ = (
+        # Unfinished jobs by heartbeat, and the job history newest first
+        Index("ix_ingestion_jobs_finished_at_updated_at", "finished_at", "updated_at"),
+    )
+
+def _add_missing_columns(connection):
+    """Add columns introduced after a table was created (create_all only creates missing tables)"""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            logger.info(f"Added column {table.name}.{column.name}")
+        for table_index in table.indexes:
+            table_index.create(bind=connection, checkfirst=True)
 
-def create_tables():
+def _unique_content_hashes(connection):
+    """Make files.content_hash unique on tables created when its index was not"""
+    inspector = inspect(connection)
+    if not inspector.has_table("files"):
+        return
+    for existing in inspector.get_indexes("files"):
+        if existing["name"] != "ix_files_content_hash" or existing["unique"]:
+            continue
+        # Copies saved before the index was unique stay as documents, but only
+        # the oldest one is matched by later uploads
+        result = connection.execute(text(
+            "UPDATE files SET content_hash = NULL WHERE EXISTS ("
+            "SELECT 1 FROM files AS earlier WHERE earlier.content_hash = files.content_hash "
+            "AND (earlier.upload_time < files.upload_time "
+            "OR (earlier.upload_time = files.upload_time AND earlier.file_id < files.file_id)))"
+        ))
+        connection.execute(text("DROP INDEX ix_files_content_hash"))
+        # Recreated as a unique index by _add_missing_columns
+        logger.info(f"Made files.content_hash unique ({result.rowcount} duplicate hashes cleared)")
+
+async def create_tables():
     """Create database tables"""
     try:
-        Base.metadata.create_all(bind=engine)
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+            await connection.run_sync(_unique_content_hashes)
+            await connection.run_sync(_add_missing_columns)
         logger.info("Database tables created successfully")
     except Exception as e:
         logger.error(f"Error creating database tables: {str(e)}", exc_info=True)
         raise Exception(f"Lỗi khi tạo bảng database: {str(e)}")
 
-def get_db_session():
+async def get_db_session() -> AsyncIterator[AsyncSession]:
     """Get database session for dependency injection"""
-    db_session = SessionLocal()
-    try:
+    async with SessionLocal() as db_session:
         yield db_session
-    finally:
-        db_session.close()
+
+def pool_status() -> Dict[str, Union[int, str]]:
+    """Current connection pool usage and activity counters"""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        # StaticPool, NullPool...: no size or checkouts to report
+        return {"pool_class": type(pool).__name__, **_pool_counters}
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        # Negative while fewer than size connections are open
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        **_pool_counters,
+    }
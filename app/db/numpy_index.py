@@ -0,0 +1,210 @@
+import os
+from typing import Optional, Tuple
+import numpy as np
+
+PRECISIONS = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+# Rows converted to float32 at a time when scoring float16/int8 storage
+SCORE_BLOCK_ROWS = 16384
+
+# Snapshot written by save() into a directory: the int8 scale, then the vectors
+VECTORS_FILE = "index.npy"
+
+class NumpyIndex:
+    """
+    Inner-product index over L2-normalized vectors
+
+    Vectors are kept in a preallocated matrix that doubles when full.
+    A query batch is scored with one matrix product and the top-k picked
+    with argpartition. Results follow the FAISS IndexFlatL2 convention:
+    squared L2 distances (2 - 2 * cosine for unit vectors) in ascending
+    order, with -1 IDs where there is no result.
+
+    Storage precision is float32 (exact), float16, or int8 with a
+    per-dimension scale. Quantized matrices are scored block by block in
+    float32, so scores are approximate but memory is 2x / 4x smaller.
+    """
+
+    def __init__(self, dimension: int, capacity: int = 1024, precision: str = "float32"):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unsupported precision {precision}")
+        self.d = dimension
+        self.ntotal = 0
+        self.precision = precision
+        self._vectors = np.empty((capacity, dimension), dtype=PRECISIONS[precision])
+        self._alive = np.ones(capacity, dtype=bool)
+        self._deleted = 0
+        # int8 code = round(value / scale); the scale only ever grows
+        self._scale = np.zeros(dimension, dtype=np.float32)
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors.reshape(-1, vectors.shape[-1])
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _reserve(self, rows: int):
+        """Grow the matrix so it can hold `rows` vectors"""
+        capacity = len(self._vectors)
+        if rows <= capacity:
+            return
+        capacity = max(capacity, 1)
+        while capacity < rows:
+            capacity *= 2
+        vectors = np.empty((capacity, self.d), dtype=self._vectors.dtype)
+        vectors[:self.ntotal] = self._vectors[:self.ntotal]
+        alive = np.ones(capacity, dtype=bool)
+        alive[:self.ntotal] = self._alive[:self.ntotal]
+        self._vectors = vectors
+        self._alive = alive
+
+    def add(self, vectors: np.ndarray):
+        """Append vectors; their IDs continue from ntotal"""
+        if not len(vectors):
+            return
+        vectors = self._normalize(vectors)
+        self._reserve(self.ntotal + len(vectors))
+        self._vectors[self.ntotal:self.ntotal + len(vectors)] = self._encode(vectors)
+        self.ntotal += len(vectors)
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        """Convert normalized float32 vectors to the storage precision"""
+        if self.precision != "int8":
+            return vectors.astype(self._vectors.dtype)
+
+        # Widen the scale where the new vectors exceed it and requantize the
+        # stored codes of just those dimensions
+        needed = np.abs(vectors).max(axis=0) / 127.0
+        grown = needed > self._scale
+        if grown.any():
+            if self.ntotal:
+                ratio = self._scale[grown] / needed[grown]
+                stored = self._vectors[:self.ntotal, grown].astype(np.float32) * ratio
+                self._vectors[:self.ntotal, grown] = np.round(stored).astype(np.int8)
+            self._scale[grown] = needed[grown]
+
+        scale = np.where(self._scale > 0, self._scale, 1.0)
+        return np.clip(np.round(vectors / scale), -127, 127).astype(np.int8)
+
+    def _scores(self, queries: np.ndarray, start: int, end: int) -> np.ndarray:
+        """Inner products between queries and stored vectors [start, end)"""
+        if self.precision == "float32":
+            return queries @ self._vectors[start:end].T
+
+        if self.precision == "int8":
+            # q . (codes * scale) == (q * scale) . codes
+            queries = queries * self._scale
+        scores = np.empty((len(queries), end - start), dtype=np.float32)
+        for block in range(start, end, SCORE_BLOCK_ROWS):
+            block_end = min(block + SCORE_BLOCK_ROWS, end)
+            scores[:, block - start:block_end - start] = (
+                queries @ self._vectors[block:block_end].astype(np.float32).T
+            )
+        return scores
+
+    def mark_deleted(self, ids: np.ndarray):
+        """Exclude vector IDs from future searches"""
+        ids = np.asarray(ids, dtype=np.int64)
+        self._deleted += int(np.count_nonzero(self._alive[ids]))
+        self._alive[ids] = False
+
+    def save(self, path: str):
+        """
+        Atomically write the stored vectors into directory path
+
+        The int8 scale goes first in the same file, so a reader never pairs
+        vectors with the scale of another snapshot.
+        """
+        tmp_path = os.path.join(path, VECTORS_FILE + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, self._scale)
+            np.save(f, self._vectors[:self.ntotal])
+        os.replace(tmp_path, os.path.join(path, VECTORS_FILE))
+
+    @classmethod
+    def load(cls, path: str, precision: str = "float32", mmap: bool = True) -> Optional["NumpyIndex"]:
+        """
+        Open a snapshot written by save(), or None if there is none for this precision
+
+        With mmap the vectors stay in the page cache, shared with other
+        processes mapping the same file, instead of being read into memory;
+        the first add() copies them into a private, growable matrix.
+        """
+        vectors_path = os.path.join(path, VECTORS_FILE)
+        if not os.path.exists(vectors_path):
+            return None
+        with open(vectors_path, "rb") as f:
+            scale = np.load(f)
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+            if dtype != PRECISIONS.get(precision) or len(shape) != 2 or fortran_order:
+                return None
+            if not mmap or not shape[0]:
+                vectors = np.fromfile(f, dtype=dtype, count=shape[0] * shape[1]).reshape(shape)
+        if mmap and shape[0]:
+            vectors = np.memmap(vectors_path, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+        loaded = cls(shape[1], capacity=0, precision=precision)
+        loaded._vectors = vectors
+        loaded._alive = np.ones(len(vectors), dtype=bool)
+        loaded._scale = scale
+        loaded.ntotal = len(vectors)
+        return loaded
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the stored vectors"""
+        return self._vectors.nbytes + self._scale.nbytes
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        max_distance: Optional[float] = None,
+        rows: Optional[Tuple[int, int]] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k nearest vectors for each query
+
+        Args:
+            queries: (nq x d) query vectors
+            k: Number of neighbours per query
+            max_distance: Drop results farther than this squared L2 distance
+            rows: Optional [start, end) ID range to search within
+
+        Returns:
+            (distances, ids), both (nq x k)
+        """
+        queries = self._normalize(queries)
+        start, end = rows if rows is not None else (0, self.ntotal)
+        n = end - start
+        k = min(k, n)
+        if k <= 0:
+            return (np.full((len(queries), 0), np.inf, dtype=np.float32),
+                    np.full((len(queries), 0), -1, dtype=np.int64))
+
+        scores = self._scores(queries, start, end)
+        if self._deleted:
+            scores[:, ~self._alive[start:end]] = -np.inf
+
+        if k < n:
+            candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.broadcast_to(np.arange(n), (len(queries), n))
+        top = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-top, axis=1)
+        ids = np.take_along_axis(candidates, order, axis=1) + start
+        top = np.take_along_axis(top, order, axis=1)
+
+        distances = np.maximum(2.0 - 2.0 * top, 0.0).astype(np.float32)
+        invalid = ~np.isfinite(top)
+        if max_distance is not None:
+            invalid |= distances > max_distance
+        ids[invalid] = -1
+        distances[invalid] = np.inf
+        return distances, ids
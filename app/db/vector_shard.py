@@ -0,0 +1,922 @@
+import os
+import time
+import shutil
+import pickle
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import numpy as np
+from app.config import settings
+from app.db.chunk_store import MANIFEST_FILE, ChunkStore
+from app.db.numpy_index import VECTORS_FILE as NUMPY_INDEX_FILE, NumpyIndex
+from app.utils.file_lock import FileLock
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+if settings.VECTOR_DB not in ("chroma", "numpy"):
+    import faiss
+    # Saved indexes are mapped read-only instead of read into memory;
+    # FAISS builds without the flag read them
+    _MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+dimension = 1536  # Dimension for text-embedding-3-small
+
+# Saved FAISS index inside a generation directory (NumPy indexes save
+# NUMPY_INDEX_FILE). It is a read-only snapshot of the store's first rows
+# that every worker maps; rows appended after it are searched exactly
+# until the next snapshot
+INDEX_FILE = "index.faiss"
+
+# Any worker may write, one at a time: writes hold WRITE_LOCK_FILE. The
+# worker holding MAINTENANCE_LOCK_FILE writes snapshots and compacts; the
+# others load what it publishes
+WRITE_LOCK_FILE = "WRITE.lock"
+MAINTENANCE_LOCK_FILE = "MAINTENANCE.lock"
+
+def _use_ann(ntotal: int) -> bool:
+    """Whether an index holding ntotal vectors should be an HNSW graph"""
+    if settings.VECTOR_INDEX_TYPE == "hnsw":
+        if settings.VECTOR_DB == "numpy":
+            raise Exception("VECTOR_INDEX_TYPE=hnsw chỉ hỗ trợ với VECTOR_DB=faiss")
+        return True
+    return (
+        settings.VECTOR_INDEX_TYPE == "auto"
+        and settings.VECTOR_DB != "numpy"
+        and ntotal >= settings.VECTOR_ANN_THRESHOLD
+    )
+
+def _new_index(dim: int, ntotal: int = 0):
+    """Create an empty index for the configured local backend and precision, sized for ntotal vectors"""
+    use_ann = _use_ann(ntotal)
+    if settings.VECTOR_DB == "numpy":
+        return NumpyIndex(dim, precision=settings.VECTOR_PRECISION)
+    if settings.VECTOR_PRECISION not in ("float32", "float16"):
+        raise Exception(f"VECTOR_PRECISION={settings.VECTOR_PRECISION} chỉ hỗ trợ với VECTOR_DB=numpy")
+
+    if use_ann:
+        if settings.VECTOR_PRECISION == "float16":
+            new_index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_fp16, settings.HNSW_M)
+        else:
+            new_index = faiss.IndexHNSWFlat(dim, settings.HNSW_M)
+        new_index.hnsw.efConstruction = settings.HNSW_EF_CONSTRUCTION
+        new_index.hnsw.efSearch = settings.HNSW_EF_SEARCH
+        return new_index
+
+    if settings.VECTOR_PRECISION == "float16":
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    return faiss.IndexFlatL2(dim)
+
+def _is_ann(current_index) -> bool:
+    """Whether an index is an HNSW graph"""
+    return settings.VECTOR_DB != "numpy" and isinstance(current_index, faiss.IndexHNSW)
+
+def _index_path(path: str) -> str:
+    """Index snapshot file of a generation directory"""
+    return os.path.join(path, NUMPY_INDEX_FILE if settings.VECTOR_DB == "numpy" else INDEX_FILE)
+
+def _save_index(current_index, path: str):
+    """Atomically write an index into a generation directory"""
+    if settings.VECTOR_DB == "numpy":
+        current_index.save(path)
+        return
+    tmp_path = os.path.join(path, INDEX_FILE + ".tmp")
+    faiss.write_index(current_index, tmp_path)
+    os.replace(tmp_path, os.path.join(path, INDEX_FILE))
+
+def _read_saved_index(path: str, mmap: bool = True):
+    """Open the index saved in a generation directory, or None if there is none"""
+    if settings.VECTOR_DB == "numpy":
+        return NumpyIndex.load(path, settings.VECTOR_PRECISION, mmap=mmap)
+
+    index_path = _index_path(path)
+    if not os.path.exists(index_path):
+        return None
+    saved = faiss.read_index(index_path, _MMAP_FLAG if mmap else 0)
+    if _is_ann(saved):
+        saved.hnsw.efSearch = settings.HNSW_EF_SEARCH
+    return saved
+
+def _snapshot_usable(saved, current_store: ChunkStore) -> bool:
+    """Whether a saved index is of a configured type and covers only rows of the store"""
+    dim = current_store.dimension
+    return (
+        type(saved) in (type(_new_index(dim, 0)), type(_new_index(dim, len(current_store))))
+        and saved.d == dim
+        and saved.ntotal <= len(current_store)
+    )
+
+def _snapshot_outdated(current_index, current_store: ChunkStore) -> bool:
+    """Whether too many rows are past the snapshot or the store has outgrown its index type"""
+    return (
+        len(current_store) - current_index.ntotal >= settings.VECTOR_SNAPSHOT_ROWS
+        or type(current_index) is not type(_new_index(current_store.dimension, len(current_store)))
+    )
+
+def _write_snapshot(current_store: ChunkStore, rows: int):
+    """
+    Save an index of the store's first rows; call holding the maintenance lock
+
+    HNSW graphs are expensive to build, so a saved index of the right type
+    is read into memory and only the rows appended since it was written
+    are inserted.
+    """
+    new_index = _new_index(current_store.dimension, rows)
+    saved = _read_saved_index(current_store.path, mmap=False)
+    if saved is not None and type(saved) is type(new_index) and saved.d == new_index.d and saved.ntotal <= rows:
+        new_index = saved
+    new_index.add(np.asarray(current_store.vectors[new_index.ntotal:rows]))
+    _save_index(new_index, current_store.path)
+
+def _load_document_state(current_store: ChunkStore, current_tombstones: Set[int]) -> Tuple[
+    Dict[str, Tuple[int, int]], Dict[str, np.ndarray], Dict[int, Dict[str, int]], Set[str], Dict[int, int]
+]:
+    """
+    Rebuild the in-memory view of a store's documents
+
+    Returns:
+        (row range of each live document's own chunks, shared rows each live
+        document references, the live documents referencing each shared row
+        with the number of their reference record, deleted documents still in
+        the store, live row of each chunk content hash)
+    """
+    doc_ids = current_store.doc_ids
+    doc_ranges = current_store.doc_ranges()
+
+    # Replay the reference log: deleting a document drops its references,
+    # and a deleted document may have been added again since
+    deleted_ordinals: Set[int] = set()
+    live_refs: Dict[int, List[Tuple[int, int]]] = {}
+    for ref, (ordinal, row) in enumerate(current_store.refs().tolist()):
+        if row == -1:
+            deleted_ordinals.add(ordinal)
+            live_refs.pop(ordinal, None)
+        elif row == -2:
+            deleted_ordinals.discard(ordinal)
+        else:
+            live_refs.setdefault(ordinal, []).append((row, ref))
+
+    ranges, deleted = {}, set()
+    for ordinal, doc_id in enumerate(doc_ids):
+        doc_range = doc_ranges.get(doc_id, (0, 0))
+        # Stores written before the reference log only have tombstoned rows
+        if ordinal in deleted_ordinals or (doc_range[1] > doc_range[0] and doc_range[0] in current_tombstones):
+            deleted.add(doc_id)
+        else:
+            ranges[doc_id] = doc_range
+
+    shared: Dict[str, List[int]] = {}
+    referrers: Dict[int, Dict[str, int]] = {}
+    for ordinal, doc_refs in live_refs.items():
+        doc_id = doc_ids[ordinal]
+        if doc_id in deleted:
+            continue
+        for row, ref in doc_refs:
+            shared.setdefault(doc_id, []).append(row)
+            referrers.setdefault(row, {}).setdefault(doc_id, ref)
+
+    live = np.ones(len(current_store), dtype=bool)
+    if current_tombstones:
+        live[np.fromiter(current_tombstones, dtype='int64')] = False
+    live_rows = np.flatnonzero(live)
+    chunk_rows = dict(zip(current_store.hashes[live_rows].tolist(), live_rows.tolist()))
+
+    return (
+        ranges,
+        {doc_id: np.array(rows, dtype='int64') for doc_id, rows in shared.items()},
+        referrers,
+        deleted,
+        chunk_rows,
+    )
+
+def _file_version(path: str):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def _rescore(
+    current_store: ChunkStore, query_embeddings: np.ndarray, indices: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Re-rank candidate IDs by exact squared L2 distance
+
+    Candidates come from a reduced-precision index; their full-precision
+    vectors are read from the store's vector column.
+    """
+    vectors = current_store.vectors
+    distances = np.full((len(query_embeddings), k), np.inf, dtype=np.float32)
+    ids = np.full((len(query_embeddings), k), -1, dtype=np.int64)
+    for q, query in enumerate(query_embeddings):
+        candidates = np.sort(indices[q][indices[q] >= 0])
+        if not len(candidates):
+            continue
+        exact = np.sum((np.asarray(vectors[candidates]) - query) ** 2, axis=1)
+        order = np.argsort(exact)[:k]
+        distances[q, :len(order)] = exact[order]
+        ids[q, :len(order)] = candidates[order]
+    return distances, ids
+
+def _search_rows(
+    current_store: ChunkStore, query_embeddings: np.ndarray, rows: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact top-k squared L2 search over the given store rows"""
+    vectors = np.asarray(current_store.vectors[rows])
+    distances = (
+        np.sum(query_embeddings ** 2, axis=1, keepdims=True)
+        - 2.0 * query_embeddings @ vectors.T
+        + np.sum(vectors ** 2, axis=1)
+    )
+    top = np.argsort(distances, axis=1)[:, :k]
+    distances = np.maximum(np.take_along_axis(distances, top, axis=1), 0.0).astype(np.float32)
+    return distances, rows[top]
+
+def _merge_results(
+    distances: np.ndarray, indices: np.ndarray, more_distances: np.ndarray, more_indices: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Keep the k nearest of two sets of search results for each query"""
+    distances = np.concatenate([distances, more_distances], axis=1)
+    indices = np.concatenate([indices, more_indices], axis=1)
+    distances = np.where(indices >= 0, distances, np.inf)
+    top = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(distances, top, axis=1), np.take_along_axis(indices, top, axis=1)
+
+def _chunk_metadata(
+    current_store: ChunkStore,
+    doc_data: Dict,
+    referrers: Optional[Dict[str, int]],
+    file_id: Optional[str],
+    deleted_documents: Set[str]
+) -> Optional[Dict]:
+    """
+    Metadata of a search hit, naming the document it is returned for
+
+    Like ChromaDB results, metadata names the chunk's document: the searched
+    document, else the owner while it is live, else a live document that
+    references the chunk. A reference logged before references kept
+    metadata only names its document. None if no live document has the chunk.
+    """
+    owner = doc_data["doc_id"]
+    if owner == file_id or (not file_id and owner not in deleted_documents):
+        return {**doc_data["metadata"], "doc_id": owner}
+
+    # The dict may change on the event loop; copying it is atomic
+    referrers = dict(referrers or {})
+    doc_id = file_id if file_id in referrers else (None if file_id else next(iter(referrers), None))
+    if doc_id is None:
+        return None
+    return {**(current_store.ref_metadata(referrers[doc_id]) or {}), "doc_id": doc_id}
+
+class VectorShard:
+    """
+    One partition of the local (FAISS/NumPy) vector store
+
+    Chunks and vectors live in an append-only ChunkStore; compaction writes
+    a new generation directory under root and CURRENT names the live one.
+    The index is a read-only snapshot of the store's first rows, mapped by
+    every worker so they share its pages; rows appended after it are
+    searched exactly from the store's vector column.
+
+    Writes from any worker are serialized by a file lock and applied to the
+    latest published state; snapshots and compactions run in the worker
+    holding the maintenance lock, and the others load what it publishes.
+    search() only reads state and may run in a worker thread.
+    """
+
+    def __init__(self, root: str, owns: Callable[[str], bool] = lambda doc_id: True):
+        self.root = root
+        self.current_path = os.path.join(root, "CURRENT")
+        # Documents of the files written by earlier versions that belong here
+        self._owns = owns
+        self._store_lock = FileLock(os.path.join(root, WRITE_LOCK_FILE))
+        self._maintenance_lock = FileLock(os.path.join(root, MAINTENANCE_LOCK_FILE))
+
+        self.store = None
+        self.index = None
+        # Row IDs of deleted chunks that are still physically in the index
+        self.tombstones: Set[int] = set()
+        # Chunks whose text is already stored are referenced instead of stored
+        # again (document_refs); a shared row stays live while a document in
+        # shared_rows references it, and is labelled with that document's
+        # metadata (its reference record) once the owner is deleted
+        self.document_ranges: Dict[str, Tuple[int, int]] = {}
+        self.document_refs: Dict[str, np.ndarray] = {}
+        self.shared_rows: Dict[int, Dict[str, int]] = {}
+        self.deleted_documents: Set[str] = set()
+        self.chunk_rows: Dict[int, int] = {}
+        # Live rows past the index snapshot
+        self._delta_rows = np.empty(0, dtype='int64')
+        self._live_selector = None
+
+        # What was published on disk when the state above was read, when it
+        # was last checked, and a counter of this worker's own changes to it
+        self._synced_version = None
+        self._last_sync = 0.0
+        self._state_serial = 0
+
+        # Serializes changes within this worker; searches read the state
+        # without it, taking _state_lock only to pick up a consistent state
+        self._write_lock = asyncio.Lock()
+        self._reload_lock = asyncio.Lock()
+        self._state_lock = threading.Lock()
+        self._compaction_task = None
+        self._snapshot_task = None
+
+    def _publish_generation(self, name: str):
+        """Atomically point CURRENT at a generation directory"""
+        tmp_path = self.current_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.current_path)
+
+    def _current_generation(self) -> str:
+        """Name of the live generation directory"""
+        with open(self.current_path, "r", encoding="utf-8") as f:
+            return f.read().strip()
+
+    def _next_generation_name(self) -> str:
+        """Name for the generation directory after the current one"""
+        current = os.path.basename(self.store.path)
+        return f"gen-{int(current.split('-')[1]) + 1:06d}"
+
+    def _import_legacy_files(self, new_store: ChunkStore):
+        """Copy this shard's documents of a faiss_index.bin + metadata.pickle pair into a ChunkStore"""
+        import faiss
+
+        legacy_index = faiss.read_index(legacy_index_path)
+        with open(legacy_metadata_path, 'rb') as f:
+            legacy_metadata = pickle.load(f)
+        if os.path.exists(legacy_tombstones_path):
+            for idx in np.load(legacy_tombstones_path).tolist():
+                legacy_metadata.pop(idx, None)
+
+        ids = np.array(sorted(legacy_metadata), dtype='int64')
+        documents = []
+        for idx in ids:
+            data = legacy_metadata[int(idx)]
+            if not self._owns(data["doc_id"]):
+                continue
+            if not documents or documents[-1][0] != data["doc_id"]:
+                documents.append((data["doc_id"], [], []))
+            documents[-1][1].append({"content": data["content"], "metadata": data["metadata"]})
+            documents[-1][2].append(int(idx))
+
+        new_store.append_many([
+            (doc_id, chunks, legacy_index.reconstruct_batch(np.array(idxs, dtype='int64')))
+            for doc_id, chunks, idxs in documents
+        ])
+        logger.info(f"Imported {len(new_store)} chunks from {legacy_index_path} into {self.root}")
+
+    def _open_current_store(self) -> ChunkStore:
+        """
+        Open the live generation for writing, creating (and migrating into)
+        the first one if needed; call holding the write lock
+        """
+        if os.path.exists(self.current_path):
+            return ChunkStore(os.path.join(self.root, self._current_generation()))
+
+        name = "gen-000001"
+        new_store = ChunkStore(os.path.join(self.root, name), dimension=dimension)
+        if os.path.exists(legacy_index_path) and os.path.exists(legacy_metadata_path) and not len(new_store):
+            self._import_legacy_files(new_store)
+        self._publish_generation(name)
+        return new_store
+
+    def _remove_stale_generations(self):
+        """Remove generations left behind by an interrupted compaction; call holding the maintenance lock"""
+        name = self._current_generation()
+        for entry in os.listdir(self.root):
+            if entry.startswith("gen-") and entry != name:
+                shutil.rmtree(os.path.join(self.root, entry), ignore_errors=True)
+
+    def _build_snapshot(self, path: str, lock_held: bool = False) -> Tuple[object, ChunkStore]:
+        """
+        Write the index snapshot of a generation that has none (or an unusable one) and map it
+
+        Without the maintenance lock, and with another task or worker
+        holding it, returns an empty index instead: every row is then
+        searched exactly until the holder publishes a snapshot or a new
+        generation, which the next check for changes loads.
+        """
+        if not lock_held and not self._maintenance_lock.acquire(blocking=False):
+            logger.info(f"Index snapshot of {path} is being written elsewhere, searching it exactly meanwhile")
+            current_store = ChunkStore(path, recover=False)
+            return _new_index(current_store.dimension, 0), current_store
+        try:
+            # Another worker may have written it meanwhile
+            saved = _read_saved_index(path)
+            current_store = ChunkStore(path, recover=False)
+            if saved is None or not _snapshot_usable(saved, current_store):
+                logger.info(f"Writing the index snapshot of {path} ({len(current_store)} vectors)")
+                _write_snapshot(current_store, len(current_store))
+                saved = _read_saved_index(path)
+                current_store = ChunkStore(path, recover=False)
+        finally:
+            if not lock_held:
+                self._maintenance_lock.release()
+        return saved, current_store
+
+    def _disk_version(self) -> Tuple:
+        """Identify the published state: the live generation, its manifest and its index snapshot"""
+        name = self._current_generation()
+        path = os.path.join(self.root, name)
+        return (name, _file_version(os.path.join(path, MANIFEST_FILE)), _file_version(_index_path(path)))
+
+    def _read_state(self, lock_held: bool = False) -> Tuple:
+        """
+        Open the live generation as published on disk
+
+        The snapshot is mapped before the store is opened, so it never
+        covers rows the store doesn't have. lock_held tells whether the
+        caller holds the maintenance lock.
+
+        Returns:
+            (disk version, store, index, tombstones, then the document state
+            of _load_document_state)
+        """
+        version = self._disk_version()
+        path = os.path.join(self.root, version[0])
+        saved = _read_saved_index(path)
+        current_store = ChunkStore(path, recover=False)
+        if saved is None or not _snapshot_usable(saved, current_store):
+            saved, current_store = self._build_snapshot(path, lock_held)
+
+        current_tombstones = set(current_store.deleted_rows().tolist())
+        return (
+            version, current_store, saved, current_tombstones,
+            *_load_document_state(current_store, current_tombstones)
+        )
+
+    def load(self) -> Tuple:
+        """Open the live generation, creating or recovering it first, and read its state (blocking)"""
+        os.makedirs(self.root, exist_ok=True)
+        with self._store_lock:
+            self._open_current_store()
+        if self._maintenance_lock.acquire(blocking=False):
+            try:
+                self._remove_stale_generations()
+            finally:
+                self._maintenance_lock.release()
+        return self._read_state()
+
+    def install_state(self, state: Tuple):
+        """Swap in a state read by load() or _read_state(); call on the event loop"""
+        with self._state_lock:
+            (
+                self._synced_version, self.store, self.index, self.tombstones,
+                self.document_ranges, self.document_refs, self.shared_rows,
+                self.deleted_documents, self.chunk_rows
+            ) = state
+            self._apply_tombstones(np.fromiter(self.tombstones, dtype='int64'))
+            self._update_delta_rows()
+        # E.g. an empty index while another worker held the maintenance lock
+        self._maybe_schedule_snapshot()
+
+    def _apply_tombstones(self, rows: np.ndarray):
+        """Make the index skip tombstoned rows"""
+        if settings.VECTOR_DB == "numpy":
+            rows = rows[rows < self.index.ntotal]
+            if len(rows):
+                self.index.mark_deleted(rows)
+        elif self.tombstones:
+            batch = faiss.IDSelectorBatch(np.fromiter(self.tombstones, dtype='int64'))
+            # Keep a reference to the inner selector, IDSelectorNot doesn't own it
+            self._live_selector = (faiss.IDSelectorNot(batch), batch)
+        else:
+            self._live_selector = None
+
+    def _update_delta_rows(self):
+        """Recompute the live rows past the index snapshot"""
+        rows = np.arange(self.index.ntotal, len(self.store), dtype='int64')
+        if self.tombstones and len(rows):
+            rows = rows[~np.isin(rows, np.fromiter(self.tombstones, dtype='int64'))]
+        self._delta_rows = rows
+
+    async def sync(self, force: bool = False):
+        """
+        Load changes other workers have published
+
+        Searches check at most every VECTOR_RELOAD_INTERVAL seconds and keep
+        the current state if loading fails; writers check before every
+        change (force). The new state is read in a worker thread and
+        swapped in at once, unless this worker changed the state meanwhile.
+        """
+        if not force and (
+            self._reload_lock.locked() or time.monotonic() - self._last_sync < settings.VECTOR_RELOAD_INTERVAL
+        ):
+            return
+        async with self._reload_lock:
+            self._last_sync = time.monotonic()
+            try:
+                if await asyncio.to_thread(self._disk_version) == self._synced_version:
+                    # Retry a snapshot that couldn't be written while the maintenance lock was busy
+                    self._maybe_schedule_snapshot()
+                    return
+                serial = self._state_serial
+                state = await asyncio.to_thread(self._read_state)
+            except Exception as e:
+                if force:
+                    raise
+                logger.warning(f"Could not reload the vector store in {self.root}: {str(e)}")
+                return
+            if self._state_serial == serial:
+                self.install_state(state)
+                logger.info(
+                    f"Reloaded {self.root}/{state[0][0]}: {len(self.store)} vectors, "
+                    f"{self.index.ntotal} in the snapshot"
+                )
+
+    @asynccontextmanager
+    async def _write_locked(self):
+        """
+        Hold the write lock of this worker and of the shard on disk
+
+        Changes published by other workers are loaded first, so the change
+        is applied to the latest state.
+        """
+        async with self._write_lock:
+            # The lock is taken in a thread; if cancelled meanwhile, release it once taken
+            acquire = asyncio.ensure_future(asyncio.to_thread(self._store_lock.acquire))
+            try:
+                await asyncio.shield(acquire)
+            except asyncio.CancelledError:
+                acquire.add_done_callback(lambda _: self._store_lock.release())
+                raise
+            try:
+                await self.sync(force=True)
+                self._state_serial += 1
+                yield
+                # This worker's own change doesn't need to be reloaded
+                self._synced_version = self._disk_version()
+            except BaseException:
+                # The in-memory state may not match the disk any more
+                self._synced_version = None
+                raise
+            finally:
+                self._state_serial += 1
+                self._store_lock.release()
+
+    def _split_shared_chunks(
+        self,
+        documents: List[Tuple[str, List[Dict[str, str]], List[List[float]]]],
+        arrays: List[np.ndarray]
+    ) -> Tuple[
+        List[Tuple[str, List[Dict[str, str]], np.ndarray]], List[Tuple[str, np.ndarray, List[Dict]]], Dict[int, int]
+    ]:
+        """
+        Separate chunks whose text is already stored from new ones
+
+        Repeated text such as headers, footers and disclaimers is stored and
+        indexed once per shard; later documents reference the existing row
+        instead. Must be called under the write lock.
+
+        Returns:
+            (documents with only their new chunks, rows each document
+            references with its metadata for those chunks, content hash ->
+            row of the new chunks)
+        """
+        next_row = len(self.store)
+        new_documents, refs, new_hashes = [], [], {}
+        for (doc_id, chunks, _), embeddings_array in zip(documents, arrays):
+            if not settings.CHUNK_DEDUP:
+                new_documents.append((doc_id, chunks, embeddings_array))
+                next_row += len(chunks)
+                continue
+
+            keep, shared_rows, shared_metadata = [], [], []
+            for i, chunk in enumerate(chunks):
+                content_hash = ChunkStore.content_hash(chunk["content"])
+                row = self.chunk_rows.get(content_hash, new_hashes.get(content_hash))
+                if row is None:
+                    new_hashes[content_hash] = next_row
+                    next_row += 1
+                    keep.append(i)
+                else:
+                    shared_rows.append(row)
+                    shared_metadata.append(chunk["metadata"])
+
+            new_documents.append((doc_id, [chunks[i] for i in keep], embeddings_array[keep]))
+            if shared_rows:
+                refs.append((doc_id, np.array(shared_rows, dtype='int64'), shared_metadata))
+        return new_documents, refs, new_hashes
+
+    async def add_documents(self, documents: List[Tuple[str, List[Dict[str, str]], List[List[float]]]]):
+        """Add embedded documents to this shard in one write"""
+        arrays = [
+            np.array(embeddings, dtype='float32').reshape(-1, self.store.dimension)
+            for _, _, embeddings in documents
+        ]
+
+        async with self._write_locked():
+            new_documents, refs, new_hashes = self._split_shared_chunks(documents, arrays)
+            restored = [doc_id for doc_id, _, _ in documents if doc_id in self.deleted_documents]
+
+            # Append chunks and vectors to the store with one manifest write;
+            # row N of the store is vector ID N. Rows past the index
+            # snapshot are searched exactly until the next snapshot
+            ref = self.store.num_refs
+            ranges = await asyncio.to_thread(self.store.append_many, new_documents, refs, (), restored)
+            self.deleted_documents.difference_update(restored)
+            new_vectors = sum(len(chunks) for _, chunks, _ in new_documents)
+            for (doc_id, _, _), doc_range in zip(new_documents, ranges):
+                self.document_ranges[doc_id] = doc_range
+            for doc_id, rows, _ in refs:
+                self.document_refs[doc_id] = rows
+                for row in rows.tolist():
+                    self.shared_rows.setdefault(row, {}).setdefault(doc_id, ref)
+                    ref += 1
+            self.chunk_rows.update(new_hashes)
+            self._update_delta_rows()
+
+        shared = sum(len(rows) for _, rows, _ in refs)
+        if shared:
+            logger.info(f"Stored {new_vectors} new chunks, referenced {shared} already stored chunks")
+        self._maybe_schedule_snapshot()
+
+    async def delete_document(self, doc_id: str):
+        """
+        Mark a document's vectors as tombstones; searches skip them and a
+        background compaction removes them from the index later
+        """
+        async with self._write_locked():
+            doc_range = self.document_ranges.pop(doc_id, None)
+            if doc_range is None:
+                return
+
+            shared_rows = set(self.document_refs.pop(doc_id, np.empty(0, dtype='int64')).tolist())
+            for row in shared_rows:
+                referrers = self.shared_rows[row]
+                referrers.pop(doc_id, None)
+                if not referrers:
+                    del self.shared_rows[row]
+            self.deleted_documents.add(doc_id)
+
+            # Rows other documents still reference stay live until the last
+            # of them is deleted
+            rows = [row for row in range(*doc_range) if row not in self.shared_rows]
+            rows.extend(
+                row for row in shared_rows
+                if row not in self.shared_rows and self.store.doc_id(row) in self.deleted_documents
+            )
+            rows = np.unique(np.array(rows, dtype='int64'))
+
+            await asyncio.to_thread(self.store.mark_deleted, rows, [doc_id])
+            self.tombstones.update(rows.tolist())
+            for row, content_hash in zip(rows.tolist(), self.store.hashes[rows].tolist()):
+                if self.chunk_rows.get(content_hash) == row:
+                    del self.chunk_rows[content_hash]
+            self._apply_tombstones(rows)
+            self._update_delta_rows()
+
+        self._maybe_schedule_compaction()
+
+    async def _compact(self):
+        """
+        Physically remove tombstoned chunks from the store and the index
+
+        Surviving rows are copied into a new generation in a worker thread,
+        so searches keep running against the old one meanwhile. Rows are
+        append-only, so only documents added or deleted during the copy, by
+        any worker, have to be carried over under the write lock before the
+        swap. Only the worker holding the maintenance lock compacts; the
+        others load the new generation when they next check for changes.
+        """
+        if not await asyncio.to_thread(self._maintenance_lock.acquire, False):
+            return
+        new_store = None
+        published = False
+        try:
+            async with self._write_locked():
+                old_store = self.store
+                snapshot_total = len(old_store)
+                live = np.ones(snapshot_total, dtype=bool)
+                live[np.fromiter(self.tombstones, dtype='int64')] = False
+                keep_rows = np.flatnonzero(live)
+                new_store = ChunkStore(
+                    os.path.join(self.root, self._next_generation_name()), dimension=old_store.dimension
+                )
+
+            await asyncio.to_thread(old_store.copy_rows, keep_rows, new_store)
+            await asyncio.to_thread(_write_snapshot, new_store, len(new_store))
+
+            async with self._write_locked():
+                # Carry over rows added while the new generation was being
+                # built; they are searched past the new snapshot
+                added_rows = np.arange(snapshot_total, len(self.store))
+                if len(added_rows):
+                    await asyncio.to_thread(self.store.copy_rows, added_rows, new_store)
+
+                # Documents deleted during the rebuild are still in the new generation
+                old_rows = np.concatenate([keep_rows, added_rows])
+                deleted_rows = np.flatnonzero(np.isin(old_rows, np.fromiter(self.tombstones, dtype='int64')))
+                if len(deleted_rows):
+                    await asyncio.to_thread(new_store.mark_deleted, deleted_rows)
+
+                # Shared-chunk references point at old row IDs; deleted documents
+                # copied over still own rows that live documents reference
+                refs: Dict[str, Tuple[List[int], List[Optional[Dict]]]] = {}
+                for row, referrers in self.shared_rows.items():
+                    for doc_id, ref in referrers.items():
+                        rows, metadata = refs.setdefault(doc_id, ([], []))
+                        rows.append(row)
+                        metadata.append(self.store.ref_metadata(ref))
+                await asyncio.to_thread(
+                    new_store.add_refs,
+                    [
+                        (doc_id, np.searchsorted(old_rows, np.array(rows, dtype='int64')), metadata)
+                        for doc_id, (rows, metadata) in refs.items()
+                    ],
+                    [doc_id for doc_id in new_store.doc_ids if doc_id in self.deleted_documents],
+                )
+
+                self._publish_generation(os.path.basename(new_store.path))
+                published = True
+                self.install_state(await asyncio.to_thread(self._read_state, True))
+
+            # Searches may still hold the old mmaps; unlinking is safe on POSIX
+            await asyncio.to_thread(shutil.rmtree, old_store.path, True)
+            logger.info(f"Compacted {self.root} to {len(self.store)} vectors")
+
+            # Deletes that landed during the rebuild may already call for another pass
+            asyncio.get_running_loop().call_soon(self._maybe_schedule_compaction)
+
+        except Exception as e:
+            logger.error(f"Error compacting vector index: {str(e)}", exc_info=True)
+        finally:
+            # Drop a half-built generation if the rebuild failed or was cancelled
+            if new_store is not None and not published:
+                shutil.rmtree(new_store.path, ignore_errors=True)
+            self._maintenance_lock.release()
+
+    def _maybe_schedule_compaction(self):
+        """Start a background compaction once enough of the shard is tombstoned"""
+        if self._compaction_task is not None and not self._compaction_task.done():
+            return
+        if len(self.store) and len(self.tombstones) / len(self.store) > settings.VECTOR_COMPACTION_THRESHOLD:
+            logger.info(
+                f"Scheduling compaction of {self.root}: {len(self.tombstones)}/{len(self.store)} vectors tombstoned"
+            )
+            self._compaction_task = asyncio.create_task(self._compact())
+
+    async def _update_snapshot(self):
+        """
+        Write a new index snapshot covering every row of the store
+
+        Built in a worker thread while searches keep using the mapped
+        snapshot and the exact search over the rows past it; other workers
+        map the new file when they next check for changes. Also switches a
+        flat index to HNSW once the shard outgrows it.
+        """
+        if not await asyncio.to_thread(self._maintenance_lock.acquire, False):
+            return
+        try:
+            current_store = self.store
+            await asyncio.to_thread(_write_snapshot, current_store, len(current_store))
+            new_index = await asyncio.to_thread(_read_saved_index, current_store.path)
+
+            async with self._write_lock:
+                if self.store.path != current_store.path:
+                    return
+                with self._state_lock:
+                    self.index = new_index
+                    self._apply_tombstones(np.fromiter(self.tombstones, dtype='int64'))
+                    self._update_delta_rows()
+                self._state_serial += 1
+                if self._synced_version is not None:
+                    self._synced_version = (
+                        *self._synced_version[:2], _file_version(_index_path(self.store.path))
+                    )
+            logger.info(f"Wrote index snapshot of {self.index.ntotal} vectors ({type(self.index).__name__}) in {self.root}")
+
+            # Rows appended while it was written may already call for another
+            asyncio.get_running_loop().call_soon(self._maybe_schedule_snapshot)
+
+        except Exception as e:
+            logger.error(f"Error writing vector index snapshot: {str(e)}", exc_info=True)
+        finally:
+            self._maintenance_lock.release()
+
+    def _maybe_schedule_snapshot(self):
+        """Start writing a new index snapshot once it is outdated"""
+        if not _snapshot_outdated(self.index, self.store):
+            return
+        # A running compaction writes a snapshot of its own
+        for task in (self._snapshot_task, self._compaction_task):
+            if task is not None and not task.done():
+                return
+        self._snapshot_task = asyncio.create_task(self._update_snapshot())
+
+    def search(
+        self,
+        query_embeddings: np.ndarray,
+        file_id: Optional[str],
+        similarity_threshold: float,
+        top_k: int
+    ) -> List[List[Tuple[float, Dict[str, str]]]]:
+        """
+        Search the shard for each query embedding
+
+        Returns:
+            For each query, up to top_k (distance, chunk) pairs nearest first
+        """
+        with self._state_lock:
+            current_store, current_index = self.store, self.index
+            tombstones, delta_rows, live_selector = self.tombstones, self._delta_rows, self._live_selector
+            document_ranges, document_refs = self.document_ranges, self.document_refs
+            shared, deleted_documents = self.shared_rows, self.deleted_documents
+        no_results = [[] for _ in range(len(query_embeddings))]
+
+        if file_id:
+            # Only scan the vectors that belong to the requested document
+            if file_id not in document_ranges:
+                return no_results
+            start, end = document_ranges[file_id]
+            shared_rows = document_refs.get(file_id)
+            if shared_rows is not None:
+                file_rows = np.union1d(np.arange(start, end), shared_rows)
+                available = len(file_rows)
+            else:
+                available = end - start
+        else:
+            available = len(current_store) - len(tombstones)
+        k = min(top_k, available)
+        if k <= 0:
+            return no_results
+
+        # Reduced-precision indexes over-fetch candidates for exact re-ranking
+        rescore = settings.VECTOR_PRECISION != "float32" and settings.VECTOR_RESCORE_FACTOR > 1
+        k_search = min(k * settings.VECTOR_RESCORE_FACTOR, available) if rescore else k
+
+        if file_id and (_is_ann(current_index) or shared_rows is not None or end > current_index.ntotal):
+            # A graph search can't be restricted to a row range, nor a range
+            # search extended to shared rows or to rows past the snapshot; one
+            # document is small enough to scan exactly
+            if shared_rows is None:
+                file_rows = np.arange(start, end)
+            distances, indices = _search_rows(current_store, query_embeddings, file_rows, k)
+            rescore = False
+        elif not current_index.ntotal:
+            distances = np.empty((len(query_embeddings), 0), dtype=np.float32)
+            indices = np.empty((len(query_embeddings), 0), dtype=np.int64)
+        elif settings.VECTOR_DB == "numpy":
+            # similarity = 1 / (1 + distance), so the threshold is a distance bound
+            max_distance = 1.0 / similarity_threshold - 1.0 if similarity_threshold > 0 and not rescore else None
+            distances, indices = current_index.search(
+                query_embeddings, k_search, max_distance=max_distance,
+                rows=(start, end) if file_id else None
+            )
+        else:
+            if file_id:
+                params = faiss.SearchParameters(sel=faiss.IDSelectorRange(start, end))
+            elif _is_ann(current_index):
+                # efSearch must be at least k for the graph search to return k results
+                params = faiss.SearchParametersHNSW(efSearch=max(settings.HNSW_EF_SEARCH, k_search))
+                if live_selector:
+                    params.sel = live_selector[0]
+            else:
+                params = faiss.SearchParameters(sel=live_selector[0]) if live_selector else None
+            distances, indices = current_index.search(query_embeddings, k_search, params=params)
+
+        if not file_id and len(delta_rows):
+            # Rows added since the snapshot was written are only in the store
+            delta_distances, delta_indices = _search_rows(current_store, query_embeddings, delta_rows, k_search)
+            distances, indices = _merge_results(distances, indices, delta_distances, delta_indices, k_search)
+
+        if rescore:
+            distances, indices = _rescore(current_store, query_embeddings, indices, k)
+
+        # Filter and format results
+        all_chunks = []
+        for q in range(len(query_embeddings)):
+            chunks = []
+            for i, idx in enumerate(indices[q]):
+                # Skip if index is invalid
+                if idx == -1 or idx in tombstones:
+                    continue
+
+                # Calculate similarity (convert distance to similarity)
+                distance = float(distances[q][i])
+                similarity = 1.0 / (1.0 + distance)
+
+                # Results are sorted by distance, so the rest are below the threshold too
+                if similarity < similarity_threshold:
+                    break
+
+                # Get document data
+                doc_data = current_store.get(int(idx))
+                metadata = _chunk_metadata(current_store, doc_data, shared.get(int(idx)), file_id, deleted_documents)
+                if metadata is None:
+                    continue
+                chunks.append((distance, {"content": doc_data["content"], "metadata": metadata}))
+            all_chunks.append(chunks)
+
+        return all_chunks
+
+# Files written by earlier versions, imported once into the first generation
+legacy_index_path = os.path.join(settings.VECTOR_DB_PATH, "faiss_index.bin")
+legacy_metadata_path = os.path.join(settings.VECTOR_DB_PATH, "metadata.pickle")
+legacy_tombstones_path = os.path.join(settings.VECTOR_DB_PATH, "tombstones.npy")
@@ -1,128 +1,254 @@
 import os
-from typing import List, Dict, Optional
-# import faiss
+import heapq
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from itertools import islice
+from typing import List, Dict, Optional, Tuple
 import numpy as np
-import chromadb
-from chromadb.utils import embedding_functions
-import json
-import pickle
+from prometheus_client import Gauge
 from app.config import settings
+from app.core.answer_cache import answer_cache
 from app.core.embedding import get_embeddings, get_single_embedding
 from app.utils.logger import get_logger
+from app.utils.metrics import stage_timer
 
 logger = get_logger(__name__)
 
 # Ensure vector DB directory exists
 os.makedirs(settings.VECTOR_DB_PATH, exist_ok=True)
 
-# Choose vector DB based on config
+# Choose vector DB based on config; the client or the shards are opened
+# by load_vector_store(), not at import
 if settings.VECTOR_DB == "chroma":
-    # Initialize ChromaDB
+    collection = None
+
+else:  # Local index: FAISS (default) or NumPy
+    from app.db.vector_shard import VectorShard
+    
+    # Documents are partitioned into VECTOR_SHARDS shards by a hash of their
+    # ID; each shard is a separate store, index and set of locks. A single
+    # shard keeps the layout of unsharded stores
+    shard_count = settings.VECTOR_SHARDS
+    shards: List[VectorShard] = []
+    # Number of shards the store on disk was created with
+    shard_count_path = os.path.join(settings.VECTOR_DB_PATH, "SHARDS")
+    # Where the single store was kept before the NumPy backend was added
+    legacy_store_root = os.path.join(settings.VECTOR_DB_PATH, "faiss")
+    
+    # Searches run off the event loop, a global one on every shard at once;
+    # FAISS and NumPy release the GIL while they scan
+    _search_pool = None
+
+_loaded = False
+_load_lock = asyncio.Lock()
+
+def _shard_of(doc_id: str) -> int:
+    """Index of the shard that owns a document"""
+    digest = blake2b(doc_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % shard_count
+
+def _shard_root(i: int) -> str:
+    if shard_count == 1:
+        return os.path.join(settings.VECTOR_DB_PATH, "chunks")
+    return os.path.join(settings.VECTOR_DB_PATH, "shards", f"shard-{i:03d}")
+
+def _migrate_legacy_layout():
+    """Move a store written under VECTOR_DB_PATH/faiss to where a single shard is kept"""
+    single_root = os.path.join(settings.VECTOR_DB_PATH, "chunks")
+    if not os.path.exists(os.path.join(legacy_store_root, "CURRENT")):
+        return
+    if os.path.exists(single_root):
+        logger.warning(f"Ignoring {legacy_store_root}: {single_root} already exists")
+        return
+    try:
+        os.rename(legacy_store_root, single_root)
+        logger.info(f"Moved the vector store from {legacy_store_root} to {single_root}")
+    except FileNotFoundError:
+        # Another worker moved it first
+        pass
+
+def _check_shard_count():
+    """Record the shard count of a new store, or check that it matches the existing one"""
+    if os.path.exists(shard_count_path):
+        with open(shard_count_path, "r", encoding="utf-8") as f:
+            existing = int(f.read().strip())
+    elif os.path.exists(os.path.join(settings.VECTOR_DB_PATH, "chunks", "CURRENT")):
+        # Stores written before sharding are a single shard
+        existing = 1
+    else:
+        existing = shard_count
+        tmp_path = shard_count_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(shard_count))
+        os.replace(tmp_path, shard_count_path)
+    if existing != shard_count:
+        raise Exception(
+            f"VECTOR_SHARDS={shard_count} khác với số shard của vector store hiện có ({existing}); "
+            f"hãy đặt lại VECTOR_SHARDS={existing} hoặc tạo lại vector store"
+        )
+
+def _connect_chroma():
+    """Open the ChromaDB collection"""
+    global collection
+    import chromadb
+    from chromadb.utils import embedding_functions
+    
     chroma_client = chromadb.PersistentClient(path=settings.VECTOR_DB_PATH)
     openai_ef = embedding_functions.OpenAIEmbeddingFunction(
         api_key=settings.OPENAI_API_KEY,
         model_name=settings.EMBEDDING_MODEL
     )
+    collection = chroma_client.get_or_create_collection(
+        name="document_chunks",
+        embedding_function=openai_ef
+    )
+
+def _open_shards() -> List[Tuple["VectorShard", Tuple]]:
+    """Open every shard, creating or recovering it first, and read its state"""
+    _migrate_legacy_layout()
+    _check_shard_count()
+    opened = []
+    for i in range(shard_count):
+        shard = VectorShard(_shard_root(i), owns=lambda doc_id, i=i: _shard_of(doc_id) == i)
+        opened.append((shard, shard.load()))
+    return opened
+
+async def load_vector_store():
+    """
+    Open the vector store on first use
     
-    # Create or get collection
-    try:
-        collection = chroma_client.get_or_create_collection(
-            name="document_chunks",
-            embedding_function=openai_ef
-        )
-    except Exception as e:
-        logger.error(f"Error initializing ChromaDB: {str(e)}", exc_info=True)
-        raise Exception(f"Lỗi khởi tạo ChromaDB: {str(e)}")
-    
-else:  # Default to FAISS
-    # Initialize FAISS
-    faiss_index_path = os.path.join(settings.VECTOR_DB_PATH, "faiss_index.bin")
-    metadata_path = os.path.join(settings.VECTOR_DB_PATH, "metadata.pickle")
-    
-    try:
-        if os.path.exists(faiss_index_path):
-            # Load existing index
-            index = faiss.read_index(faiss_index_path)
-            with open(metadata_path, 'rb') as f:
-                document_metadata = pickle.load(f)
-        else:
-            # Create new index
-            dimension = 1536  # Dimension for text-embedding-3-small
-            index = faiss.IndexFlatL2(dimension)
-            document_metadata = {}
-    except Exception as e:
-        logger.error(f"Error initializing FAISS: {str(e)}", exc_info=True)
-        raise Exception(f"Lỗi khởi tạo FAISS: {str(e)}")
+    Called from the application's warm-up so the first request doesn't
+    wait for it; every entry point below calls it too. Safe to call
+    concurrently and repeatedly.
+    """
+    global _loaded, _search_pool
+    if _loaded:
+        return
+    async with _load_lock:
+        if _loaded:
+            return
+        try:
+            if settings.VECTOR_DB == "chroma":
+                await asyncio.to_thread(_connect_chroma)
+            else:
+                if "FAISS_COMPACTION_THRESHOLD" in os.environ:
+                    logger.warning("FAISS_COMPACTION_THRESHOLD is deprecated, set VECTOR_COMPACTION_THRESHOLD instead")
+                opened = await asyncio.to_thread(_open_shards)
+                for shard, state in opened:
+                    shard.install_state(state)
+                shards.extend(shard for shard, _ in opened)
+                _search_pool = ThreadPoolExecutor(
+                    max_workers=max(shard_count, os.cpu_count() or 1), thread_name_prefix="vector-search"
+                )
+            _loaded = True
+            logger.info("Vector store loaded")
+        except Exception as e:
+            logger.error(f"Error initializing vector store: {str(e)}", exc_info=True)
+            raise Exception(f"Lỗi khởi tạo vector store: {str(e)}")
+
+def shutdown_search_pool():
+    """Stop the shard search threads"""
+    global _search_pool
+    if settings.VECTOR_DB != "chroma" and _search_pool is not None:
+        _search_pool.shutdown(wait=False)
+        _search_pool = None
 
-async def add_document_to_vectordb(doc_id: str, chunks: List[Dict[str, str]]) -> str:
+# Index size, read from the live shards when /metrics is scraped
+INDEX_VECTORS = Gauge("chatbot_index_vectors", "Vectors in the index, including tombstoned ones")
+INDEX_TOMBSTONES = Gauge("chatbot_index_tombstones", "Deleted vectors awaiting compaction")
+INDEX_DOCUMENTS = Gauge("chatbot_index_documents", "Documents in the vector store")
+if settings.VECTOR_DB == "chroma":
+    INDEX_VECTORS.set_function(lambda: collection.count() if collection is not None else 0)
+else:
+    INDEX_VECTORS.set_function(lambda: sum(len(shard.store) for shard in shards))
+    INDEX_TOMBSTONES.set_function(lambda: sum(len(shard.tombstones) for shard in shards))
+    INDEX_DOCUMENTS.set_function(lambda: sum(len(shard.document_ranges) for shard in shards))
+
+async def add_document_to_vectordb(
+    doc_id: str,
+    chunks: List[Dict[str, str]],
+    embeddings: Optional[List[List[float]]] = None
+) -> str:
     """
     Add document chunks to vector database
     
     Args:
         doc_id: Document ID
         chunks: List of text chunks with metadata
-        
+        embeddings: Precomputed chunk embeddings; generated when omitted
+    
     Returns:
         Vector store ID
     """
     try:
-        # Extract text from chunks
-        texts = [chunk["content"] for chunk in chunks]
-        
         # Generate embeddings
-        embeddings = await get_embeddings(texts)
-        
-        if settings.VECTOR_DB == "chroma":
-            # Add to ChromaDB
-            ids = [f"{doc_id}_{i}" for i in range(len(chunks))]
-            
-            # Thêm doc_id vào metadata
-            metadatas = []
-            for chunk in chunks:
-                # Thêm trường doc_id vào metadata
-                metadata = chunk["metadata"].copy()
-                metadata["doc_id"] = doc_id
-                metadatas.append(metadata)
-            
-            # Log để debug
-            logger.info(f"Adding document to ChromaDB with doc_id: {doc_id}")
-            logger.info(f"First metadata example: {metadatas[0] if metadatas else 'No metadata'}")
-            
-            collection.add(
-                ids=ids,
-                embeddings=embeddings,
-                documents=texts,
-                metadatas=metadatas
-            )
-            
-        else:  # FAISS
-            # Convert embeddings to numpy array
-            embeddings_array = np.array(embeddings).astype('float32')
-            
-            # Get current index size
-            current_size = index.ntotal
-            
-            # Add embeddings to FAISS index
-            index.add(embeddings_array)
+        if embeddings is None:
+            embeddings = await get_embeddings([chunk["content"] for chunk in chunks])
+    
+    except Exception as e:
+        logger.error(f"Error adding document to vector DB: {str(e)}", exc_info=True)
+        raise Exception(f"Lỗi khi thêm tài liệu vào vector DB: {str(e)}")
+    
+    return (await add_documents_to_vectordb([(doc_id, chunks, embeddings)]))[0]
+
+async def add_documents_to_vectordb(
+    documents: List[Tuple[str, List[Dict[str, str]], List[List[float]]]]
+) -> List[str]:
+    """
+    Add several embedded documents to the vector database in one write
+    
+    Args:
+        documents: (doc_id, chunks, embeddings) for each document
+    
+    Returns:
+        Vector store ID of each document
+    """
+    try:
+        await load_vector_store()
+        with stage_timer("vector_write"):
+            if settings.VECTOR_DB == "chroma":
+                # Add to ChromaDB
+                ids, texts, all_embeddings, metadatas = [], [], [], []
+                for doc_id, chunks, embeddings in documents:
+                    ids.extend(f"{doc_id}_{i}" for i in range(len(chunks)))
+                    texts.extend(chunk["content"] for chunk in chunks)
+                    all_embeddings.extend(embeddings)
+                
+                    for chunk in chunks:
+                        # Thêm trường doc_id vào metadata
+                        metadata = chunk["metadata"].copy()
+                        metadata["doc_id"] = doc_id
+                        metadatas.append(metadata)
             
-            # Store metadata
-            for i, chunk in enumerate(chunks):
-                idx = current_size + i
-                document_metadata[idx] = {
-                    "doc_id": doc_id,
-                    "content": chunk["content"],
-                    "metadata": chunk["metadata"]
-                }
+                # Log để debug
+                logger.info(f"Adding {len(documents)} documents to ChromaDB")
+                logger.info(f"First metadata example: {metadatas[0] if metadatas else 'No metadata'}")
             
-            # Save index and metadata
-            faiss.write_index(index, faiss_index_path)
-            with open(metadata_path, 'wb') as f:
-                pickle.dump(document_metadata, f)
+                if ids:
+                    collection.add(
+                        ids=ids,
+                        embeddings=all_embeddings,
+                        documents=texts,
+                        metadatas=metadatas
+                    )
+        
+            else:  # FAISS / NumPy
+                # Each shard appends its documents in one write; shards
+                # are written concurrently
+                by_shard: Dict[int, List[Tuple[str, List[Dict[str, str]], List[List[float]]]]] = {}
+                for document in documents:
+                    by_shard.setdefault(_shard_of(document[0]), []).append(document)
+                await asyncio.gather(*(
+                    shards[i].add_documents(shard_documents) for i, shard_documents in by_shard.items()
+                ))
         
-        return doc_id
+            # Cached answers may be based on an earlier version of these documents
+            answer_cache.invalidate_documents(doc_id for doc_id, _, _ in documents)
+            return [doc_id for doc_id, _, _ in documents]
     
     except Exception as e:
-        logger.error(f"Error adding document to vector DB: {str(e)}", exc_info=True)
+        logger.error(f"Error adding documents to vector DB: {str(e)}", exc_info=True)
         raise Exception(f"Lỗi khi thêm tài liệu vào vector DB: {str(e)}")
 
 async def delete_document_from_vectordb(doc_id: str) -> bool:
@@ -131,68 +257,106 @@ async def delete_document_from_vectordb(doc_id: str) -> bool:
     
     Args:
         doc_id: Document ID
-        
+    
     Returns:
         True if successful
     """
     try:
-        if settings.VECTOR_DB == "chroma":
-            # Delete from ChromaDB
-            collection.delete(where={"doc_id": doc_id})
-            
-        else:  # FAISS
-            # FAISS doesn't support direct deletion
-            # We need to rebuild the index excluding the document
-            global index, document_metadata  # Chỉ khai báo global một lần ở đây
-            
-            # Filter out document metadata
-            new_metadata = {}
-            indices_to_keep = []
-            
-            for idx, data in document_metadata.items():
-                if data["doc_id"] != doc_id:
-                    new_metadata[len(indices_to_keep)] = data
-                    indices_to_keep.append(idx)
-            
-            if indices_to_keep:
-                # Get vectors to keep
-                vectors_to_keep = index.reconstruct_batch(np.array(indices_to_keep))
-                
-                # Create new index
-                dimension = vectors_to_keep.shape[1]
-                new_index = faiss.IndexFlatL2(dimension)
-                new_index.add(vectors_to_keep)
-                
-                # Replace old index and metadata
-                index = new_index
-                document_metadata = new_metadata
-                
-                # Save to disk
-                faiss.write_index(index, faiss_index_path)
-                with open(metadata_path, 'wb') as f:
-                    pickle.dump(document_metadata, f)
-            else:
-                # If all documents are deleted, create empty index
-                dimension = 1536
-                index = faiss.IndexFlatL2(dimension)
-                document_metadata = {}
-                
-                # Save to disk
-                faiss.write_index(index, faiss_index_path)
-                with open(metadata_path, 'wb') as f:
-                    pickle.dump(document_metadata, f)
+        await load_vector_store()
+        with stage_timer("vector_delete"):
+            if settings.VECTOR_DB == "chroma":
+                # Delete from ChromaDB
+                collection.delete(where={"doc_id": doc_id})
+        
+            else:  # FAISS / NumPy
+                # Only the owning shard holds the document's chunks
+                await shards[_shard_of(doc_id)].delete_document(doc_id)
         
-        return True
+            answer_cache.invalidate_documents([doc_id])
+            return True
     
     except Exception as e:
         logger.error(f"Error deleting document from vector DB: {str(e)}", exc_info=True)
         raise Exception(f"Lỗi khi xóa tài liệu từ vector DB: {str(e)}")
 
+def _search_chroma(
+    query_embeddings: List[List[float]],
+    file_id: Optional[str],
+    similarity_threshold: float,
+    top_k: int
+) -> List[List[Dict[str, str]]]:
+    """Search ChromaDB for each query embedding"""
+    where_filter = {"doc_id": file_id} if file_id else None
+    
+    # Log query parameters
+    logger.info(f"Search parameters: file_id={file_id}, threshold={similarity_threshold}, top_k={top_k}")
+    logger.info(f"Where filter: {where_filter}")
+    
+    results = collection.query(
+        query_embeddings=query_embeddings,
+        n_results=top_k,
+        where=where_filter
+    )
+    
+    all_chunks = []
+    for q in range(len(query_embeddings)):
+        # Log results
+        num_results = len(results['documents'][q]) if results['documents'] else 0
+        logger.info(f"Query returned {num_results} raw results")
+        
+        chunks = []
+        for i in range(num_results):
+            # Only include if above similarity threshold
+            distance = results['distances'][q][i]
+            similarity = 1.0 / (1.0 + distance)
+            
+            logger.info(f"Result {i}: distance={distance}, similarity={similarity}")
+            
+            if similarity >= similarity_threshold:
+                chunks.append({
+                    "content": results['documents'][q][i],
+                    "metadata": results['metadatas'][q][i]
+                })
+        
+        logger.info(f"Returning {len(chunks)} chunks after threshold filtering")
+        all_chunks.append(chunks)
+    
+    return all_chunks
+
+async def _search_shards(
+    query_embeddings: np.ndarray,
+    file_id: Optional[str],
+    similarity_threshold: float,
+    top_k: int
+) -> List[List[Dict[str, str]]]:
+    """
+    Search the local shards for each query embedding
+    
+    A file_id search only queries the shard that owns the document. A
+    global search queries every shard and merges their nearest-first
+    results into the overall top_k. Shards are searched in the search
+    thread pool, never on the event loop: even a single shard may scan up
+    to VECTOR_SNAPSHOT_ROWS rows past its snapshot exactly.
+    """
+    await asyncio.gather(*(shard.sync() for shard in shards))
+    targets = [shards[_shard_of(file_id)]] if file_id else shards
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(
+        loop.run_in_executor(_search_pool, shard.search, query_embeddings, file_id, similarity_threshold, top_k)
+        for shard in targets
+    ))
+    
+    return [
+        [chunk for _, chunk in islice(heapq.merge(*(result[q] for result in results), key=lambda hit: hit[0]), top_k)]
+        for q in range(len(query_embeddings))
+    ]
+
 async def search_similar_chunks(
-    query: str, 
+    query: str,
     file_id: Optional[str] = None,
     similarity_threshold: float = 0.7,
-    top_k: int = 3
+    top_k: int = 3,
+    query_embedding: Optional[List[float]] = None
 ) -> List[Dict[str, str]]:
     """
     Search for chunks similar to the query
@@ -202,84 +366,66 @@ async def search_similar_chunks(
         file_id: Optional file ID to filter results
         similarity_threshold: Minimum similarity score
         top_k: Maximum number of results
-        
+        query_embedding: Precomputed query embedding; generated when omitted
+    
     Returns:
         List of relevant text chunks
     """
     try:
+        await load_vector_store()
         # Generate embedding for query
-        query_embedding = await get_single_embedding(query)
+        if query_embedding is None:
+            with stage_timer("query_embed"):
+                query_embedding = await get_single_embedding(query)
         
-        if settings.VECTOR_DB == "chroma":
-            # Search in ChromaDB
-            where_filter = {"doc_id": file_id} if file_id else None
-            
-            # Log query parameters
-            logger.info(f"Searching with query: '{query[:30]}...'")
-            logger.info(f"Search parameters: file_id={file_id}, threshold={similarity_threshold}, top_k={top_k}")
-            logger.info(f"Where filter: {where_filter}")
-            
-            results = collection.query(
-                query_embeddings=[query_embedding],
-                n_results=top_k,
-                where=where_filter
-            )
-            
-            # Log results
-            num_results = len(results['documents'][0]) if results['documents'] else 0
-            logger.info(f"Query returned {num_results} raw results")
+        with stage_timer("vector_search"):
+            if settings.VECTOR_DB == "chroma":
+                logger.info(f"Searching with query: '{query[:30]}...'")
+                return _search_chroma([query_embedding], file_id, similarity_threshold, top_k)[0]
             
-            chunks = []
-            for i in range(len(results['documents'][0]) if results['documents'] else 0):
-                # Only include if above similarity threshold
-                distance = results['distances'][0][i]
-                similarity = 1.0 / (1.0 + distance)
-                
-                logger.info(f"Result {i}: distance={distance}, similarity={similarity}")
-                
-                if similarity >= similarity_threshold:
-                    chunks.append({
-                        "content": results['documents'][0][i],
-                        "metadata": results['metadatas'][0][i]
-                    })
-            
-            logger.info(f"Returning {len(chunks)} chunks after threshold filtering")
-            
-        else:  # FAISS
-            # Search in FAISS
             query_embedding_array = np.array([query_embedding]).astype('float32')
-            distances, indices = index.search(query_embedding_array, index.ntotal)
-            
-            # Filter and format results
-            chunks = []
-            for i, idx in enumerate(indices[0]):
-                # Skip if index is invalid
-                if idx == -1 or idx >= len(document_metadata):
-                    continue
-                    
-                # Get document data
-                doc_data = document_metadata[idx]
-                
-                # Skip if not from requested file
-                if file_id and doc_data["doc_id"] != file_id:
-                    continue
-                
-                # Calculate similarity (convert distance to similarity)
-                distance = distances[0][i]
-                similarity = 1.0 / (1.0 + distance)
-                
-                # Only include if above similarity threshold
-                if similarity >= similarity_threshold:
-                    chunks.append({
-                        "content": doc_data["content"],
-                        "metadata": doc_data["metadata"]
-                    })
-                    
-                    # Stop if we have enough results
-                    if len(chunks) >= top_k:
-                        break
+            return (await _search_shards(query_embedding_array, file_id, similarity_threshold, top_k))[0]
+    
+    except Exception as e:
+        logger.error(f"Error searching vector DB: {str(e)}", exc_info=True)
+        raise Exception(f"Lỗi khi tìm kiếm trong vector DB: {str(e)}")
+
+async def search_similar_chunks_batch(
+    queries: List[str],
+    file_id: Optional[str] = None,
+    similarity_threshold: float = 0.7,
+    top_k: int = 3
+) -> List[List[Dict[str, str]]]:
+    """
+    Search for chunks similar to each of several queries at once
+    
+    The queries are embedded in batched requests and searched with a
+    single multi-query index call per shard.
+    
+    Args:
+        queries: Search queries
+        file_id: Optional file ID to filter results
+        similarity_threshold: Minimum similarity score
+        top_k: Maximum number of results per query
+    
+    Returns:
+        One list of relevant text chunks per query, in input order
+    """
+    if not queries:
+        return []
+    
+    try:
+        await load_vector_store()
+        with stage_timer("query_embed"):
+            query_embeddings = await get_embeddings(queries)
         
-        return chunks
+        with stage_timer("vector_search"):
+            if settings.VECTOR_DB == "chroma":
+                logger.info(f"Searching with {len(queries)} queries")
+                return _search_chroma(query_embeddings, file_id, similarity_threshold, top_k)
+            
+            query_embeddings_array = np.array(query_embeddings).astype('float32')
+            return await _search_shards(query_embeddings_array, file_id, similarity_threshold, top_k)
     
     except Exception as e:
         logger.error(f"Error searching vector DB: {str(e)}", exc_info=True)
@@ -1,23 +1,76 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from app.api.routes import documents, qa
 from app.config import settings
 from app.utils.logger import setup_logging, get_logger
-from app.db.models import create_tables
+from app.utils.metrics import MetricsMiddleware, render_metrics
+from app.core import pdf_extraction
+from app.core.embedding import close_client
+from app.core.ingestion import shutdown_workers, start_workers
+from app.core.storage import get_backend
+from app.db.models import create_tables, engine, pool_status
+from app.db.vector_store import load_vector_store, shutdown_search_pool
 
 # Set up logging
 setup_logging()
 logger = get_logger(__name__)
 
-# Create database tables
-create_tables()
+# Warm-up progress of each component, reported by /health/ready
+_warmup = {"status": "starting", "components": {}}
+
+async def _warm_up_component(name: str, start) -> bool:
+    """Run one component's start-up and record its status and duration"""
+    started = time.perf_counter()
+    _warmup["components"][name] = {"status": "loading"}
+    try:
+        await start()
+    except Exception as e:
+        logger.error(f"Warm-up of {name} failed: {str(e)}", exc_info=True)
+        _warmup["components"][name] = {"status": "failed", "error": str(e)}
+        return False
+    _warmup["components"][name] = {"status": "ready", "seconds": round(time.perf_counter() - started, 3)}
+    return True
+
+async def _warm_up():
+    """Open the vector store and the storage backend concurrently"""
+    results = await asyncio.gather(
+        _warm_up_component("vector_store", load_vector_store),
+        _warm_up_component("storage", lambda: asyncio.to_thread(get_backend)),
+    )
+    _warmup["status"] = "ready" if all(results) else "failed"
+    logger.info(f"Warm-up finished: {_warmup}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Every database route needs the tables, so they exist before the server
+    # accepts connections
+    if not await _warm_up_component("database", create_tables):
+        raise Exception(_warmup["components"]["database"]["error"])
+    # Picks up jobs left unfinished by a previous run or a stopped worker
+    start_workers()
+    # The rest warms up in the background so the server accepts connections
+    # (and answers /health/ready) right after; requests that arrive earlier
+    # load what they need themselves
+    warmup_task = asyncio.create_task(_warm_up())
+    yield
+    warmup_task.cancel()
+    await shutdown_workers()
+    # Close pooled database and OpenAI connections and the PDF workers
+    await engine.dispose()
+    await close_client()
+    pdf_extraction.shutdown_pool()
+    shutdown_search_pool()
 
 # Initialize FastAPI app
 app = FastAPI(
     title=settings.PROJECT_NAME,
     description=settings.PROJECT_DESCRIPTION,
-    version=settings.VERSION
+    version=settings.VERSION,
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -29,6 +82,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request latency by route for /metrics
+app.add_middleware(MetricsMiddleware)
+
 # Include API routes
 app.include_router(documents.router)
 app.include_router(qa.router)
@@ -46,3 +102,19 @@ async def global_exception_handler(request: Request, exc: Exception):
 async def health_check():
     """Health check endpoint"""
     return {"status": "ok", "message": f"{settings.PROJECT_NAME} is running"}
+
+@app.get("/health/ready", tags=["Health Check"])
+async def readiness():
+    """Whether warm-up has finished; 503 with each component's status until then"""
+    return JSONResponse(status_code=200 if _warmup["status"] == "ready" else 503, content=_warmup)
+
+@app.get("/health/db", tags=["Health Check"])
+async def database_health():
+    """Database connection pool usage"""
+    return {"pool": pool_status()}
+
+@app.get("/metrics", tags=["Health Check"])
+async def metrics():
+    """Prometheus metrics: per-stage latency, request latency, tokens, cache and index size"""
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
@@ -0,0 +1,49 @@
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single process is assumed
+    fcntl = None
+
+class FileLock:
+    """
+    Exclusive advisory lock shared by every process that opens the same path
+
+    Uses flock, so the lock is released by the OS if the holder dies.
+    Not reentrant: while held, a non-blocking acquire through the same
+    instance fails and a blocking one raises, since it would never return.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Take the lock, waiting for it unless blocking is False; return whether it was taken"""
+        if self._fd is not None:
+            if not blocking:
+                return False
+            raise RuntimeError(f"{self.path} is already held by this process")
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                os.close(fd)
+                return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            # Closing the descriptor releases the lock
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
@@ -0,0 +1,123 @@
+import time
+from typing import Callable, Iterable, List
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.metrics_core import Metric
+
+# Latency buckets from 1 ms (index lookups) to 2 minutes (long completions, large uploads)
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+)
+
+# Stages of /ask: query_embed, vector_search, context, completion, completion_first_token
+# Stages of ingestion: extract, chunk, embed, embedding_request, vector_write,
+# storage_upload, db_save; plus vector_delete and storage_delete
+STAGE_SECONDS = Histogram(
+    "chatbot_stage_duration_seconds",
+    "Time spent in each processing stage",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+
+REQUEST_SECONDS = Histogram(
+    "chatbot_http_request_duration_seconds",
+    "HTTP request duration, including streamed response bodies",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+# kind: embedding, prompt, completion
+TOKENS = Counter("chatbot_openai_tokens", "Tokens billed by OpenAI", ["kind"])
+
+CONTEXT_TOKENS = Counter("chatbot_context_tokens", "Tokens of context sent with questions")
+CONTEXT_TOKENS_SAVED = Counter(
+    "chatbot_context_tokens_saved",
+    "Tokens of retrieved chunks left out of the context (overlap, duplicates, budget)",
+)
+
+# status: succeeded, failed, duplicate
+DOCUMENTS_INGESTED = Counter("chatbot_documents_ingested", "Documents that finished ingestion", ["status"])
+
+# Called with (stage, seconds) for every stage observation, e.g. by the
+# benchmark harness to keep raw samples for exact percentiles
+_stage_observers: List[Callable[[str, float], None]] = []
+
+def add_stage_observer(observer: Callable[[str, float], None]):
+    _stage_observers.append(observer)
+
+def observe_stage(stage: str, seconds: float):
+    """Record the time spent in a stage"""
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    for observer in _stage_observers:
+        observer(stage, seconds)
+
+class _StageTimer:
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe_stage(self.stage, time.perf_counter() - self.started)
+        return False
+
+def stage_timer(stage: str) -> _StageTimer:
+    """Context manager that records the time spent in a stage"""
+    return _StageTimer(stage)
+
+class CallbackCollector:
+    """Collector whose metrics are read from existing state at scrape time, off the hot path"""
+
+    def __init__(self, collect: Callable[[], Iterable[Metric]]):
+        self._collect = collect
+
+    def collect(self) -> Iterable[Metric]:
+        return self._collect()
+
+def register_callback(collect: Callable[[], Iterable[Metric]]):
+    REGISTRY.register(CallbackCollector(collect))
+
+def _route_path(scope) -> str:
+    """Path template of the matched route, so request metrics have bounded labels"""
+    route = scope.get("route")
+    if route is None:
+        # Older Starlette versions don't record the matched route in the scope
+        from starlette.routing import Match
+        for candidate in scope["app"].router.routes:
+            if candidate.matches(scope)[0] == Match.FULL:
+                route = candidate
+                break
+    return getattr(route, "path", "unmatched")
+
+class MetricsMiddleware:
+    """ASGI middleware that times each HTTP request by method, route and status"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_SECONDS.labels(scope["method"], _route_path(scope), str(status)).observe(
+                time.perf_counter() - started
+            )
+
+def render_metrics():
+    """Metrics in the Prometheus text format, with its content type"""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,91 @@
+"""
+Benchmark HNSW against the exact FAISS index: recall@k and p50/p99 latency
+
+Builds a synthetic clustered corpus of unit vectors, inserts it into an
+IndexHNSWFlat in document-sized batches (the way add_document_to_vectordb
+grows the index), then times single-query searches for several efSearch
+values against IndexFlatL2 as ground truth.
+
+Usage:
+    python benchmarks/bench_ann.py --size 500000 --dim 1536 --ef-search 16 32 64 128
+
+Building the graph is the slow part (minutes for a few hundred thousand
+1536-d vectors on one core); pass a smaller --size or --dim for a quick run.
+"""
+import argparse
+import time
+import faiss
+import numpy as np
+
+def make_corpus(rng, size, dim, clusters, latent_dim, projection):
+    """
+    Unit vectors around random cluster centres in a low-dimensional latent space
+
+    Text embeddings have a much lower intrinsic dimension than their width;
+    isotropic random vectors would make every method look bad.
+    """
+    centres = np.random.default_rng(1).standard_normal((clusters, latent_dim), dtype=np.float32)
+    latent = centres[rng.integers(0, clusters, size)] + 0.5 * rng.standard_normal((size, latent_dim), dtype=np.float32)
+    vectors = latent @ projection + 0.05 * rng.standard_normal((size, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def run_queries(search, queries):
+    """Search one query at a time; return the IDs and per-query latencies in ms"""
+    ids = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        _, found = search(query.reshape(1, -1))
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids.append(found[0])
+    return np.array(ids), np.array(latencies)
+
+def recall(found, truth):
+    return float(np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=200_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--latent-dim", type=int, default=64)
+    parser.add_argument("--chunks-per-doc", type=int, default=40, help="Insert batch size, ~20-page document")
+    parser.add_argument("--m", type=int, default=32, help="HNSW_M")
+    parser.add_argument("--ef-construction", type=int, default=80, help="HNSW_EF_CONSTRUCTION")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 32, 64, 128], help="HNSW_EF_SEARCH values")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    projection = rng.standard_normal((args.latent_dim, args.dim), dtype=np.float32) / np.sqrt(args.latent_dim)
+    vectors = make_corpus(rng, args.size, args.dim, args.clusters, args.latent_dim, projection)
+    queries = make_corpus(rng, args.queries, args.dim, args.clusters, args.latent_dim, projection)
+    k = args.top_k
+
+    flat = faiss.IndexFlatL2(args.dim)
+    flat.add(vectors)
+
+    hnsw = faiss.IndexHNSWFlat(args.dim, args.m)
+    hnsw.hnsw.efConstruction = args.ef_construction
+    start = time.perf_counter()
+    for offset in range(0, args.size, args.chunks_per_doc):
+        hnsw.add(vectors[offset:offset + args.chunks_per_doc])
+    build_s = time.perf_counter() - start
+
+    truth, flat_ms = run_queries(lambda q: flat.search(q, k), queries)
+
+    print(f"corpus: {args.size} x {args.dim}, {args.queries} queries, top_k={k}")
+    print(f"HNSW M={args.m} efConstruction={args.ef_construction}: "
+          f"incremental build {build_s:.1f} s ({args.size / build_s:.0f} vectors/s)")
+    print(f"{'index':>16} {'recall@' + str(k):>10} {'p50 ms':>9} {'p99 ms':>9}")
+    print(f"{'flat':>16} {1.0:>10.4f} {np.percentile(flat_ms, 50):>9.3f} {np.percentile(flat_ms, 99):>9.3f}")
+
+    for ef in args.ef_search:
+        params = faiss.SearchParametersHNSW(efSearch=max(ef, k))
+        found, hnsw_ms = run_queries(lambda q: hnsw.search(q, k, params=params), queries)
+        print(f"{'hnsw ef=' + str(ef):>16} {recall(found, truth):>10.4f} "
+              f"{np.percentile(hnsw_ms, 50):>9.3f} {np.percentile(hnsw_ms, 99):>9.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+"""
+End-to-end benchmark of ingestion and /ask without OpenAI, Firebase or Postgres
+
+Starts benchmarks/fake_openai.py in a subprocess (deterministic embeddings
+and completions with configurable latency and rate limits) and runs the
+app in this process against stand-ins: SQLite (aiosqlite) for metadata,
+STORAGE_BACKEND=local for original files and a temporary vector DB
+directory. Requests go through the ASGI app, so routes, background
+ingestion, the OpenAI client and its connection pool are all exercised.
+
+Two phases:
+  - ingest: --documents synthetic documents (benchmarks/corpus.py) are
+    uploaded with --concurrency in flight; each client waits for its
+    document's job to finish before uploading the next
+  - ask:    --questions questions built from the corpus are sent to /ask
+    (or /ask/stream) with --concurrency in flight
+
+Reports throughput and client-side latency per phase plus p50/p95/p99 of
+every stage the app instruments (extract, chunk, embed, vector_write,
+storage_upload, db_save, query_embed, vector_search, context, completion,
+...), from raw samples rather than histogram buckets. --output writes the
+results as JSON, tagged with the git commit; --compare prints the change
+against an earlier results file.
+
+Settings other than the stand-ins come from the environment as usual, e.g.
+VECTOR_DB=numpy or INGEST_WORKERS=4.
+
+Usage:
+    python benchmarks/bench_app.py --documents 200 --questions 500 --concurrency 16 --output after.json
+    python benchmarks/bench_app.py --documents 200 --questions 500 --concurrency 16 --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+import fake_openai
+from corpus import FORMATS, make_corpus, make_questions
+
+FINISHED = ("succeeded", "failed", "duplicate")
+
+def latency_summary(seconds):
+    if not seconds:
+        return {"count": 0}
+    ms = np.array(seconds) * 1000
+    return {
+        "count": len(ms),
+        "mean_ms": round(float(ms.mean()), 2),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+    }
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_fake_openai(args, port: int) -> subprocess.Popen:
+    """Run the fake in its own process so it doesn't compete with the app for the GIL"""
+    command = [
+        sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"), "--port", str(port),
+        "--dimension", str(args.dimension),
+        "--embed-latency-ms", str(args.embed_latency_ms),
+        "--embed-latency-per-input-ms", str(args.embed_latency_per_input_ms),
+        "--chat-ttft-ms", str(args.chat_ttft_ms),
+        "--chat-token-ms", str(args.chat_token_ms),
+        "--answer-tokens", str(args.answer_tokens),
+        "--rpm", str(args.rpm),
+        "--tpm", str(args.tpm),
+    ]
+    process = subprocess.Popen(command)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/stats", timeout=1).raise_for_status()
+            return process
+        except httpx.HTTPError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("fake OpenAI server did not start")
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BENCH_DIR, text=True)
+        return commit + ("-dirty" if dirty.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+async def ingest(client: httpx.AsyncClient, corpus, concurrency: int):
+    """Upload every document, each client waiting for its job before the next upload"""
+    pending = list(reversed(corpus))
+    latencies, statuses = [], defaultdict(int)
+    totals = {"chunks": 0, "rejected": 0}
+
+    async def uploader():
+        while pending:
+            filename, content, _ = pending.pop()
+            started = time.perf_counter()
+            while True:
+                response = await client.post("/documents/upload", files={"file": (filename, content)})
+                if response.status_code != 503:
+                    break
+                # Ingestion queue full
+                totals["rejected"] += 1
+                await asyncio.sleep(0.05)
+            if response.status_code >= 400:
+                statuses[f"http_{response.status_code}"] += 1
+                continue
+            job_id = response.json()["job_id"]
+            while True:
+                job = (await client.get(f"/documents/jobs/{job_id}")).json()
+                if job["status"] in FINISHED:
+                    break
+                await asyncio.sleep(0.02)
+            latencies.append(time.perf_counter() - started)
+            statuses[job["status"]] += 1
+            totals["chunks"] += job.get("chunks") or 0
+
+    started = time.perf_counter()
+    await asyncio.gather(*(uploader() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    return {
+        "documents": len(corpus),
+        "statuses": dict(statuses),
+        "chunks": totals["chunks"],
+        "rejected_503": totals["rejected"],
+        "wall_s": round(wall, 3),
+        "documents_per_s": round(statuses["succeeded"] / wall, 2),
+        "chunks_per_s": round(totals["chunks"] / wall, 1),
+        "latency": latency_summary(latencies),
+    }
+
+async def ask(client: httpx.AsyncClient, questions, args):
+    """Send every question, args.concurrency at a time"""
+    from app.api.routes.qa import NO_RESULTS_ANSWER
+
+    pending = list(reversed(questions))
+    latencies = []
+    totals = {"errors": 0, "no_results": 0}
+    path = "/ask/stream" if args.stream else "/ask"
+
+    async def asker():
+        while pending:
+            question = pending.pop()
+            started = time.perf_counter()
+            response = await client.post(path, json={
+                "question": question,
+                "similarity_threshold": args.similarity_threshold,
+                "top_k": args.top_k,
+                "max_tokens": args.max_tokens,
+            })
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200 or (args.stream and "event: error" in response.text):
+                totals["errors"] += 1
+            elif NO_RESULTS_ANSWER in (response.text if args.stream else response.json()["answer"]):
+                totals["no_results"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(asker() for _ in range(args.concurrency)))
+    wall = time.perf_counter() - started
+    return {
+        "questions": len(questions),
+        "errors": totals["errors"],
+        "no_results": totals["no_results"],
+        "wall_s": round(wall, 3),
+        "requests_per_s": round(len(questions) / wall, 2),
+        "latency": latency_summary(latencies),
+    }
+
+async def wait_ready(client: httpx.AsyncClient, started: float):
+    """Poll /health/ready until warm-up finishes"""
+    while True:
+        response = await client.get("/health/ready")
+        if response.status_code == 200 or response.json()["status"] == "failed":
+            return {"ready_s": round(time.perf_counter() - started, 3), **response.json()}
+        await asyncio.sleep(0.01)
+
+async def run(args, corpus, questions):
+    from app.main import app
+    from app.utils.metrics import add_stage_observer
+
+    logging.getLogger().setLevel(args.log_level)
+
+    samples = defaultdict(lambda: defaultdict(list))
+    phase = {"name": "startup"}
+    add_stage_observer(lambda stage, seconds: samples[phase["name"]][stage].append(seconds))
+
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    started = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            results["startup"] = await wait_ready(client, started)
+            phase["name"] = "ingest"
+            results["ingest"] = await ingest(client, corpus, args.concurrency)
+            if questions:
+                phase["name"] = "ask"
+                results["ask"] = await ask(client, questions, args)
+            phase["name"] = "shutdown"
+
+    results["stages"] = {
+        name: {stage: latency_summary(values) for stage, values in sorted(stages.items())}
+        for name, stages in samples.items() if name in ("ingest", "ask")
+    }
+    return results
+
+def comparable(results):
+    """Flat {metric: value} of the numbers worth comparing between runs"""
+    flat = {}
+    if "startup" in results:
+        flat["startup ready_s"] = results["startup"]["ready_s"]
+    for name, key in (("ingest", "documents_per_s"), ("ask", "requests_per_s")):
+        if name in results:
+            flat[f"{name} {key}"] = results[name][key]
+            for q in ("p50_ms", "p95_ms", "p99_ms"):
+                flat[f"{name} latency {q}"] = results[name]["latency"].get(q)
+    for name, stages in results.get("stages", {}).items():
+        for stage, summary in stages.items():
+            for q in ("p50_ms", "p95_ms", "p99_ms"):
+                flat[f"{name}/{stage} {q}"] = summary.get(q)
+    return flat
+
+def print_results(results):
+    print(f"startup: {results['startup']}")
+    for name in ("ingest", "ask"):
+        if name not in results:
+            continue
+        summary = {k: v for k, v in results[name].items() if k != "latency"}
+        print(f"{name}: {summary}")
+        print(f"  latency: {results[name]['latency']}")
+    print(f"{'stage':<32} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, stages in results["stages"].items():
+        for stage, s in stages.items():
+            print(f"{name + '/' + stage:<32} {s['count']:>7} {s['p50_ms']:>9} {s['p95_ms']:>9} {s['p99_ms']:>9}")
+    print(f"openai: {results['openai']}")
+
+def print_comparison(baseline, results):
+    before, after = comparable(baseline), comparable(results)
+    print(f"\ncompared with {baseline.get('commit')} ({baseline.get('created_at')})")
+    print(f"{'metric':<40} {'before':>10} {'after':>10} {'change':>8}")
+    for metric in [metric for metric in after if metric in before]:
+        b, a = before[metric], after[metric]
+        if b is None or a is None:
+            continue
+        change = f"{(a - b) / b * 100:+.1f}%" if b else ""
+        print(f"{metric:<40} {b:>10} {a:>10} {change:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=100)
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=["txt", "pdf", "docx"])
+    parser.add_argument("--questions", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stream", action="store_true", help="ask through /ask/stream")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--max-tokens", type=int, default=1000)
+    # Bag-of-words vectors of a short question are less similar to their chunk
+    # than real embeddings, so by default every question goes to the completion
+    parser.add_argument("--similarity-threshold", type=float, default=0.0)
+    parser.add_argument("--vector-db", default=os.getenv("VECTOR_DB", "faiss"), choices=["faiss", "numpy"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", default=None, help="write results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="results JSON of an earlier run to compare with")
+    fake_openai.add_arguments(parser)
+    args = parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory()
+    port = free_port()
+    # Settings are read when app.config is imported
+    os.environ.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{port}/v1",
+        "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(workdir.name, 'metadata.db')}",
+        "STORAGE_BACKEND": "local",
+        "LOCAL_STORAGE_PATH": os.path.join(workdir.name, "storage"),
+        "VECTOR_DB": args.vector_db,
+        "VECTOR_DB_PATH": os.path.join(workdir.name, "vectordb"),
+        "UPLOAD_SPOOL_PATH": os.path.join(workdir.name, "spool"),
+        "LOG_FOLDER": os.path.join(workdir.name, "logs"),
+    })
+
+    corpus = make_corpus(args.documents, args.pages, args.words_per_page, args.formats, args.seed)
+    questions = make_questions(corpus, args.questions, args.seed)
+
+    fake = start_fake_openai(args, port)
+    try:
+        results = asyncio.run(run(args, corpus, questions))
+        results["openai"] = httpx.get(f"http://127.0.0.1:{port}/stats").json()
+    finally:
+        fake.terminate()
+        fake.wait()
+        workdir.cleanup()
+
+    results = {"commit": git_commit(), "created_at": datetime.now().isoformat(timespec="seconds"), "args": vars(args), **results}
+    print_results(results)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(json.load(f), results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Benchmark the streaming chunker against the previous chunk_text
+
+The previous implementation tokenized the whole document into one list and
+called tokenizer.decode on every overlapping window. iter_chunks consumes
+the text page by page and slices chunk text out of the page buffer by
+token offsets.
+
+Each mode runs in a fresh subprocess so peak RSS (ru_maxrss, measured as
+growth over the process after the corpus is generated) isn't shared
+between them:
+
+  - old:        previous chunk_text over the joined document
+  - new:        iter_chunks over the pages, collected into a list
+  - new-stream: iter_chunks over the pages, each chunk dropped once counted
+  - new-snap:   like new, with sentence/paragraph snapping
+
+Throughput depends on the tokenizer, so run it with the real cl100k_base
+encoding: tiktoken downloads it, or reads it from TIKTOKEN_CACHE_DIR on a
+host without network access.
+
+Usage:
+    python benchmarks/bench_chunker.py --pages 2000
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import resource
+import subprocess
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+MODES = ["old", "new", "new-stream", "new-snap"]
+
+def make_pages(pages, seed=0):
+    """Synthetic pages of Vietnamese/English prose split into paragraphs"""
+    rng = random.Random(seed)
+    words = ("tài liệu hệ thống câu hỏi trả lời dữ liệu the system answers questions "
+             "about uploaded documents using retrieved context").split()
+
+    def sentence():
+        return " ".join(rng.choice(words) for _ in range(rng.randint(6, 24))).capitalize() + rng.choice(".!?")
+
+    def paragraph():
+        return " ".join(sentence() for _ in range(rng.randint(2, 7)))
+
+    return ["\n\n".join(paragraph() for _ in range(6)) + "\n" for _ in range(pages)]
+
+def old_chunk_text(tokenizer, text, chunk_size=400, overlap=50):
+    """The previous implementation"""
+    tokens = tokenizer.encode(text)
+    chunks = []
+    i = 0
+    while i < len(tokens):
+        chunk_end = min(i + chunk_size, len(tokens))
+        chunks.append(tokenizer.decode(tokens[i:chunk_end]))
+        i += (chunk_size - overlap)
+    return chunks
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_mode(mode, pages):
+    """Run one mode in this process and return its measurements"""
+    from app.core.document_processor import iter_chunks, tokenizer
+
+    page_texts = make_pages(pages)
+    text_mb = sum(len(page.encode("utf-8")) for page in page_texts) / 2**20
+    base_rss = max_rss_mb()
+
+    start = time.perf_counter()
+    if mode == "old":
+        count = len(old_chunk_text(tokenizer, "".join(page_texts)))
+    elif mode == "new-stream":
+        count = sum(1 for _ in iter_chunks(page_texts, snap=False))
+    else:
+        count = len(list(iter_chunks(page_texts, snap=mode == "new-snap")))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "mode": mode,
+        "chunks": count,
+        "text_mb": text_mb,
+        "seconds": elapsed,
+        "mb_per_s": text_mb / elapsed,
+        "peak_rss_growth_mb": max_rss_mb() - base_rss,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.pages)))
+        return
+
+    print(f"{'mode':>11} {'chunks':>7} {'text MB':>8} {'seconds':>8} {'MB/s':>7} {'peak RSS +MB':>13}")
+    for mode in MODES:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--pages", str(args.pages), "--mode", mode],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        row = json.loads(output.strip().splitlines()[-1])
+        print(f"{row['mode']:>11} {row['chunks']:>7} {row['text_mb']:>8.1f} {row['seconds']:>8.2f} "
+              f"{row['mb_per_s']:>7.2f} {row['peak_rss_growth_mb']:>13.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Load test of the metadata database layer under concurrent requests
+
+Compares the previous pattern, a synchronous SQLAlchemy session queried
+directly inside async handlers, with the async engine and pooled sessions
+of app.db.models. Each simulated request runs the queries of a document
+listing page and a lookup by file_id; a health-check task pings the event
+loop every few milliseconds to measure how long other requests are stalled.
+
+SQLite (aiosqlite) stands in for Postgres by default. SQLite runs in
+process, so --rtt-ms adds a network round trip to every statement, slept in
+the thread that executes it like a client waiting on a server. Pass --url
+with a postgresql+asyncpg:// URL to run against a real server instead (the
+sync mode then uses psycopg2).
+
+Usage:
+    python benchmarks/bench_db.py --rows 50000 --requests 400 --concurrency 32 --rtt-ms 2
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+def summarize(name, wall, requests, pings):
+    # Per-request latency isn't comparable: blocking requests run one at a
+    # time and their queueing shows up as loop stall instead
+    return {
+        "mode": name,
+        "requests_per_s": round(requests / wall, 1),
+        "loop_stall_p50_ms": round(percentile(pings, 50), 2),
+        "loop_stall_p99_ms": round(percentile(pings, 99), 2),
+        "loop_stall_max_ms": round(max(pings, default=0.0), 2),
+    }
+
+async def heartbeat(stop, pings, interval=0.005):
+    """Record how late the event loop wakes a task that sleeps for interval"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        pings.append((time.perf_counter() - started - interval) * 1000)
+
+async def run_load(handler, file_ids, args):
+    """Run args.requests calls of handler with args.concurrency in flight"""
+    pings = []
+    stop = asyncio.Event()
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        async with limit:
+            await handler(file_ids[i % len(file_ids)], f"doc-{i % 100:02d}")
+
+    pinger = asyncio.create_task(heartbeat(stop, pings))
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    wall = time.perf_counter() - started
+    stop.set()
+    await pinger
+    return wall, args.requests, pings
+
+def add_round_trip(sync_engine, args):
+    """Sleep args.rtt_ms in the executing thread for every SQLite statement"""
+    from sqlalchemy import event
+
+    if not args.rtt_ms or not args.url.startswith("sqlite"):
+        return
+
+    def round_trip(statement):
+        time.sleep(args.rtt_ms / 1000)
+
+    @event.listens_for(sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        if hasattr(dbapi_connection, "run_async"):
+            # aiosqlite: the callback must be set on its worker thread
+            dbapi_connection.run_async(lambda connection: connection.set_trace_callback(round_trip))
+        else:
+            dbapi_connection.set_trace_callback(round_trip)
+
+async def bench_async(file_ids, args):
+    from sqlalchemy import func, select
+    from app.db.models import FileMetadata, SessionLocal, engine, pool_status
+
+    await engine.dispose()
+    add_round_trip(engine.sync_engine, args)
+
+    async def handler(file_id, prefix):
+        async with SessionLocal() as db_session:
+            await db_session.get(FileMetadata, file_id)
+            result = await db_session.execute(
+                select(FileMetadata).where(FileMetadata.filename.like(f"%{prefix}%"))
+                .order_by(FileMetadata.upload_time.desc()).limit(50)
+            )
+            result.scalars().all()
+            await db_session.execute(select(func.count()).select_from(FileMetadata))
+
+    result = summarize("async", *await run_load(handler, file_ids, args))
+    result["pool"] = pool_status()
+    await engine.dispose()
+    return result
+
+async def bench_sync(file_ids, args):
+    from sqlalchemy import create_engine, func, select
+    from sqlalchemy.orm import sessionmaker
+    from app.db.models import FileMetadata
+
+    sync_url = args.url.replace("+aiosqlite", "").replace("+asyncpg", "+psycopg2")
+    sync_engine = create_engine(sync_url)
+    add_round_trip(sync_engine, args)
+    SyncSession = sessionmaker(autocommit=False, autoflush=False, bind=sync_engine)
+
+    async def handler(file_id, prefix):
+        # What the route handlers used to do: blocking calls on the event loop
+        db_session = SyncSession()
+        try:
+            db_session.query(FileMetadata).filter_by(file_id=file_id).first()
+            db_session.query(FileMetadata).filter(FileMetadata.filename.like(f"%{prefix}%")) \
+                .order_by(FileMetadata.upload_time.desc()).limit(50).all()
+            db_session.execute(select(func.count()).select_from(FileMetadata)).scalar()
+        finally:
+            db_session.close()
+
+    result = summarize("sync", *await run_load(handler, file_ids, args))
+    sync_engine.dispose()
+    return result
+
+async def seed(args):
+    """Create the table and insert args.rows documents; returns a sample of file_ids"""
+    from app.db.models import FileMetadata, SessionLocal, create_tables
+
+    await create_tables()
+    rng = np.random.default_rng(0)
+    start = datetime(2024, 1, 1)
+    file_ids = []
+    async with SessionLocal() as db_session:
+        for batch_start in range(0, args.rows, 5000):
+            records = []
+            for i in range(batch_start, min(batch_start + 5000, args.rows)):
+                file_id = str(uuid.uuid4())
+                file_ids.append(file_id)
+                file_type = [".pdf", ".docx", ".txt"][i % 3]
+                records.append(FileMetadata(
+                    file_id=file_id,
+                    filename=f"doc-{int(rng.integers(100)):02d}-{i}{file_type}",
+                    file_size=int(rng.integers(1000, 10_000_000)),
+                    file_type=file_type,
+                    vector_id=file_id,
+                    file_url=f"https://example.invalid/{file_id}",
+                    upload_time=start + timedelta(seconds=i),
+                    content_hash=uuid.uuid4().hex,
+                ))
+            db_session.add_all(records)
+            await db_session.commit()
+    return file_ids[::max(len(file_ids) // 1000, 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=None, help="async database URL (default: a temporary SQLite file)")
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--rtt-ms", type=float, default=2.0, help="simulated round trip per SQLite statement")
+    parser.add_argument("--output", default=None, help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    tmpdir = None
+    if args.url is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        args.url = f"sqlite+aiosqlite:///{os.path.join(tmpdir.name, 'bench.db')}"
+    # Settings are read when app.config is imported
+    os.environ["DATABASE_URL"] = args.url
+    os.environ["DB_POOL_SIZE"] = str(args.pool_size)
+
+    async def run():
+        file_ids = await seed(args)
+        results = [await bench_sync(file_ids, args), await bench_async(file_ids, args)]
+        from app.db.models import engine
+        await engine.dispose()
+        return results
+
+    results = asyncio.run(run())
+    print(
+        f"{args.rows} rows, {args.requests} requests, {args.concurrency} concurrent, "
+        f"pool size {args.pool_size}, {args.rtt_ms} ms round trip"
+    )
+    print(f"{'mode':<6} {'req/s':>8} {'loop stall p50 ms':>18} {'p99 ms':>8} {'max ms':>8}")
+    for r in results:
+        print(
+            f"{r['mode']:<6} {r['requests_per_s']:>8} {r['loop_stall_p50_ms']:>18} "
+            f"{r['loop_stall_p99_ms']:>8} {r['loop_stall_max_ms']:>8}"
+        )
+    print("pool:", results[1]["pool"])
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+if __name__ == "__main__":
+    main()
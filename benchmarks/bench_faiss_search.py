@@ -0,0 +1,82 @@
+"""
+Benchmark FAISS query latency: full-corpus scan vs top-k / per-document range search
+
+Compares the old search_similar_chunks strategy (index.search(q, ntotal)
+followed by a Python filter loop) with searching only top_k neighbours
+globally and restricting file_id searches to the document's ID range.
+
+Usage:
+    python benchmarks/bench_faiss_search.py --sizes 100000 1000000 --dim 1536
+
+A 1M x 1536 float32 corpus needs about 6 GB of RAM; pass a smaller --dim
+to run the same comparison on smaller machines.
+"""
+import argparse
+import time
+import faiss
+import numpy as np
+
+def old_search(index, doc_ids, query, file_id, top_k):
+    """The previous strategy: rank the whole corpus, then filter in Python"""
+    distances, indices = index.search(query, index.ntotal)
+    results = []
+    for i, idx in enumerate(indices[0]):
+        if file_id and doc_ids[idx] != file_id:
+            continue
+        results.append((int(idx), float(distances[0][i])))
+        if len(results) >= top_k:
+            break
+    return results
+
+def new_search(index, ranges, query, file_id, top_k):
+    """Top-k search, restricted to the document's ID range for file_id queries"""
+    if file_id:
+        start, end = ranges[file_id]
+        params = faiss.SearchParameters(sel=faiss.IDSelectorRange(start, end))
+        distances, indices = index.search(query, min(top_k, end - start), params=params)
+    else:
+        distances, indices = index.search(query, min(top_k, index.ntotal))
+    return [(int(idx), float(dist)) for idx, dist in zip(indices[0], distances[0])]
+
+def timed(fn, repeat):
+    """Return the median latency of fn in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return float(np.median(samples))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--chunks-per-doc", type=int, default=40, help="~20-page document")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'chunks':>10} {'mode':>8} {'old ms':>10} {'new ms':>10} {'speedup':>8}")
+
+    for size in args.sizes:
+        index = faiss.IndexFlatL2(args.dim)
+        for start in range(0, size, 100_000):
+            block = rng.standard_normal((min(100_000, size - start), args.dim), dtype=np.float32)
+            index.add(block)
+
+        doc_ids = [f"doc-{i // args.chunks_per_doc}" for i in range(size)]
+        ranges = {}
+        for i, doc_id in enumerate(doc_ids):
+            ranges.setdefault(doc_id, [i, i + 1])[1] = i + 1
+
+        query = rng.standard_normal((1, args.dim), dtype=np.float32)
+        target = doc_ids[size // 2]
+
+        for mode, file_id in (("global", None), ("file_id", target)):
+            old_ms = timed(lambda: old_search(index, doc_ids, query, file_id, args.top_k), args.repeat)
+            new_ms = timed(lambda: new_search(index, ranges, query, file_id, args.top_k), args.repeat)
+            print(f"{size:>10} {mode:>8} {old_ms:>10.2f} {new_ms:>10.3f} {old_ms / new_ms:>7.0f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark the NumPy backend against the FAISS scanning loop
+
+Compares, per query:
+  - faiss-scan: the old search_similar_chunks strategy, index.search(q, ntotal)
+    followed by a Python loop over the ranked results
+  - faiss-topk: IndexFlatL2 asked for top_k neighbours only
+  - numpy: NumpyIndex.search with one query
+  - numpy-batch: NumpyIndex.search with --batch queries at once, per query
+
+Usage:
+    python benchmarks/bench_numpy_search.py --sizes 10000 100000 --dim 1536
+"""
+import os
+import sys
+import argparse
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.db.numpy_index import NumpyIndex  # noqa: E402
+
+def timed(fn, repeat):
+    """Return the median latency of fn in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return float(np.median(samples))
+
+def faiss_scan(index, query, top_k, threshold):
+    """The previous strategy: rank the whole corpus, then filter in Python"""
+    distances, indices = index.search(query, index.ntotal)
+    results = []
+    for i, idx in enumerate(indices[0]):
+        if 1.0 / (1.0 + distances[0][i]) >= threshold:
+            results.append(int(idx))
+            if len(results) >= top_k:
+                break
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    try:
+        import faiss
+    except ImportError:
+        faiss = None
+        print("faiss is not installed; skipping the FAISS columns")
+
+    rng = np.random.default_rng(0)
+    print(f"{'chunks':>10} {'faiss-scan':>11} {'faiss-topk':>11} {'numpy':>9} {'numpy-batch':>12}  (ms/query)")
+
+    for size in args.sizes:
+        vectors = rng.standard_normal((size, args.dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = rng.standard_normal((args.batch, args.dim), dtype=np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        query = queries[:1]
+
+        numpy_index = NumpyIndex(args.dim)
+        numpy_index.add(vectors)
+        numpy_ms = timed(lambda: numpy_index.search(query, args.top_k, max_distance=1.0), args.repeat)
+        batch_ms = timed(lambda: numpy_index.search(queries, args.top_k, max_distance=1.0), args.repeat) / args.batch
+
+        scan_ms = topk_ms = float("nan")
+        if faiss is not None:
+            faiss_index = faiss.IndexFlatL2(args.dim)
+            faiss_index.add(vectors)
+            scan_ms = timed(lambda: faiss_scan(faiss_index, query, args.top_k, 0.5), args.repeat)
+            topk_ms = timed(lambda: faiss_index.search(query, args.top_k), args.repeat)
+
+        print(f"{size:>10} {scan_ms:>11.2f} {topk_ms:>11.2f} {numpy_ms:>9.2f} {batch_ms:>12.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Recall@k vs memory report for the vector storage precisions
+
+Builds a synthetic clustered corpus of unit vectors (embeddings of
+related chunks sit close together, which is what makes quantization
+error matter), then compares each storage setting against exact float32
+search:
+
+  - recall@k: fraction of the exact top-k found
+  - bytes/vector and total index memory
+  - ms/query
+
+"+rescore" rows fetch top_k * factor candidates from the quantized index
+and re-rank them against the full-precision vectors, as the vector store
+does when VECTOR_RESCORE_FACTOR > 1.
+
+Usage:
+    python benchmarks/bench_quantization.py --size 100000 --dim 1536 --top-k 3
+"""
+import os
+import sys
+import json
+import argparse
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.db.numpy_index import NumpyIndex  # noqa: E402
+
+def make_corpus(rng, size, dim, clusters):
+    """Unit vectors drawn around random cluster centres"""
+    centres = rng.standard_normal((clusters, dim), dtype=np.float32)
+    vectors = centres[rng.integers(0, clusters, size)] + 0.6 * rng.standard_normal((size, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def rescore(vectors, queries, candidates, k):
+    """Re-rank candidate IDs by exact distance"""
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    for q, query in enumerate(queries):
+        cand = candidates[q][candidates[q] >= 0]
+        exact = np.sum((vectors[cand] - query) ** 2, axis=1)
+        ids[q] = cand[np.argsort(exact)[:k]]
+    return ids
+
+def recall(found, truth):
+    return float(np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)]))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--clusters", type=int, default=500)
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_corpus(rng, args.size, args.dim, args.clusters)
+    queries = make_corpus(rng, args.queries, args.dim, args.clusters)
+    k = args.top_k
+
+    exact = NumpyIndex(args.dim, capacity=args.size)
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    results = []
+    for precision in ("float32", "float16", "int8"):
+        index = NumpyIndex(args.dim, capacity=args.size, precision=precision)
+        index.add(vectors)
+        settings = [(precision, 1)]
+        if precision != "float32":
+            settings.append((f"{precision}+rescore", args.rescore_factor))
+
+        for name, factor in settings:
+            start = time.perf_counter()
+            _, found = index.search(queries, k * factor)
+            if factor > 1:
+                found = rescore(vectors, queries, found, k)
+            elapsed = (time.perf_counter() - start) * 1000 / len(queries)
+            results.append({
+                "setting": name,
+                f"recall@{k}": recall(found, truth),
+                "bytes_per_vector": index.nbytes / args.size,
+                "index_mb": index.nbytes / 2**20,
+                "ms_per_query": elapsed,
+            })
+
+    print(f"corpus: {args.size} x {args.dim}, {args.queries} queries, top_k={k}")
+    print(f"{'setting':>16} {'recall@' + str(k):>10} {'bytes/vec':>10} {'index MB':>10} {'ms/query':>9}")
+    for row in results:
+        print(f"{row['setting']:>16} {row[f'recall@{k}']:>10.4f} {row['bytes_per_vector']:>10.0f} "
+              f"{row['index_mb']:>10.1f} {row['ms_per_query']:>9.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Benchmark query latency of the local vector store against its shard count
+
+For each --shards value, a subprocess with VECTOR_SHARDS set and a
+temporary VECTOR_DB_PATH fills the store through add_documents_to_vectordb
+with a synthetic clustered corpus (benchmarks/bench_ann.py), writes every
+shard's index snapshot, then times searches through the same fan-out and
+merge as /ask, without embedding the queries:
+
+  - global:     single-query searches one at a time (p50/p95 latency)
+  - throughput: --concurrency searches in flight (queries/s)
+  - file_id:    single-query searches restricted to one document, which
+                only touch the owning shard
+
+recall@k is measured against an exact search of the whole corpus, so HNSW
+shards (VECTOR_INDEX_TYPE=hnsw) show what sharding does to recall too.
+
+A global search runs the shards in parallel threads, so latency can only
+drop with at least as many free cores as shards; on fewer cores the extra
+shards add overhead instead. The speedup from the fan-out has not been
+measured on a multi-core host yet: so far only single-core runs exist,
+where every shard count above 1 is slower. Other settings come from the
+environment, e.g. VECTOR_DB=numpy or VECTOR_PRECISION=float16.
+
+Usage:
+    python benchmarks/bench_shards.py --size 200000 --shards 1 2 4 8
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+from bench_ann import make_corpus
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+# The store's vector width (text-embedding-3-small)
+DIM = 1536
+
+def make_data(args):
+    rng = np.random.default_rng(args.seed)
+    projection = rng.standard_normal((args.latent_dim, DIM), dtype=np.float32) / np.sqrt(args.latent_dim)
+    vectors = make_corpus(rng, args.size, DIM, args.clusters, args.latent_dim, projection)
+    queries = make_corpus(rng, args.queries, DIM, args.clusters, args.latent_dim, projection)
+    return vectors, queries
+
+def exact_top_k(vectors, queries, k):
+    """Row numbers of the k nearest corpus vectors of each query"""
+    found = []
+    for offset in range(0, len(queries), 64):
+        batch = queries[offset:offset + 64]
+        distances = np.sum(vectors ** 2, axis=1) - 2.0 * batch @ vectors.T
+        found.extend(np.argsort(distances, axis=1)[:, :k].tolist())
+    return found
+
+def latency_ms(seconds):
+    ms = np.array(seconds) * 1000
+    return round(float(np.percentile(ms, 50)), 3), round(float(np.percentile(ms, 95)), 3)
+
+async def run_child(args):
+    """Fill a store with VECTOR_SHARDS shards and time searches; settings come from the environment"""
+    sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+    from app.db import vector_store as vs
+
+    vectors, queries = make_data(args)
+    truth = exact_top_k(vectors, queries, args.top_k)
+    await vs.load_vector_store()
+
+    start = time.perf_counter()
+    documents = []
+    for offset in range(0, args.size, args.chunks_per_doc):
+        rows = range(offset, min(offset + args.chunks_per_doc, args.size))
+        documents.append((
+            f"doc{offset // args.chunks_per_doc}",
+            [{"content": f"chunk {row}", "metadata": {"row": row}} for row in rows],
+            vectors[offset:offset + args.chunks_per_doc],
+        ))
+        if len(documents) == 50:
+            await vs.add_documents_to_vectordb(documents)
+            documents = []
+    if documents:
+        await vs.add_documents_to_vectordb(documents)
+    fill_s = time.perf_counter() - start
+
+    # Searches should hit the index, not the exact scan of rows past it
+    start = time.perf_counter()
+    await asyncio.gather(*(shard._update_snapshot() for shard in vs.shards))
+    snapshot_s = time.perf_counter() - start
+
+    async def search(query, file_id=None):
+        return await vs._search_shards(query.reshape(1, -1), file_id, 0.0, args.top_k)
+
+    for query in queries[:10]:
+        await search(query)
+
+    seconds, hits = [], 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = (await search(query))[0]
+        seconds.append(time.perf_counter() - start)
+        hits += len({chunk["metadata"]["row"] for chunk in found} & set(expected))
+    p50, p95 = latency_ms(seconds)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(query):
+        async with semaphore:
+            await search(query)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(limited(query) for query in queries))
+    qps = len(queries) / (time.perf_counter() - start)
+
+    file_seconds = []
+    for query, expected in zip(queries, truth):
+        file_id = f"doc{expected[0] // args.chunks_per_doc}"
+        start = time.perf_counter()
+        await search(query, file_id)
+        file_seconds.append(time.perf_counter() - start)
+    file_p50, file_p95 = latency_ms(file_seconds)
+
+    vs.shutdown_search_pool()
+    return {
+        "shards": len(vs.shards),
+        "index": type(vs.shards[0].index).__name__,
+        "fill_s": round(fill_s, 2),
+        "snapshot_s": round(snapshot_s, 2),
+        "recall": round(hits / (len(queries) * args.top_k), 4),
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "qps": round(qps, 1),
+        "file_p50_ms": file_p50,
+        "file_p95_ms": file_p95,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--latent-dim", type=int, default=64)
+    parser.add_argument("--chunks-per-doc", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8, help="searches in flight for the throughput run")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8], help="VECTOR_SHARDS values")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(run_child(args))))
+        return
+
+    print(f"corpus: {args.size} x {DIM}, {args.queries} queries, top_k={args.top_k}, "
+          f"VECTOR_DB={os.getenv('VECTOR_DB', 'faiss')}, {os.cpu_count()} CPUs")
+    print(f"{'shards':>6} {'index':>16} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'qps':>8} "
+          f"{'file p50':>9} {'file p95':>9} {'fill s':>7}")
+    for count in args.shards:
+        with tempfile.TemporaryDirectory() as workdir:
+            # Settings are read when app.config is imported, so each count gets its own process
+            env = dict(
+                os.environ,
+                OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "bench"),
+                VECTOR_DB=os.getenv("VECTOR_DB", "faiss"),
+                VECTOR_DB_PATH=os.path.join(workdir, "vectordb"),
+                VECTOR_SHARDS=str(count),
+                VECTOR_SNAPSHOT_ROWS=str(args.size + 1),
+                LOG_FOLDER=os.path.join(workdir, "logs"),
+            )
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), "--child", *sys.argv[1:]], env=env, text=True
+            )
+        r = json.loads(output.strip().splitlines()[-1])
+        print(f"{r['shards']:>6} {r['index']:>16} {r['recall']:>7.4f} {r['p50_ms']:>8.3f} {r['p95_ms']:>8.3f} "
+              f"{r['qps']:>8.1f} {r['file_p50_ms']:>9.3f} {r['file_p95_ms']:>9.3f} {r['fill_s']:>7.1f}")
+
+if __name__ == "__main__":
+    main()
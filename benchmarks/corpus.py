@@ -0,0 +1,127 @@
+"""
+Synthetic document corpus for benchmarks
+
+Each document draws most of its words from its own topic vocabulary plus a
+shared pool, so documents differ but overlap like real ones, and some
+documents repeat a common boilerplate paragraph (as headers, footers and
+legal notices do). Questions are built from sentences of the generated
+documents, so retrieval has something to find. Everything is derived from
+the seed.
+
+Usage:
+    python benchmarks/corpus.py --documents 200 --pages 5 --formats txt pdf docx --out /tmp/corpus
+"""
+import io
+import os
+import random
+import argparse
+from typing import List, Tuple
+
+SHARED_WORDS = (
+    "tài liệu hệ thống dữ liệu quy trình khách hàng dịch vụ báo cáo hợp đồng "
+    "the a of and to in for with on by report process service customer data "
+    "policy system document section result value period total account"
+).split()
+
+BOILERPLATE = (
+    "Tài liệu này chỉ dùng cho mục đích nội bộ. This document is confidential and "
+    "provided without warranty of any kind; distribution requires written approval."
+)
+
+FORMATS = ("txt", "pdf", "docx")
+
+def _topic_words(rng: random.Random, count: int) -> List[str]:
+    letters = "abcdeghiklmnopqrstuvxy"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(4, 9))) for _ in range(count)]
+
+def _sentence(rng: random.Random, topic: List[str]) -> str:
+    words = [rng.choice(topic) if rng.random() < 0.6 else rng.choice(SHARED_WORDS) for _ in range(rng.randint(8, 20))]
+    return " ".join(words).capitalize() + "."
+
+def make_pages(rng: random.Random, pages: int, words_per_page: int) -> List[str]:
+    """Pages of paragraphs for one document"""
+    topic = _topic_words(rng, 60)
+    result = []
+    for _ in range(pages):
+        paragraphs, words = [], 0
+        while words < words_per_page:
+            paragraph = " ".join(_sentence(rng, topic) for _ in range(rng.randint(3, 7)))
+            paragraphs.append(paragraph)
+            words += len(paragraph.split())
+        if rng.random() < 0.3:
+            paragraphs.append(BOILERPLATE)
+        result.append("\n\n".join(paragraphs))
+    return result
+
+def _pdf_bytes(pages: List[str]) -> bytes:
+    import fitz
+
+    document = fitz.open()
+    for text in pages:
+        page = document.new_page()
+        page.insert_textbox(fitz.Rect(40, 40, 555, 800), text, fontsize=7)
+    content = document.tobytes()
+    document.close()
+    return content
+
+def _docx_bytes(pages: List[str]) -> bytes:
+    import docx
+
+    document = docx.Document()
+    for text in pages:
+        for paragraph in text.split("\n\n"):
+            document.add_paragraph(paragraph)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+def render(pages: List[str], file_format: str) -> bytes:
+    if file_format == "pdf":
+        return _pdf_bytes(pages)
+    if file_format == "docx":
+        return _docx_bytes(pages)
+    return "\n\n".join(pages).encode("utf-8")
+
+def make_corpus(
+    documents: int, pages: int = 3, words_per_page: int = 400, formats=("txt",), seed: int = 0
+) -> List[Tuple[str, bytes, List[str]]]:
+    """(filename, file content, sentences) of each generated document"""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(documents):
+        file_format = formats[i % len(formats)]
+        doc_pages = make_pages(rng, pages, words_per_page)
+        sentences = [s for page in doc_pages for s in page.replace("\n\n", " ").split(". ") if len(s.split()) >= 6]
+        corpus.append((f"doc-{i:05d}.{file_format}", render(doc_pages, file_format), sentences))
+    return corpus
+
+def make_questions(corpus: List[Tuple[str, bytes, List[str]]], count: int, seed: int = 0) -> List[str]:
+    """Questions made of a few consecutive words of random sentences in the corpus"""
+    rng = random.Random(seed + 1)
+    questions = []
+    for _ in range(count):
+        sentences = rng.choice(corpus)[2]
+        words = rng.choice(sentences).split()
+        start = rng.randint(0, max(len(words) - 6, 0))
+        questions.append(" ".join(words[start:start + 6]) + "?")
+    return questions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=100)
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=["txt"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", required=True)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    corpus = make_corpus(args.documents, args.pages, args.words_per_page, args.formats, args.seed)
+    for filename, content, _ in corpus:
+        with open(os.path.join(args.out, filename), "wb") as f:
+            f.write(content)
+    print(f"Wrote {len(corpus)} documents ({sum(len(c) for _, c, _ in corpus) / 1e6:.1f} MB) to {args.out}")
+
+if __name__ == "__main__":
+    main()
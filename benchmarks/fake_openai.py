@@ -0,0 +1,207 @@
+"""
+Local stand-in for the OpenAI embeddings and chat completions endpoints
+
+Embeddings are deterministic: each word is hashed onto a few signed
+dimensions and the sum is normalised, so texts that share words are close
+and the same text always gets the same vector. Completions echo words of
+the question. Latency and rate limits are configurable; requests over the
+limit get a 429 with retry-after-ms, the way the real API answers, so the
+client's retry logic is exercised too. Token counts are whitespace words,
+close enough for load purposes.
+
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:8100/v1.
+GET /stats returns request, token and rate-limit counters.
+
+Usage:
+    python benchmarks/fake_openai.py --port 8100 --embed-latency-ms 80 --chat-ttft-ms 300 --rpm 3000
+"""
+import re
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DIMENSION = 1536
+# Signed dimensions each word is hashed onto
+WORD_HASHES = 4
+
+_word = re.compile(r"\w+", re.UNICODE)
+
+def embed(text: str, dimension: int = DIMENSION) -> list:
+    """Deterministic bag-of-words vector of text"""
+    vector = np.zeros(dimension, dtype=np.float32)
+    words = _word.findall(text.lower()) or [text]
+    for word in words:
+        digest = hashlib.blake2b(word.encode(), digest_size=4 * WORD_HASHES).digest()
+        for i in range(WORD_HASHES):
+            h = int.from_bytes(digest[4 * i:4 * i + 4], "little")
+            vector[h % dimension] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector.tolist()
+
+def count_tokens(text: str) -> int:
+    return max(len(text.split()), 1)
+
+class RateLimiter:
+    """Token bucket refilled continuously at per_minute / 60 per second"""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+
+    def wait(self, amount: float) -> float:
+        """Seconds until amount is available, 0 if it is now"""
+        if not self.per_minute:
+            return 0.0
+        now = time.monotonic()
+        self.available = min(self.per_minute, self.available + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) * 60 / self.per_minute
+
+    def take(self, amount: float):
+        """Use up amount; call after wait() returned 0"""
+        if self.per_minute:
+            self.available -= amount
+
+def create_app(args) -> FastAPI:
+    app = FastAPI()
+    requests_limit = RateLimiter(args.rpm)
+    tokens_limit = RateLimiter(args.tpm)
+    stats = {
+        "embedding_requests": 0, "embedding_inputs": 0, "embedding_tokens": 0,
+        "chat_requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+        "rate_limited": 0,
+    }
+
+    def rate_limited(tokens: int):
+        # A rejected request uses up neither limit, like the real API
+        request_wait, token_wait = requests_limit.wait(1), tokens_limit.wait(tokens)
+        wait = max(request_wait, token_wait)
+        if not wait:
+            requests_limit.take(1)
+            tokens_limit.take(tokens)
+            return None
+        stats["rate_limited"] += 1
+        limit_type = "requests" if request_wait >= token_wait else "tokens"
+        return JSONResponse(
+            status_code=429,
+            content={"error": {"message": "Rate limit reached", "type": limit_type, "code": "rate_limit_exceeded"}},
+            headers={"retry-after-ms": str(int(wait * 1000) + 1)},
+        )
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        tokens = sum(count_tokens(text) for text in inputs)
+        limited = rate_limited(tokens)
+        if limited:
+            return limited
+
+        await asyncio.sleep((args.embed_latency_ms + args.embed_latency_per_input_ms * len(inputs)) / 1000)
+        stats["embedding_requests"] += 1
+        stats["embedding_inputs"] += len(inputs)
+        stats["embedding_tokens"] += tokens
+        return {
+            "object": "list",
+            "model": body.get("model", "text-embedding-3-small"),
+            "data": [
+                {"object": "embedding", "index": i, "embedding": embed(text, args.dimension)}
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt = " ".join(message["content"] for message in body["messages"])
+        prompt_tokens = count_tokens(prompt)
+        limit = body.get("max_completion_tokens") or body.get("max_tokens") or args.answer_tokens
+        completion_tokens = min(args.answer_tokens, limit)
+        limited = rate_limited(prompt_tokens + completion_tokens)
+        if limited:
+            return limited
+
+        stats["chat_requests"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["completion_tokens"] += completion_tokens
+        question = _word.findall(body["messages"][-1]["content"])[:completion_tokens] or ["ok"]
+        words = [question[i % len(question)] for i in range(completion_tokens)]
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": body.get("model", "fake")}
+
+        if not body.get("stream"):
+            await asyncio.sleep((args.chat_ttft_ms + args.chat_token_ms * completion_tokens) / 1000)
+            return {
+                **base,
+                "object": "chat.completion",
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": " ".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        async def events():
+            await asyncio.sleep(args.chat_ttft_ms / 1000)
+            for i, word in enumerate(words):
+                if i:
+                    await asyncio.sleep(args.chat_token_ms / 1000)
+                chunk = {
+                    **base,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": (" " if i else "") + word}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            if include_usage:
+                yield f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--dimension", type=int, default=DIMENSION)
+    parser.add_argument("--embed-latency-ms", type=float, default=80.0, help="latency of each embeddings request")
+    parser.add_argument("--embed-latency-per-input-ms", type=float, default=0.5, help="extra latency per embedded text")
+    parser.add_argument("--chat-ttft-ms", type=float, default=300.0, help="time to the first completion token")
+    parser.add_argument("--chat-token-ms", type=float, default=10.0, help="time per further completion token")
+    parser.add_argument("--answer-tokens", type=int, default=60, help="completion length in tokens")
+    parser.add_argument("--rpm", type=float, default=0, help="requests per minute across endpoints (0 = unlimited)")
+    parser.add_argument("--tpm", type=float, default=0, help="tokens per minute across endpoints (0 = unlimited)")
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()